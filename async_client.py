@@ -0,0 +1,233 @@
+# Client of the queue server for asyncio applications.
+#
+# It speaks the same wire protocol as queue_client, including the framing
+# of multiprocessing.connection: Every message is a pickled object that is
+# preceded by its length as 4 byte big-endian signed integer, or by -1 and
+# the length as 8 byte unsigned integer for messages of 2 GiB and more.
+#
+# Requests are pipelined: Many requests can be in flight on a connection
+# at once, the replies are matched to the requests by their request id.
+# The server handles the requests of one connection one after another,
+# so requests are spread over a pool of connections to be handled
+# concurrently.
+
+import asyncio
+import pickle
+import struct
+
+from queue_system import *
+
+# Max. number of connections of an async_queue_client
+default_num_connections = 4
+
+
+# Connection to the queue server. The connection is opened in the
+# background, requests can be sent right away.
+class async_connection:
+  def __init__(self, address):
+    self._reader = None
+    self._writer = None
+    # request id -> future of the reply
+    self._pending = dict()
+    # request id -> list into which the rows of a job listing are received
+    self._rows = dict()
+    # Number of requests that wait for the connection to be opened
+    self._num_waiting = 0
+    self._closed = False
+    self._connected = asyncio.get_running_loop().create_future()
+    self._receiver = asyncio.ensure_future(self._receive_responses(address))
+
+  def is_closed(self):
+    return self._closed
+
+  # Number of requests that have not been answered yet
+  def num_pending(self):
+    return len(self._pending) + self._num_waiting
+
+  def _send_message(self, msg):
+    payload = pickle.dumps(msg, pickle.HIGHEST_PROTOCOL)
+    if len(payload) > 0x7fffffff:
+      header = struct.pack("!i", -1) + struct.pack("!Q", len(payload))
+    else:
+      header = struct.pack("!i", len(payload))
+    self._writer.write(header + payload)
+
+  async def _receive_message(self):
+    size, = struct.unpack("!i", await self._reader.readexactly(4))
+    if size == -1:
+      size, = struct.unpack("!Q", await self._reader.readexactly(8))
+    return pickle.loads(await self._reader.readexactly(size))
+
+  async def _receive_responses(self, address):
+    error = None
+    try:
+      self._reader, self._writer = await asyncio.open_unix_connection(address)
+      self._connected.set_result(True)
+      while True:
+        response = await self._receive_message()
+        if response[0] == response_tag:
+          self._rows.pop(response[1], None)
+          future = self._pending.pop(response[1], None)
+          if future != None and not future.done():
+            future.set_result(response[2])
+        elif response[0] == rows_tag and response[1] in self._rows:
+          self._rows[response[1]].extend(response[2])
+    except asyncio.CancelledError:
+      error = ConnectionError("Connection has been closed.")
+    except asyncio.IncompleteReadError:
+      error = EOFError("Connection has been closed by the queue server.")
+    except Exception as e:
+      error = e
+    finally:
+      self._closed = True
+      if self._writer != None:
+        self._writer.close()
+      if not self._connected.done():
+        self._connected.set_exception(error)
+        # Don't warn about the exception if no request is waiting for it
+        self._connected.exception()
+      for future in self._pending.values():
+        if not future.done():
+          future.set_exception(error)
+      self._pending = dict()
+      self._rows = dict()
+
+  # Sends a request and returns a future of the reply. Raises an exception
+  # if the request could not be sent. If rows is given, the rows that are
+  # received in response to the request are appended to it.
+  async def send(self, request_id, msg, rows=None):
+    self._num_waiting += 1
+    try:
+      await self._connected
+    finally:
+      self._num_waiting -= 1
+    if self._closed:
+      raise ConnectionError("Connection has been closed.")
+
+    future = asyncio.get_running_loop().create_future()
+    self._pending[request_id] = future
+    if rows != None:
+      self._rows[request_id] = rows
+    try:
+      self._send_message([request_tag, request_id, msg])
+      await self._writer.drain()
+    except:
+      self._pending.pop(request_id, None)
+      self._rows.pop(request_id, None)
+      raise
+    return future
+
+  async def close(self):
+    self._receiver.cancel()
+    try:
+      await self._receiver
+    except asyncio.CancelledError:
+      pass
+    if self._writer != None:
+      try:
+        await self._writer.wait_closed()
+      except (ConnectionError, OSError):
+        pass
+
+
+# Client of the queue server with awaitable requests, which offers the same
+# requests as queue_client. All methods must be called from the same
+# event loop. Connections are opened as they are needed, up to
+# num_connections, and kept until close() is called.
+class async_queue_client:
+  def __init__(self, address=None, num_connections=default_num_connections):
+    if address == None:
+      address = socket_name
+    self._address = address
+    self._num_connections = num_connections
+    self._connections = []
+    self._next_request_id = 0
+    self._requests = client_requests()
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+
+  async def close(self):
+    connections = self._connections
+    self._connections = []
+    for connection in connections:
+      await connection.close()
+
+  # Returns the connection with the fewest pending requests. A new
+  # connection is opened if all connections are busy and the pool
+  # is not full yet.
+  def _get_connection(self):
+    self._connections = [c for c in self._connections if not c.is_closed()]
+    connection = min(self._connections, key=lambda c : c.num_pending(), default=None)
+
+    if ((connection == None or connection.num_pending() > 0) and
+        len(self._connections) < self._num_connections):
+      connection = async_connection(self._address)
+      self._connections.append(connection)
+    return connection
+
+  async def _request(self, msg, rows=None):
+    request_id = self._next_request_id
+    self._next_request_id += 1
+
+    try:
+      reply = await self._get_connection().send(request_id, msg, rows)
+    except (EOFError, OSError):
+      # The server may have closed an idle connection, try once more
+      # with a new one.
+      reply = await self._get_connection().send(request_id, msg, rows)
+    return await reply
+
+  # See queue_client._run_requests()
+  async def _run_requests(self, requests):
+    response = None
+    try:
+      while True:
+        response = await self._request(requests.send(response))
+    except StopIteration as e:
+      return e.value
+
+  # See queue_client.put_environment()
+  async def put_environment(self, env):
+    return await self._run_requests(self._requests.put_environment(env))
+
+  # Enqueues a job. The environment of the job is only sent to the server
+  # if the server doesn't know it already.
+  async def enqueue_job(self, jdata, queue_name=default_queue_name):
+    return await self._run_requests(self._requests.enqueue(jdata, queue_name))
+
+  # Enqueues a job array, see queue_client.enqueue_array()
+  async def enqueue_array(self, jdata, array_spec, queue_name=default_queue_name):
+    return await self._run_requests(self._requests.enqueue(jdata, queue_name, array_spec))
+
+  # Enqueues a list of jobs with a single request, see
+  # queue_client.enqueue_jobs()
+  async def enqueue_jobs(self, jdata_list, queue_name=default_queue_name):
+    return await self._run_requests(self._requests.enqueue_jobs(jdata_list, queue_name))
+
+  async def cancel_job(self, job_id, queue_name=default_queue_name):
+    return await self._request(['cancel', job_id, queue_name])
+
+  # Returns the jobs of a queue that match the filters, see
+  # queue_client.list_jobs(). Raises a RuntimeError if the server refuses
+  # the request.
+  async def list_jobs(self, queue_name=default_queue_name, filters=None, sort="id",
+                      limit=None, offset=0, fields=None):
+    rows = []
+    response = await self._request(['list_jobs', queue_name, filters, sort, limit, offset, fields], rows)
+    if response[0][0] != True:
+      raise RuntimeError(response[0][1])
+    return rows
+
+  async def uri_query(self, uri):
+    return await self._request(["uri_query", uri])
+
+  # See queue_client.uri_query_tree()
+  async def uri_query_tree(self, uri, attributes=None, depth=0):
+    return await self._request(["uri_query_tree", uri, attributes, depth])
+
+  async def shutdown_queue(self):
+    return await self._request(['shutdown'])
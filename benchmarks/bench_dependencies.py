@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# Dependency resolution for DAGs of 1k to 10k jobs, where every job depends
+# on up to 3 random earlier jobs. The jobs are submitted to a queue worker
+# and then "executed" in dependency order without starting processes.
+# Compares the incremental resolution of the queue worker, which only
+# visits the direct dependents of a finished job, with rescanning all held
+# jobs after every completion.
+
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import queue_system
+
+dag_sizes = [1000, 10000]
+max_dependencies = 3
+
+def make_dag(n):
+  dag = []
+  for i in range(n):
+    dag.append(random.sample(range(i), min(i, random.randint(0, max_dependencies))))
+  return dag
+
+def run_incremental(dag):
+  worker = queue_system.queue_worker(os.path.join(tempfile.mkdtemp(), "queue.log"))
+
+  start = time.perf_counter()
+  for dependencies in dag:
+    jdata = queue_system.job_data()
+    jdata.set_field(queue_system.job_data.CMD, ["true"])
+    if len(dependencies) > 0:
+      jdata.set_field(queue_system.job_data.DEPENDENCIES,
+                      "afterok:" + ":".join(str(d) for d in dependencies))
+    worker.new_job(jdata)
+  submitted = time.perf_counter()
+
+  num_finished = 0
+  with worker._lock:
+    while True:
+      j = worker._waiting_jobs.pop()
+      if j == None:
+        break
+      j.raw_data().set_field(queue_system.job_data.EXIT_CODE, 0)
+      worker._remove_job(j)
+      worker._job_left_queue(j, queue_system.job_state.FINISHED)
+      num_finished += 1
+  finished = time.perf_counter()
+
+  assert num_finished == len(dag)
+  return (submitted - start, finished - submitted)
+
+def run_rescan(dag):
+  start = time.perf_counter()
+  held = dict((i, set(dependencies)) for i, dependencies in enumerate(dag) if len(dependencies) > 0)
+  eligible = [i for i, dependencies in enumerate(dag) if len(dependencies) == 0]
+  submitted = time.perf_counter()
+
+  finished_jobs = set()
+  while len(eligible) > 0:
+    finished_jobs.add(eligible.pop())
+    for job_id in list(held.keys()):
+      if held[job_id] <= finished_jobs:
+        del held[job_id]
+        eligible.append(job_id)
+  finished = time.perf_counter()
+
+  assert len(finished_jobs) == len(dag)
+  return (submitted - start, finished - submitted)
+
+if __name__ == '__main__':
+  random.seed(42)
+  # The queue worker reports every job that leaves the queue
+  real_stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+
+  real_stdout.write("{:>8} {:>16} {:>20} {:>20}\n".format(
+    "jobs", "submission", "incremental resolve", "rescan resolve"))
+  for n in dag_sizes:
+    dag = make_dag(n)
+    submission_time, incremental_time = run_incremental(dag)
+    rescan_submission_time, rescan_time = run_rescan(dag)
+    real_stdout.write("{:>8} {:>14.3f} s {:>18.3f} s {:>18.3f} s\n".format(
+      n, submission_time, incremental_time, rescan_time))
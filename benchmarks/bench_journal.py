@@ -0,0 +1,115 @@
+#!/usr/bin/python
+
+# Benchmark of the queue journal: Submission throughput with and without
+# journaling, and the startup time of a queue whose journal contains the
+# history of 100k jobs.
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import queue_system
+from journal import *
+
+num_jobs = 100000
+num_submitting_threads = 16
+# Jobs of the history that are still waiting when the queue is restarted
+num_waiting_jobs = 1000
+
+def make_job_data():
+  jdata = queue_system.job_data()
+  jdata.set_field(queue_system.job_data.CMD, ["./simulation", "--input", "input.dat"])
+  jdata.set_field(queue_system.job_data.DIR, "/home/user/project")
+  jdata.set_field(queue_system.job_data.ENV, {"PATH": "/usr/local/bin:/usr/bin:/bin",
+                                              "HOME": "/home/user"})
+  return jdata
+
+def submit_jobs(worker):
+  def submit(n):
+    for i in range(n):
+      worker.new_job(make_job_data())
+
+  threads = [threading.Thread(target=submit, args=(num_jobs // num_submitting_threads,))
+             for i in range(num_submitting_threads)]
+  start = time.time()
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  return time.time() - start
+
+def measure_submission(temp_dir, use_journal):
+  journal = None
+  if use_journal:
+    journal = job_journal(os.path.join(temp_dir, "submission"), "default")
+  worker = queue_system.queue_worker(os.path.join(temp_dir, "queue.log"), journal=journal)
+  duration = submit_jobs(worker)
+  if journal != None:
+    journal.close()
+  return duration
+
+# Writes the journal of a queue that has run num_jobs jobs, of which
+# num_waiting_jobs are still waiting.
+def write_history(directory, snapshot_interval):
+  journal = job_journal(directory, "default", snapshot_interval)
+  journal.replay()
+  journal.start()
+
+  jobs = dict()
+  submission_date = datetime.datetime.now()
+  env = queue_system.shared_environments.intern(make_job_data().get_field(queue_system.job_data.ENV))
+  for job_id in range(num_jobs):
+    data = make_job_data().get()
+    data[queue_system.job_data.ID] = job_id
+    data[queue_system.job_data.SUBMISSION_DATE] = submission_date
+    data[queue_system.job_data.ENV] = env.content_hash
+    journal.append(job_journal.SUBMIT, job_id, data, (env.content_hash, env))
+    jobs[job_id] = data
+    if job_id < num_jobs - num_waiting_jobs:
+      journal.append(job_journal.START, job_id, None)
+      journal.append(job_journal.FINISH, job_id)
+      del jobs[job_id]
+
+    if journal.needs_snapshot():
+      journal.snapshot(job_id + 1, dict(jobs), set(), {env.content_hash : env})
+  journal.close()
+
+def measure_startup(directory):
+  start = time.time()
+  journal = job_journal(directory, "default")
+  worker = queue_system.queue_worker(os.devnull, journal=journal)
+  duration = time.time() - start
+  if worker.get_num_jobs() != num_waiting_jobs:
+    raise RuntimeError("Unexpected number of restored jobs: " + str(worker.get_num_jobs()))
+  journal.close()
+  return duration
+
+if __name__ == '__main__':
+  temp_dir = tempfile.mkdtemp()
+  # Restoring jobs is logged to stdout
+  real_stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+
+  try:
+    without_journal = measure_submission(temp_dir, False)
+    with_journal = measure_submission(temp_dir, True)
+    real_stdout.write("Submission of {} jobs from {} threads:\n".format(num_jobs, num_submitting_threads))
+    real_stdout.write("  {:<28} {:>10.0f} jobs/s\n".format("without journal", num_jobs / without_journal))
+    real_stdout.write("  {:<28} {:>10.0f} jobs/s\n".format("with journal", num_jobs / with_journal))
+
+    real_stdout.write("Startup with a history of {} jobs:\n".format(num_jobs))
+    for snapshot_interval in [default_snapshot_interval, 10 * num_jobs]:
+      directory = os.path.join(temp_dir, "history-" + str(snapshot_interval))
+      write_history(directory, snapshot_interval)
+      label = "snapshot every {} records".format(snapshot_interval)
+      if snapshot_interval > 3 * num_jobs:
+        label = "journal replay only"
+      real_stdout.write("  {:<28} {:>10.3f} s\n".format(label, measure_startup(directory)))
+  finally:
+    shutil.rmtree(temp_dir)
@@ -0,0 +1,63 @@
+#!/usr/bin/python
+
+# Job launch latency against the size of the queue server's heap: Time
+# from starting a job process until its pid is known, with
+# subprocess.Popen(preexec_fn=...) (as job.run did before the launcher
+# existed), with Popen(start_new_session=True), which uses vfork(), and
+# with the process_launcher, a separate small interpreter.
+# The heap is grown with touched memory, like a server with many jobs.
+
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import launcher
+
+heap_sizes_mib = [0, 256, 1024, 2048]
+num_launches = 50
+command = ["true"]
+
+def launch_preexec_fn():
+  return subprocess.Popen(command, stdout=devnull, stderr=devnull, preexec_fn=os.setsid)
+
+def launch_new_session():
+  return subprocess.Popen(command, stdout=devnull, stderr=devnull, start_new_session=True)
+
+def time_popen(launch):
+  total = 0
+  for i in range(num_launches):
+    start = time.perf_counter()
+    process = launch()
+    total += time.perf_counter() - start
+    process.wait()
+  return total / num_launches
+
+def time_launcher(process_launcher):
+  total = 0
+  for i in range(num_launches):
+    start = time.perf_counter()
+    pid = process_launcher.launch(command, "/", env, devnull, devnull)
+    total += time.perf_counter() - start
+    process_launcher.wait(pid)
+  return total / num_launches
+
+if __name__ == '__main__':
+  devnull = open(os.devnull, "w")
+  env = dict(os.environ)
+  process_launcher = launcher.process_launcher()
+
+  print("{:>10} {:>18} {:>18} {:>18}".format(
+    "heap", "preexec_fn", "start_new_session", "launcher"))
+  heap = []
+  for size in heap_sizes_mib:
+    while len(heap) < size:
+      # Touched, so that the pages are mapped
+      heap.append(b"x" * (1024 * 1024))
+    times = [time_popen(launch_preexec_fn), time_popen(launch_new_session),
+             time_launcher(process_launcher)]
+    print("{:>6} MiB {:>16.2f}ms {:>16.2f}ms {:>16.2f}ms".format(
+      size, *[1000 * t for t in times]))
+  process_launcher.close()
@@ -0,0 +1,81 @@
+#!/usr/bin/python
+
+# Job listing of a deep queue, as qstatus.py needs it: Downloading the
+# status fields of all jobs with one tree query and sorting them by
+# priority on the client (as qstatus.py did before list_jobs existed),
+# compared with list_jobs(), which sorts and pages on the server.
+# The queue does not execute the jobs.
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import queue_system
+from uri import *
+
+queue_sizes = [1000, 10000, 50000]
+page_size = 20
+status_fields = [queue_system.job_data.ID, queue_system.job_data.NAME,
+                 queue_system.job_data.RUNNING, queue_system.job_data.START_DATE,
+                 queue_system.job_data.DIR]
+
+def start_server(address, num_jobs):
+  worker = queue_system.queue_worker(os.path.join(tempfile.mkdtemp(), "queue.log"))
+  env = dict(os.environ)
+  jobs = []
+  for i in range(num_jobs):
+    jdata = queue_system.job_data()
+    jdata.set_field(queue_system.job_data.CMD, ["true", str(i)])
+    jdata.set_field(queue_system.job_data.DIR, "/tmp/dir" + str(i % 10))
+    jdata.set_field(queue_system.job_data.ENV, env)
+    jdata.set_field(queue_system.job_data.PRIORITY, 1 + i % 3)
+    jobs.append((jdata, None))
+  worker.new_jobs(jobs, num_jobs)
+
+  uri_root = uri_directory({"queues": uri_directory({"default": worker})})
+  server = queue_system.queue_server({"default": worker}, num_jobs, uri_root, address=address)
+  threading.Thread(target=server.listen, daemon=True).start()
+
+def list_by_tree_query(client):
+  result = client.uri_query_tree("qsystem://queues/default/jobs/by-id",
+                                 status_fields + ["effective_priority"], depth=1)
+  jobs = sorted(result[1].values(), key=lambda j : -j["effective_priority"])
+  return jobs[:page_size]
+
+def list_first_page(client):
+  return list(client.list_jobs(sort="priority", limit=page_size, fields=status_fields))
+
+def list_all(client):
+  return list(client.list_jobs(sort="priority", fields=status_fields))
+
+def list_filtered(client):
+  return list(client.list_jobs(filters={"dir": "/tmp/dir3", "name": "<unnamed-1*"},
+                               sort="priority", limit=page_size, fields=status_fields))
+
+def time_per_call(client, f, repetitions=5):
+  start = time.perf_counter()
+  for i in range(repetitions):
+    f(client)
+  return (time.perf_counter() - start) / repetitions
+
+if __name__ == '__main__':
+  # The server logs every request to stdout
+  real_stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+
+  real_stdout.write("{:>8} {:>20} {:>20} {:>20} {:>20}\n".format(
+    "jobs", "tree query + sort", "list_jobs, 1st page", "list_jobs, all", "list_jobs, filtered"))
+  for num_jobs in queue_sizes:
+    address = os.path.join(tempfile.mkdtemp(), "queue_system_socket")
+    start_server(address, num_jobs)
+    with queue_system.queue_client(address) as client:
+      assert len(list_first_page(client)) == page_size
+      assert len(list_all(client)) == num_jobs
+      times = [time_per_call(client, f) for f in
+               [list_by_tree_query, list_first_page, list_all, list_filtered]]
+    real_stdout.write("{:>8} {:>18.1f}ms {:>18.1f}ms {:>18.1f}ms {:>18.1f}ms\n".format(
+      num_jobs, *[1000 * t for t in times]))
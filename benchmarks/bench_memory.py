@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+# Memory benchmark: Bytes per queued job when the job data is stored as
+# dict-backed job_data with a private copy of the environment, as it is
+# received from the client, compared to compact job records that share
+# identical environments.
+
+import os
+import pickle
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import queue_system
+
+num_jobs = 10000
+
+def make_submission(env):
+  jdata = queue_system.job_data()
+  jdata.set_field(queue_system.job_data.CMD, ["./simulation", "--input", "input.dat"])
+  jdata.set_field(queue_system.job_data.DIR, "/home/user/project")
+  jdata.set_field(queue_system.job_data.ENV, env)
+  # Every submission arrives as a separately unpickled message
+  return pickle.loads(pickle.dumps(jdata.get()))
+
+def measure(make_jobs):
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  jobs = make_jobs()
+  after = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return (after - before) / len(jobs)
+
+def dict_backed_jobs(env):
+  return [queue_system.job(queue_system.job_data(make_submission(env)))
+          for i in range(num_jobs)]
+
+def compact_jobs(env):
+  jobs = []
+  for i in range(num_jobs):
+    record = queue_system.job_record(make_submission(env))
+    env_copy = record.get_field(queue_system.job_data.ENV)
+    record.set_field(queue_system.job_data.ENV,
+                     queue_system.shared_environments.intern(env_copy))
+    jobs.append(queue_system.job(record))
+  return jobs
+
+if __name__ == '__main__':
+  env = dict(os.environ)
+  env_size = len(pickle.dumps(env))
+
+  print("{} jobs, environment of {} bytes (pickled)".format(num_jobs, env_size))
+  print("{:<32} {:>12}".format("", "bytes/job"))
+  print("{:<32} {:>12.0f}".format("job_data, private environment", measure(lambda : dict_backed_jobs(env))))
+  print("{:<32} {:>12.0f}".format("job_record, shared environment", measure(lambda : compact_jobs(env))))
@@ -0,0 +1,170 @@
+#!/usr/bin/python
+
+# Trace-driven simulation of the scheduling policies. Replays a job log on
+# a queue with a given number of slots in virtual time, without starting
+# processes, and reports the utilization of the slots and the mean wait
+# time of the jobs under each policy, overall and of the jobs of all users
+# but the one who submitted the most jobs.
+#
+# The job log is read in the Standard Workload Format (SWF) of the Parallel
+# Workloads Archive: one job per line, comments start with ';'. Of the
+# whitespace separated fields, the submit time (2), run time (4), allocated
+# (5) and requested (8) processors, the requested time (9), all in
+# seconds, and the user id (12) are used. Processors are mapped to execution slots. Without a
+# log, a synthetic trace is generated.
+#
+# Usage: bench_policies.py [<swf file> [<number of slots>]]
+
+import datetime
+import heapq
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import queue_system
+
+default_num_slots = 64
+num_synthetic_jobs = 5000
+# Offered load of the synthetic trace, as fraction of the slots
+synthetic_load = 0.9
+
+epoch = datetime.datetime(2000, 1, 1)
+
+# Returns a list of tuples (submit time, runtime, slots, walltime, user)
+def read_swf(filename, num_slots):
+  trace = []
+  num_skipped = 0
+  with open(filename, "r") as f:
+    for line in f:
+      fields = line.split()
+      if len(fields) < 12 or fields[0].startswith(";"):
+        continue
+      submit_time = float(fields[1])
+      runtime = float(fields[3])
+      slots = int(fields[7]) if int(fields[7]) > 0 else int(fields[4])
+      walltime = float(fields[8]) if float(fields[8]) > 0 else runtime
+      if runtime < 0 or slots < 1 or slots > num_slots:
+        num_skipped += 1
+        continue
+      trace.append((submit_time, runtime, slots, max(walltime, runtime), int(fields[11])))
+  if num_skipped > 0:
+    print("Skipped", num_skipped, "jobs without runtime or with more than", num_slots, "slots")
+  trace.sort()
+  return trace
+
+# Mostly small jobs with a few wide ones, log-normal runtimes and walltimes
+# that overestimate the runtime by up to a factor of 3, as users do. One of
+# the users submits half of the jobs.
+def make_synthetic_trace(num_slots):
+  widths = [1, 1, 1, 1, 2, 4, 8, num_slots // 4, num_slots // 2, num_slots]
+  jobs = []
+  for i in range(num_synthetic_jobs):
+    slots = max(1, random.choice(widths))
+    runtime = min(random.lognormvariate(6, 1.5), 24 * 3600)
+    walltime = runtime * random.uniform(1, 3)
+    user = random.choice([0, 0, 0, 0, 1, 2, 3, 4])
+    jobs.append((runtime, slots, walltime, user))
+
+  mean_work = sum(runtime * slots for runtime, slots, walltime, user in jobs) / len(jobs)
+  mean_interarrival = mean_work / (num_slots * synthetic_load)
+  trace = []
+  submit_time = 0.0
+  for runtime, slots, walltime, user in jobs:
+    submit_time += random.expovariate(1 / mean_interarrival)
+    trace.append((submit_time, runtime, slots, walltime, user))
+  return trace
+
+def make_job(job_id, submit_time, slots, walltime, user):
+  jdata = queue_system.job_data()
+  jdata.set_field(queue_system.job_data.ID, job_id)
+  jdata.set_field(queue_system.job_data.SUBMISSION_DATE, epoch + datetime.timedelta(seconds=submit_time))
+  jdata.set_field(queue_system.job_data.SLOTS, slots)
+  jdata.set_field(queue_system.job_data.WALLTIME, int(walltime + 1))
+  jdata.set_field(queue_system.job_data.USER, user)
+  return queue_system.job(queue_system.job_record(jdata))
+
+# Returns (utilization, mean wait time in s, mean wait time of the users
+# other than the busiest one in s, scheduler time in s)
+def simulate(trace, num_slots, policy):
+  waiting_jobs = queue_system.job_priority_index()
+  running_jobs = dict()
+  free_slots = num_slots
+  # Events as (time, kind, job id), finishing jobs come before submissions
+  # at the same time
+  FINISH = 0
+  SUBMIT = 1
+  events = [(job[0], SUBMIT, i) for i, job in enumerate(trace)]
+  heapq.heapify(events)
+  jobs = dict()
+
+  # user -> (number of jobs, total wait time)
+  user_waits = dict()
+  total_wait = 0.0
+  used_slot_seconds = 0.0
+  end_time = 0.0
+  scheduler_time = 0.0
+  while len(events) > 0:
+    now_seconds = events[0][0]
+    while len(events) > 0 and events[0][0] == now_seconds:
+      event_time, kind, job_id = heapq.heappop(events)
+      if kind == SUBMIT:
+        submit_time, runtime, slots, walltime, user = trace[job_id]
+        jobs[job_id] = make_job(job_id, submit_time, slots, walltime, user)
+        waiting_jobs.push(jobs[job_id])
+      else:
+        j = running_jobs.pop(job_id)
+        free_slots += j.get_slots()
+        policy.job_finished(j, epoch + datetime.timedelta(seconds=event_time))
+        del jobs[job_id]
+
+    now = epoch + datetime.timedelta(seconds=now_seconds)
+    start = time.perf_counter()
+    while free_slots > 0:
+      j = policy.next_job(waiting_jobs, list(running_jobs.values()), free_slots, 0, now)
+      if j == None:
+        break
+      waiting_jobs.remove(j)
+      j.raw_data().set_field(queue_system.job_data.RUNNING, True)
+      j.raw_data().set_field(queue_system.job_data.START_DATE, now)
+      free_slots -= j.get_slots()
+      running_jobs[j.get_id()] = j
+      policy.job_started(j, now)
+
+      submit_time, runtime, slots, walltime, user = trace[j.get_id()]
+      total_wait += now_seconds - submit_time
+      num_jobs, user_wait = user_waits.get(user, (0, 0.0))
+      user_waits[user] = (num_jobs + 1, user_wait + now_seconds - submit_time)
+      used_slot_seconds += runtime * slots
+      end_time = max(end_time, now_seconds + runtime)
+      heapq.heappush(events, (now_seconds + runtime, FINISH, j.get_id()))
+    scheduler_time += time.perf_counter() - start
+
+  makespan = end_time - trace[0][0]
+  busiest_user = max(user_waits.keys(), key=lambda user : user_waits[user][0])
+  num_other_jobs = len(trace) - user_waits[busiest_user][0]
+  other_wait = (total_wait - user_waits[busiest_user][1]) / max(num_other_jobs, 1)
+  return (used_slot_seconds / (num_slots * makespan), total_wait / len(trace),
+          other_wait, scheduler_time)
+
+if __name__ == '__main__':
+  random.seed(42)
+  num_slots = default_num_slots
+  if len(sys.argv) > 2:
+    num_slots = int(sys.argv[2])
+
+  if len(sys.argv) > 1:
+    trace = read_swf(sys.argv[1], num_slots)
+    print("Replaying", len(trace), "jobs from", sys.argv[1], "on", num_slots, "slots:")
+  else:
+    trace = make_synthetic_trace(num_slots)
+    print("Replaying", len(trace), "synthetic jobs on", num_slots, "slots:")
+
+  print("{:>10} {:>12} {:>16} {:>20} {:>16}".format(
+    "policy", "utilization", "mean wait", "wait of others", "scheduler time"))
+  for name, policy in queue_system.scheduling_policies.items():
+    utilization, mean_wait, other_wait, scheduler_time = simulate(trace, num_slots, policy())
+    print("{:>10} {:>11.1f}% {:>14.0f} s {:>18.0f} s {:>14.2f} s".format(
+      name, 100 * utilization, mean_wait, other_wait, scheduler_time))
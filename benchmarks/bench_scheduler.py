@@ -0,0 +1,67 @@
+#!/usr/bin/python
+
+# Microbenchmark of the selection of the next job for execution.
+# Compares the linear scan over all queued jobs that was used before
+# with the priority index of the queue worker, for queue lengths from
+# 100 to 100k jobs.
+
+import datetime
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import queue_system
+
+queue_lengths = [100, 1000, 10000, 100000]
+priorities = [1, 2, 5, 10]
+
+def make_jobs(n):
+  now = datetime.datetime.now()
+  jobs = []
+  for i in range(n):
+    jdata = queue_system.job_data()
+    jdata.set_field(queue_system.job_data.ID, i)
+    jdata.set_field(queue_system.job_data.SUBMISSION_DATE,
+                    now - datetime.timedelta(seconds=n - i))
+    jdata.set_field(queue_system.job_data.PRIORITY, random.choice(priorities))
+    jobs.append(queue_system.job(jdata))
+  return jobs
+
+def linear_scan(jobs):
+  return jobs.index(max(jobs, key = lambda j : j.get_effective_priority()))
+
+def time_per_call(func, repeat):
+  return min(timeit.repeat(func, number=1, repeat=repeat))
+
+if __name__ == '__main__':
+  random.seed(42)
+  print("{:>8} {:>14} {:>14} {:>14} {:>14}".format(
+    "jobs", "scan next", "index next", "scan cancel", "index cancel"))
+
+  for n in queue_lengths:
+    jobs = make_jobs(n)
+    index = queue_system.job_priority_index()
+    for j in jobs:
+      index.push(j)
+
+    scan_next = time_per_call(lambda : linear_scan(jobs), 5)
+    index_next = time_per_call(lambda : index.peek(), 100)
+
+    # Cancel a job from the middle of the queue and put it back
+    victim = jobs[n // 2]
+    def scan_cancel():
+      jobs.insert(jobs.index(victim), jobs.pop(jobs.index(victim)))
+    def index_cancel():
+      index.remove(victim)
+      index.push(victim)
+    scan_cancel_time = time_per_call(scan_cancel, 5)
+    index_cancel_time = time_per_call(index_cancel, 100)
+
+    assert linear_scan(jobs) == jobs.index(index.peek())
+
+    print("{:>8} {:>12.2f}us {:>12.2f}us {:>12.2f}us {:>12.2f}us".format(
+      n, scan_next * 1e6, index_next * 1e6,
+      scan_cancel_time * 1e6, index_cancel_time * 1e6))
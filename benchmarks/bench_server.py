@@ -0,0 +1,72 @@
+#!/usr/bin/python
+
+# Load test of the queue server: Measures the number of URI queries per
+# second that the server answers with 1, 16 and 128 concurrent clients.
+# Every client runs in its own process and sends its requests over one
+# persistent connection.
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import queue_system
+from uri import *
+
+client_counts = [1, 16, 128]
+duration = 3.0
+query = "qsystem://queues/default/num_enqueued_jobs"
+
+def run_client(address, start_time, end_time, result_queue):
+  client = queue_system.queue_client(address)
+  # Connect before the measurement starts
+  client.uri_query(query)
+
+  while time.time() < start_time:
+    time.sleep(0.001)
+
+  num_requests = 0
+  while time.time() < end_time:
+    response = client.uri_query(query)
+    if response[0][0] != True:
+      raise RuntimeError(response[0][1])
+    num_requests += 1
+
+  client.close()
+  result_queue.put(num_requests)
+
+def start_server(address):
+  temp_dir = tempfile.mkdtemp()
+  worker = queue_system.queue_worker(os.path.join(temp_dir, "queue.log"))
+  uri_root = uri_directory({"queues": uri_directory({"default": worker})})
+  server = queue_system.queue_server({"default": worker}, queue_system.default_max_queue_length,
+                                     uri_root, address=address)
+  threading.Thread(target=server.listen, daemon=True).start()
+
+if __name__ == '__main__':
+  address = os.path.join(tempfile.mkdtemp(), "queue_system_socket")
+  # The server logs every request to stdout
+  real_stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+  start_server(address)
+
+  real_stdout.write("{:>8} {:>14}\n".format("clients", "requests/s"))
+  for num_clients in client_counts:
+    start_time = time.time() + 1.0 + 0.01 * num_clients
+    end_time = start_time + duration
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=run_client,
+                                       args=(address, start_time, end_time, results))
+               for i in range(num_clients)]
+    for c in clients:
+      c.start()
+
+    total_requests = sum(results.get() for c in clients)
+    for c in clients:
+      c.join()
+
+    real_stdout.write("{:>8} {:>14.0f}\n".format(num_clients, total_requests / duration))
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+# Submission throughput of the queue server: Submits N jobs one by one
+# with a new connection per job (as a separate qsubmit.py call per job
+# would), one by one over a persistent connection, and with enqueue_jobs()
+# in batches. The queue does not execute the jobs.
+
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import journal
+import queue_system
+from uri import *
+
+num_jobs = 5000
+batch_size = 500
+
+def start_server(address, journal_directory):
+  temp_dir = tempfile.mkdtemp()
+  jobs_journal = None
+  if journal_directory != None:
+    jobs_journal = journal.job_journal(journal_directory, "default")
+  worker = queue_system.queue_worker(os.path.join(temp_dir, "queue.log"), journal=jobs_journal)
+  uri_root = uri_directory({"queues": uri_directory({"default": worker})})
+  server = queue_system.queue_server({"default": worker}, 10 * num_jobs, uri_root,
+                                     max_submission_rate=1e9, submission_burst=1e9,
+                                     address=address)
+  threading.Thread(target=server.listen, daemon=True).start()
+
+def make_jobs(env):
+  jobs = []
+  for i in range(num_jobs):
+    jdata = queue_system.job_data()
+    jdata.set_field(queue_system.job_data.CMD, ["true", str(i)])
+    jdata.set_field(queue_system.job_data.DIR, "/tmp")
+    jdata.set_field(queue_system.job_data.ENV, env)
+    jobs.append(jdata)
+  return jobs
+
+def submit_with_new_connections(address, jobs):
+  for jdata in jobs:
+    with queue_system.queue_client(address) as client:
+      response = client.enqueue_job(jdata)
+      if response[0][0] != True:
+        raise RuntimeError(response[0][1])
+
+def submit_single(address, jobs):
+  with queue_system.queue_client(address) as client:
+    for jdata in jobs:
+      response = client.enqueue_job(jdata)
+      if response[0][0] != True:
+        raise RuntimeError(response[0][1])
+
+def submit_batches(address, jobs):
+  with queue_system.queue_client(address) as client:
+    for i in range(0, len(jobs), batch_size):
+      response = client.enqueue_jobs(jobs[i:i + batch_size])
+      if response[0][0] != True:
+        raise RuntimeError(response[0][1])
+      for result in response[1]:
+        if result[0] != True:
+          raise RuntimeError(result[1])
+
+if __name__ == '__main__':
+  # The server logs every request to stdout
+  real_stdout = sys.stdout
+  sys.stdout = open(os.devnull, "w")
+
+  env = dict(os.environ)
+  jobs = make_jobs(env)
+  real_stdout.write("Submission of {} jobs:\n".format(num_jobs))
+  for use_journal in [False, True]:
+    for name, submit in [("single, new connection per job", submit_with_new_connections),
+                         ("single, persistent connection", submit_single),
+                         ("enqueue_jobs, batches of " + str(batch_size), submit_batches)]:
+      address = os.path.join(tempfile.mkdtemp(), "queue_system_socket")
+      start_server(address, tempfile.mkdtemp() if use_journal else None)
+
+      start = time.perf_counter()
+      submit(address, jobs)
+      elapsed = time.perf_counter() - start
+      label = name + (", journal" if use_journal else "")
+      real_stdout.write("  {:<48} {:>8.0f} jobs/s\n".format(label, num_jobs / elapsed))
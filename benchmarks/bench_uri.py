@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+# Benchmark of URI resolution with and without the cache of resolved
+# URIs in uri_accessor. A monitoring client is simulated that polls the
+# same set of job attribute URIs over and over.
+
+import datetime
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import queue_system
+from uri import *
+
+num_jobs = 1000
+num_polled_uris = 300
+attributes = [queue_system.job_data.NAME,
+              queue_system.job_data.RUNNING,
+              queue_system.job_data.PRIORITY]
+num_rounds = 20
+
+def make_uri_root():
+  worker = queue_system.queue_worker(os.path.join(tempfile.mkdtemp(), "queue.log"))
+  for i in range(num_jobs):
+    worker.new_job(queue_system.job_data())
+  return uri_directory({"queues": uri_directory({"default": worker})})
+
+def poll(uri_root, uris):
+  permissions = uri_permissions.CLIENT
+  for uri in uris:
+    uri_accessor(uri, uri_root, permissions).read(permissions)
+
+if __name__ == '__main__':
+  uri_root = make_uri_root()
+  uris = ["qsystem://queues/default/jobs/by-id/" + str(i) + "/" + attributes[i % len(attributes)]
+          for i in range(num_polled_uris)]
+
+  capacity = uri_accessor.cache_capacity
+  uri_accessor.cache_capacity = 0
+  uncached = min(timeit.repeat(lambda : poll(uri_root, uris), number=num_rounds, repeat=3))
+
+  uri_accessor.cache_capacity = capacity
+  poll(uri_root, uris)
+  cached = min(timeit.repeat(lambda : poll(uri_root, uris), number=num_rounds, repeat=3))
+
+  num_queries = num_rounds * len(uris)
+  print("{:>10} {:>14}".format("", "us/query"))
+  print("{:>10} {:>14.2f}".format("uncached", uncached / num_queries * 1e6))
+  print("{:>10} {:>14.2f}".format("cached", cached / num_queries * 1e6))
@@ -0,0 +1,249 @@
+# Control groups (cgroup v2) of jobs.
+#
+# If the cgroup v2 hierarchy is mounted and the cgroup of the queue server
+# is writable, e.g. because it has been delegated to the user running the
+# server, each job runs in a cgroup of its own below the cgroup of the
+# server:
+#   <cgroup of the server>/qsystem/<queue>/job-<job id>
+# The cgroup contains the whole process tree of the job, including
+# processes that daemonize, so that its resource usage can be read from
+# the cgroup when the job has finished, the limits of the job apply to all
+# of its processes and the job can be killed as a whole.
+#
+# Limits can only be set if the cpu, memory and pids controllers are
+# available in the cgroup of the server. Since cgroups with processes can't
+# pass controllers on to their children, the server moves itself to a leaf
+# cgroup of its own if necessary:
+#   <cgroup of the server>/server
+
+import errno
+import os
+import os.path
+import signal
+import time
+
+# Name of the cgroup below the cgroup of the server that holds the cgroups
+# of all jobs
+default_cgroup_name = "qsystem"
+# Name of the cgroup the server moves itself to
+default_server_cgroup_name = "server"
+# Controllers that are needed for the limits of jobs
+limit_controllers = ["cpu", "memory", "pids"]
+# Period for the CPU bandwidth limit in microseconds
+default_cpu_period = 100000
+# Max. time in seconds to wait for the processes of a job to exit after
+# they have been killed
+default_kill_timeout = 5
+
+# Returns the mount point of the cgroup v2 hierarchy, or None
+def find_cgroup_mount():
+  try:
+    with open("/proc/self/mountinfo", "r") as f:
+      for line in f:
+        fields = line.split()
+        # The optional fields end with a "-", followed by the file system type
+        separator = fields.index("-")
+        if fields[separator + 1] == "cgroup2":
+          return fields[4]
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
+
+# Returns the directory of the cgroup v2 of the calling process, or None
+def find_own_cgroup():
+  mount = find_cgroup_mount()
+  if mount == None:
+    return None
+  try:
+    with open("/proc/self/cgroup", "r") as f:
+      for line in f:
+        hierarchy, controllers, path = line.rstrip("\n").split(":", 2)
+        if hierarchy == "0":
+          return os.path.join(mount, path.lstrip("/"))
+  except (OSError, ValueError):
+    pass
+  return None
+
+# Makes the limit controllers that are available in a cgroup available in
+# its children
+def _enable_controllers(directory):
+  with open(os.path.join(directory, "cgroup.controllers"), "r") as f:
+    available = f.read().split()
+  controllers = [c for c in limit_controllers if c in available]
+  if len(controllers) > 0:
+    with open(os.path.join(directory, "cgroup.subtree_control"), "w") as f:
+      f.write(" ".join("+" + c for c in controllers))
+
+# Creates the cgroup that holds the cgroups of all jobs and returns it, or
+# returns None if cgroups can't be used. Called once by the server before
+# it creates the cgroups of its queues.
+def setup_job_cgroups():
+  own_cgroup = find_own_cgroup()
+  if own_cgroup == None:
+    return None
+  directory = os.path.join(own_cgroup, default_cgroup_name)
+  try:
+    os.makedirs(directory, exist_ok=True)
+  except OSError as e:
+    print("Warning: Cannot create cgroups for jobs, running jobs without cgroups:", e)
+    return None
+
+  try:
+    try:
+      _enable_controllers(own_cgroup)
+    except OSError as e:
+      # The root cgroup is exempt from the rule that only cgroups without
+      # processes may enable controllers for their children
+      if e.errno != errno.EBUSY or os.path.samefile(own_cgroup, find_cgroup_mount()):
+        raise
+      server_cgroup = os.path.join(own_cgroup, default_server_cgroup_name)
+      os.makedirs(server_cgroup, exist_ok=True)
+      with open(os.path.join(server_cgroup, "cgroup.procs"), "w") as f:
+        f.write(str(os.getpid()))
+      _enable_controllers(own_cgroup)
+    _enable_controllers(directory)
+  except OSError as e:
+    print("Warning: Cannot enable cgroup controllers for jobs, limits of jobs are set with setrlimit():", e)
+  return directory
+
+# Creates the directory for the cgroups of the jobs of a queue below the
+# directory returned by setup_job_cgroups() and returns it, or returns None
+# if cgroups can't be used
+def create_queue_cgroup(job_cgroups, queue_name):
+  if job_cgroups == None:
+    return None
+  directory = os.path.join(job_cgroups, queue_name)
+  try:
+    os.makedirs(directory, exist_ok=True)
+  except OSError as e:
+    print("Warning: Cannot create cgroups for jobs, running jobs without cgroups:", e)
+    return None
+  try:
+    _enable_controllers(directory)
+  except OSError as e:
+    print("Warning: Cannot enable cgroup controllers for jobs, limits of jobs are set with setrlimit():", e)
+  return directory
+
+# Moves the calling process into the cgroup with the given path
+def enter_cgroup(path):
+  with open(os.path.join(path, "cgroup.procs"), "w") as f:
+    f.write("0")
+
+# Reads a file with lines "<key> <value>" into a dict
+def _read_flat_keyed(filename):
+  values = dict()
+  with open(filename, "r") as f:
+    for line in f:
+      key, value = line.split()
+      values[key] = int(value)
+  return values
+
+
+# The cgroup of one job
+class job_cgroup:
+  def __init__(self, directory, job_id):
+    self._path = os.path.join(directory, "job-" + str(job_id))
+    if os.path.exists(self._path):
+      # Left over from a queue server that has not exited cleanly
+      os.rmdir(self._path)
+    os.mkdir(self._path)
+
+  def get_path(self):
+    return self._path
+
+  # Moves the calling process into the cgroup. Used by the child process
+  # of the job before it executes the command.
+  def enter(self):
+    enter_cgroup(self._path)
+
+  # Limits the processes in the cgroup to the given number of CPUs (may be
+  # fractional), memory in MiB and number of processes, where 0 means no
+  # limit. Returns the set of controllers of limits that could not be set
+  # because the controller is not available.
+  def set_limits(self, cpus, memory, pids):
+    with open(os.path.join(self._path, "cgroup.controllers"), "r") as f:
+      available = f.read().split()
+    limits = [("cpu", "cpu.max", "{} {}".format(max(1000, int(cpus * default_cpu_period)),
+                                                 default_cpu_period), cpus),
+              ("memory", "memory.max", str(memory * 1024 * 1024), memory),
+              ("pids", "pids.max", str(pids), pids)]
+    unavailable = set()
+    for controller, filename, value, limit in limits:
+      if limit <= 0:
+        continue
+      if not controller in available:
+        unavailable.add(controller)
+        continue
+      with open(os.path.join(self._path, filename), "w") as f:
+        f.write(value)
+    return unavailable
+
+  # Returns True if processes in the cgroup have been killed because the
+  # cgroup exceeded its memory limit
+  def is_out_of_memory(self):
+    memory_events = os.path.join(self._path, "memory.events")
+    if not os.path.exists(memory_events):
+      return False
+    return _read_flat_keyed(memory_events).get("oom_kill", 0) > 0
+
+  def is_populated(self):
+    return _read_flat_keyed(os.path.join(self._path, "cgroup.events"))["populated"] != 0
+
+  # Sends SIGKILL to all processes in the cgroup
+  def kill(self):
+    try:
+      with open(os.path.join(self._path, "cgroup.kill"), "w") as f:
+        f.write("1")
+    except FileNotFoundError:
+      # cgroup.kill requires Linux 5.14. Processes that fork meanwhile
+      # escape, so repeat until the cgroup is empty.
+      with open(os.path.join(self._path, "cgroup.procs"), "r") as f:
+        for pid in f.read().split():
+          try:
+            os.kill(int(pid), signal.SIGKILL)
+          except ProcessLookupError:
+            pass
+
+  # Kills all processes that are left in the cgroup and waits until they
+  # have exited. Returns False if they have not exited within the timeout.
+  def kill_remaining(self, timeout=default_kill_timeout):
+    deadline = time.monotonic() + timeout
+    while self.is_populated():
+      if time.monotonic() > deadline:
+        return False
+      self.kill()
+      time.sleep(0.01)
+    return True
+
+  # Returns the resource usage of all processes that have been in the
+  # cgroup, as dict with the keys "user_time" and "system_time" (seconds)
+  # and, if the memory and io controllers are enabled, "peak_memory" (KiB),
+  # "read_bytes" and "write_bytes".
+  def read_usage(self):
+    usage = dict()
+    cpu_stat = _read_flat_keyed(os.path.join(self._path, "cpu.stat"))
+    usage["user_time"] = cpu_stat["user_usec"] / 1e6
+    usage["system_time"] = cpu_stat["system_usec"] / 1e6
+
+    memory_peak = os.path.join(self._path, "memory.peak")
+    if os.path.exists(memory_peak):
+      with open(memory_peak, "r") as f:
+        usage["peak_memory"] = int(f.read()) // 1024
+
+    io_stat = os.path.join(self._path, "io.stat")
+    if os.path.exists(io_stat):
+      # One line per device that has been used:
+      # <major>:<minor> rbytes=... wbytes=... ...
+      with open(io_stat, "r") as f:
+        for line in f:
+          for entry in line.split()[1:]:
+            key, value = entry.split("=")
+            if key == "rbytes":
+              usage["read_bytes"] = usage.get("read_bytes", 0) + int(value)
+            elif key == "wbytes":
+              usage["write_bytes"] = usage.get("write_bytes", 0) + int(value)
+    return usage
+
+  # Removes the cgroup. Fails if processes are still running in it.
+  def remove(self):
+    os.rmdir(self._path)
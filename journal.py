@@ -0,0 +1,249 @@
+# Write-ahead journal of a queue, which allows the queue to survive
+# restarts of the queue server.
+#
+# The journal consists of numbered segment files <name>.journal.<n>, into
+# which the events of the queue (submission, start, end and cancellation of
+# jobs) are appended, and a snapshot file <name>.snapshot of the complete
+# state of the queue. Records are written by a separate thread, which
+# commits all records that have been appended in the meantime with a single
+# fsync (group commit). Whenever a certain number of records has been
+# written, the queue hands over a snapshot of its state. The snapshot is
+# written and all segments that it covers are deleted afterwards.
+# On startup, the state is restored by loading the snapshot and replaying
+# the remaining segments.
+
+import os
+import os.path
+import pickle
+import threading
+
+default_journal_directory = "/tmp/queue_system_journal"
+# Number of records after which a snapshot is taken
+default_snapshot_interval = 10000
+
+class job_journal:
+  # Record types. Each record is a tuple (type, job id, data)
+  SUBMIT = "submit"
+  START = "start"
+  FINISH = "finish"
+  CANCEL = "cancel"
+  # Shell environment of submitted jobs, with data (content hash, environment).
+  # Each environment is written once per segment, before the first
+  # submission that refers to it.
+  ENVIRONMENT = "environment"
+
+  def __init__(self, directory, name, snapshot_interval=default_snapshot_interval):
+    self._directory = directory
+    self._name = name
+    self._snapshot_interval = snapshot_interval
+
+    self._cond = threading.Condition()
+    # Records and snapshots that still have to be written,
+    # as tuples (write function, arguments)
+    self._pending = []
+    self._num_appended = 0
+    self._num_durable = 0
+    self._num_records_since_snapshot = 0
+    self._closed = False
+    self._error = None
+
+    self._segment = 0
+    self._file = None
+    self._writer_thread = None
+    # Content hashes of the environments written to the current segment
+    self._written_environments = set()
+
+    os.makedirs(directory, exist_ok=True)
+
+  def _snapshot_filename(self):
+    return os.path.join(self._directory, self._name + ".snapshot")
+
+  def _segment_filename(self, segment):
+    return os.path.join(self._directory, self._name + ".journal." + str(segment))
+
+  def _segments(self):
+    prefix = self._name + ".journal."
+    segments = []
+    for filename in os.listdir(self._directory):
+      if filename.startswith(prefix) and filename[len(prefix):].isdigit():
+        segments.append(int(filename[len(prefix):]))
+    return sorted(segments)
+
+  def _sync_directory(self):
+    fd = os.open(self._directory, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+
+  # Restores the state of the queue from the snapshot and the journal.
+  # Returns a tuple (number of received jobs, dict job id -> job data,
+  # set of ids of started jobs, dict content hash -> environment) of the
+  # jobs that had not finished. Environments of submissions from the
+  # journal are referenced by their content hash in the job data.
+  # Must be called before start().
+  def replay(self):
+    num_jobs = 0
+    jobs = dict()
+    started_jobs = set()
+    environments = dict()
+    covered_segment = -1
+
+    if os.path.exists(self._snapshot_filename()):
+      with open(self._snapshot_filename(), "rb") as f:
+        covered_segment, num_jobs, jobs, started_jobs, environments = pickle.load(f)
+
+    last_segment = covered_segment
+    for segment in self._segments():
+      last_segment = max(last_segment, segment)
+      if segment <= covered_segment:
+        continue
+
+      with open(self._segment_filename(segment), "rb") as f:
+        while True:
+          try:
+            record_type, job_id, data = pickle.load(f)
+          except EOFError:
+            break
+          except Exception:
+            # A torn write at the end of the last segment. Everything
+            # before it has been replayed, new records go to a new segment.
+            print("Warning: Journal segment", segment, "is truncated, ignoring its tail.")
+            break
+
+          if record_type == self.ENVIRONMENT:
+            environments[data[0]] = data[1]
+          elif record_type == self.SUBMIT:
+            jobs[job_id] = data
+            num_jobs = max(num_jobs, job_id + 1)
+          elif record_type == self.START:
+            if job_id in jobs:
+              started_jobs.add(job_id)
+          elif record_type == self.FINISH or record_type == self.CANCEL:
+            jobs.pop(job_id, None)
+            started_jobs.discard(job_id)
+
+    self._segment = last_segment + 1
+    return (num_jobs, jobs, started_jobs, environments)
+
+  # Starts writing records to the journal.
+  def start(self):
+    self._file = open(self._segment_filename(self._segment), "ab")
+    self._sync_directory()
+
+    self._writer_thread = threading.Thread(target=self._write_records, daemon=True)
+    self._writer_thread.start()
+
+  # Appends a record to the journal and returns its sequence number, which
+  # can be passed to wait_durable(). The record is written asynchronously.
+  # Records are written in the order in which they are appended.
+  # For submissions, environment is a tuple (content hash, environment) of
+  # the environment that the job data refers to by its content hash. The
+  # environment must provide materialize() and must not be modified.
+  def append(self, record_type, job_id, data=None, environment=None):
+    with self._cond:
+      self._pending.append((self._write_record, (record_type, job_id, data, environment)))
+      self._num_appended += 1
+      self._num_records_since_snapshot += 1
+      self._cond.notify_all()
+      return self._num_appended
+
+  # Returns whether the queue should hand over a snapshot of its state.
+  def needs_snapshot(self):
+    return self._num_records_since_snapshot >= self._snapshot_interval
+
+  # Hands over a snapshot of the queue state. The snapshot must reflect
+  # exactly the records that have been appended so far, i.e. appending and
+  # taking snapshots must be serialized by the caller.
+  # jobs must be a dict job id -> job data of all unfinished jobs and
+  # started_jobs the set of ids of the jobs among them that have been
+  # started. The job data refers to environments by their content hash,
+  # environments is a dict content hash -> environment. None of them may
+  # be modified afterwards.
+  def snapshot(self, num_jobs, jobs, started_jobs, environments):
+    with self._cond:
+      self._pending.append((self._write_snapshot, (num_jobs, jobs, started_jobs, environments)))
+      self._num_records_since_snapshot = 0
+      self._cond.notify_all()
+
+  # Blocks until the record with the given sequence number has been written
+  # to disk.
+  def wait_durable(self, sequence_number):
+    with self._cond:
+      while self._num_durable < sequence_number and self._error == None:
+        self._cond.wait()
+      if self._num_durable < sequence_number:
+        raise RuntimeError("Could not write to journal: " + str(self._error))
+
+  # Writes all records that have been appended so far and stops the journal.
+  def close(self):
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    if self._writer_thread != None:
+      self._writer_thread.join()
+
+  def _write_record(self, record_type, job_id, data, environment):
+    if environment != None and not environment[0] in self._written_environments:
+      env_hash, env = environment
+      pickle.dump((self.ENVIRONMENT, None, (env_hash, dict(env.materialize()))),
+                  self._file, pickle.HIGHEST_PROTOCOL)
+      self._written_environments.add(env_hash)
+
+    pickle.dump((record_type, job_id, data), self._file, pickle.HIGHEST_PROTOCOL)
+
+  def _write_snapshot(self, num_jobs, jobs, started_jobs, environments):
+    # Subsequent records go to a new segment, all previous
+    # segments are covered by the snapshot.
+    covered_segment = self._segment
+    self._file.flush()
+    os.fsync(self._file.fileno())
+    self._file.close()
+
+    self._segment += 1
+    self._file = open(self._segment_filename(self._segment), "ab")
+    self._written_environments = set()
+
+    temp_filename = self._snapshot_filename() + ".tmp"
+    with open(temp_filename, "wb") as f:
+      environments = {env_hash : env.materialize() for env_hash, env in environments.items()}
+      pickle.dump((covered_segment, num_jobs, jobs, started_jobs, environments),
+                  f, pickle.HIGHEST_PROTOCOL)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(temp_filename, self._snapshot_filename())
+    self._sync_directory()
+
+    for segment in self._segments():
+      if segment <= covered_segment:
+        os.remove(self._segment_filename(segment))
+
+  def _write_records(self):
+    while True:
+      with self._cond:
+        while len(self._pending) == 0 and not self._closed:
+          self._cond.wait()
+        if len(self._pending) == 0:
+          self._file.close()
+          return
+
+        batch = self._pending
+        self._pending = []
+        num_written = self._num_appended
+
+      try:
+        for write, args in batch:
+          write(*args)
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+      except Exception as e:
+        print("Error: Could not write to journal:", e)
+        with self._cond:
+          self._error = e
+          self._cond.notify_all()
+        return
+
+      with self._cond:
+        self._num_durable = num_written
+        self._cond.notify_all()
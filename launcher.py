@@ -0,0 +1,272 @@
+# Launching of job processes.
+#
+# Forking the queue server itself to start a job gets slower the larger the
+# server gets, since fork() has to copy its page tables, and it is not safe
+# to run Python code between fork() and exec() in the child of a process
+# with threads, which subprocess.Popen() does with preexec_fn. Jobs are
+# therefore started by a launcher process, a separate interpreter that
+# stays small and has no other threads. The launcher starts the job
+# processes in a new session, in the cgroup of the job and with its
+# resource limits, and reports their exit status and resource usage back
+# to the server.
+
+import concurrent.futures
+import os
+import pickle
+import resource
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+
+from cgroup import enter_cgroup
+
+# Max. number of file descriptors that are passed with a launch request
+max_passed_fds = 2
+
+# Returns the storage I/O of a process and of the children that it has
+# waited for as dict with the keys "read_bytes" and "write_bytes", or an
+# empty dict if it is not available. Also works for zombie processes.
+def read_process_io(pid):
+  usage = dict()
+  try:
+    with open("/proc/" + str(pid) + "/io", "r") as f:
+      for line in f:
+        key, value = line.split(":")
+        if key in ["read_bytes", "write_bytes"]:
+          usage[key] = int(value)
+  except (OSError, ValueError):
+    pass
+  return usage
+
+# Waits for a child process to exit and returns (wait status, rusage, I/O
+# as returned by read_process_io())
+def wait_for_process(pid):
+  # Leave the process as zombie until its I/O statistics have been read.
+  # Unlike waitpid(), wait4() also reports the resource usage.
+  os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT)
+  process_io = read_process_io(pid)
+  pid, status, resource_usage = os.wait4(pid, 0)
+  return (status, resource_usage, process_io)
+
+# Sets the given resource limits, as list of (resource, limit), of the
+# calling process
+def set_rlimits(rlimits):
+  for limit, value in rlimits:
+    resource.setrlimit(limit, (value, value))
+
+# Prepares the calling process for executing a job: Starts a new session,
+# moves it to the cgroup with the given path (or None) and sets the given
+# resource limits
+def prepare_job_process(cgroup_path, rlimits):
+  os.setsid()
+  if cgroup_path != None:
+    enter_cgroup(cgroup_path)
+  set_rlimits(rlimits)
+
+def _send_message(sock, msg, fds=[]):
+  data = pickle.dumps(msg)
+  data = struct.pack("!I", len(data)) + data
+  # The file descriptors arrive together with the first byte
+  sent = socket.send_fds(sock, [data], fds)
+  sock.sendall(data[sent:])
+
+def _recv_exactly(sock, size):
+  data = b""
+  while len(data) < size:
+    chunk = sock.recv(size - len(data))
+    if len(chunk) == 0:
+      raise EOFError()
+    data += chunk
+  return data
+
+# Returns (message, list of file descriptors)
+def _recv_message(sock):
+  header, fds, flags, address = socket.recv_fds(sock, 4, max_passed_fds)
+  if len(header) == 0:
+    raise EOFError()
+  header += _recv_exactly(sock, 4 - len(header))
+  size, = struct.unpack("!I", header)
+  return (pickle.loads(_recv_exactly(sock, size)), fds)
+
+
+# Starts processes on behalf of the queue server. The launcher process is
+# started as a new interpreter, so that it is small and has no threads
+# regardless of the state of the server, and is restarted if it exits.
+class process_launcher:
+  def __init__(self):
+    self._send_lock = threading.Lock()
+    self._lock = threading.Lock()
+    self._next_request_id = 0
+    # request id -> future of the pid of a process that is being started
+    self._pending_launches = dict()
+    # pid -> future of the result of wait_for_process()
+    self._exits = dict()
+    # Socket connected to the launcher process, None if it has exited
+    self._socket = None
+    self._reader_thread = None
+    self._closed = False
+    with self._lock:
+      self._start()
+
+  # Starts the launcher process. Must be called with the lock held.
+  def _start(self):
+    server_socket, launcher_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    with launcher_socket:
+      # In a session of its own, so that Ctrl+C in the terminal of the
+      # server does not stop it. It exits when the server closes its socket.
+      process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  str(launcher_socket.fileno())],
+                                 pass_fds=[launcher_socket.fileno()], start_new_session=True)
+    self._socket = server_socket
+    self._reader_thread = threading.Thread(target=self._read_responses,
+                                           args=(server_socket, process), daemon=True)
+    self._reader_thread.start()
+
+  # Starts a process that runs command (a list of arguments) in working_dir
+  # with the environment env, writing its output to the open files stdout
+  # and stderr. The process is prepared like by prepare_job_process().
+  # Returns the pid, or raises OSError if the command can't be executed.
+  def launch(self, command, working_dir, env, stdout, stderr, cgroup_path=None, rlimits=[]):
+    future = concurrent.futures.Future()
+    with self._lock:
+      if self._closed:
+        raise OSError("The process launcher has been closed.")
+      if self._socket == None:
+        print("Warning: The process launcher has exited, restarting it")
+        self._start()
+      sock = self._socket
+      request_id = self._next_request_id
+      self._next_request_id += 1
+      self._pending_launches[request_id] = future
+    msg = ("launch", request_id, command, working_dir, env, cgroup_path, rlimits)
+    try:
+      with self._send_lock:
+        _send_message(sock, msg, [stdout.fileno(), stderr.fileno()])
+    except OSError:
+      with self._lock:
+        self._pending_launches.pop(request_id, None)
+      raise
+    return future.result()
+
+  # Waits for a process that has been started with launch() to exit.
+  # Returns the same as wait_for_process(). Raises OSError if the launcher
+  # has exited before the process.
+  def wait(self, pid):
+    with self._lock:
+      future = self._exits[pid]
+    try:
+      return future.result()
+    finally:
+      with self._lock:
+        del self._exits[pid]
+
+  def _read_responses(self, sock, process):
+    try:
+      while True:
+        msg, fds = _recv_message(sock)
+        with self._lock:
+          if msg[0] == "started":
+            request_id, pid = msg[1:]
+            self._exits[pid] = concurrent.futures.Future()
+            self._pending_launches.pop(request_id).set_result(pid)
+          elif msg[0] == "error":
+            request_id, error = msg[1:]
+            self._pending_launches.pop(request_id).set_exception(OSError(*error))
+          elif msg[0] == "exited":
+            pid, status, resource_usage, process_io = msg[1:]
+            self._exits[pid].set_result((status, resource_usage, process_io))
+    except (EOFError, OSError):
+      pass
+
+    # The next launch starts a new launcher. The processes that this one
+    # has started can't be waited for anymore.
+    with self._lock:
+      self._socket = None
+      error = OSError("The process launcher has exited.")
+      for future in self._pending_launches.values():
+        future.set_exception(error)
+      self._pending_launches.clear()
+      for future in self._exits.values():
+        if not future.done():
+          future.set_exception(error)
+    sock.close()
+    if process.poll() == None:
+      process.kill()
+    process.wait()
+
+  # Stops the launcher process. Processes that are still running are not
+  # affected, but can't be waited for anymore.
+  def close(self):
+    with self._lock:
+      self._closed = True
+      sock = self._socket
+      reader_thread = self._reader_thread
+    if sock != None:
+      sock.shutdown(socket.SHUT_RDWR)
+    reader_thread.join()
+
+
+# Main loop of the launcher process
+def _launcher_main(sock):
+  # pid -> subprocess.Popen of the running processes
+  processes = dict()
+  selector = selectors.DefaultSelector()
+  selector.register(sock, selectors.EVENT_READ)
+  while True:
+    for key, events in selector.select():
+      if key.fileobj is sock:
+        try:
+          msg, fds = _recv_message(sock)
+        except EOFError:
+          return
+        request_id = msg[1]
+        try:
+          process = _launch_process(msg, fds)
+        except Exception as e:
+          if not isinstance(e, OSError):
+            e = OSError(None, str(e))
+          _send_message(sock, ("error", request_id, (e.errno, e.strerror, e.filename)))
+          continue
+        processes[process.pid] = process
+        selector.register(os.pidfd_open(process.pid), selectors.EVENT_READ, process.pid)
+        _send_message(sock, ("started", request_id, process.pid))
+      else:
+        # The pidfd of a process becomes readable when it exits
+        pid = key.data
+        selector.unregister(key.fileobj)
+        os.close(key.fileobj)
+        status, resource_usage, process_io = wait_for_process(pid)
+        # Otherwise, subprocess considers the process as still running
+        processes.pop(pid).returncode = os.waitstatus_to_exitcode(status)
+        _send_message(sock, ("exited", pid, status, resource_usage, process_io))
+
+# Starts the process of a launch request and returns its subprocess.Popen
+def _launch_process(msg, fds):
+  request_id, command, working_dir, env, cgroup_path, rlimits = msg[1:]
+  stdout, stderr = fds
+  try:
+    if cgroup_path == None and len(rlimits) == 0:
+      # Without preexec_fn, the process is started with vfork()
+      return subprocess.Popen(command, cwd=working_dir, shell=False, env=env,
+                              stdout=stdout, stderr=stderr, start_new_session=True)
+    # Only the process itself may enter the cgroup of the job, whose limits
+    # must not apply to the launcher. preexec_fn is safe in the launcher,
+    # which has no other threads.
+    return subprocess.Popen(command, cwd=working_dir, shell=False, env=env,
+                            stdout=stdout, stderr=stderr,
+                            preexec_fn=lambda: prepare_job_process(cgroup_path, rlimits))
+  finally:
+    os.close(stdout)
+    os.close(stderr)
+
+if __name__ == '__main__':
+  # Started by process_launcher with the file descriptor of its socket
+  try:
+    _launcher_main(socket.socket(fileno=int(sys.argv[1])))
+  except (BrokenPipeError, ConnectionResetError):
+    # The server has exited
+    pass
@@ -5,22 +5,28 @@ import os
 import sys
 
 def usage():
-  print("Usage: qcancel.py <Job ID>")
+  print("Usage: qcancel.py [-q <queue>] <Job ID>")
 
 if __name__ == '__main__':
   client = queue_system.queue_client()
+
+  args = sys.argv[1:]
+  queue_name = queue_system.default_queue_name
+  if len(args) >= 2 and (args[0] == "-q" or args[0] == "--queue"):
+    queue_name = args[1]
+    args = args[2:]
   
-  if len(sys.argv) != 2:
+  if len(args) != 1:
     usage()
     sys.exit(-1)
     
-  if sys.argv[1] == "--help":
+  if args[0] == "--help":
     usage()
     sys.exit(0)
   
-  job_id = int(sys.argv[1])
+  job_id = int(args[0])
   
-  response = client.cancel_job(job_id)
+  response = client.cancel_job(job_id, queue_name)
   if(response[0][0] != True):
     print("Could not cancel job:",response[0][1])
   else:
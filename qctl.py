@@ -5,7 +5,7 @@ import os
 import sys
 
 def usage():
-  print("Usage: qctl.py shutdown  -  shutdown the queue system after the currently running job is finished")
+  print("Usage: qctl.py shutdown  -  shutdown the queue system after the currently running jobs are finished")
   #print("        pause     -  do not automatically proceed to the next job in the queue")
   #print("        resume    -  resume processing the jobs in the queue")
 
@@ -9,19 +9,31 @@ from uri import *
 max_col_chars = 70
 max_full_status_col_chars=25
 
+def format_row(line, col_width):
+  return "| " + " | ".join("{:{}}".format(str(x), col_width[i])
+                           for i, x in enumerate(line)) + " |"
+
 def format_table(table):
   col_width = [max(len(str(x)) for x in col) for col in zip(*table)]
   result = ""
   for line in table:
-    result += "| " + " | ".join("{:{}}".format(str(x), col_width[i])
-                                for i, x in enumerate(line)) + " |"
+    result += format_row(line, col_width)
     result += "\n"
   return result
 
 def usage():
-  print("Usage: qstatus.py          - print status of all jobs")
-  print("   or: qstatus.py <job id> - print detailed status of one job")
-  print("   or: qstatus.py <URI>    - query the queue system with URIs")
+  print("Usage: qstatus.py [-q <queue>] [<options>]  - print status of all jobs")
+  print("   or: qstatus.py [-q <queue>] <job id>     - print detailed status of one job")
+  print("   or: qstatus.py <URI>                     - query the queue system with URIs")
+  print("Options:")
+  print("  -r, --running           only show running jobs")
+  print("  -w, --waiting           only show waiting jobs")
+  print("  -n, --name <pattern>    only show jobs whose name matches the pattern, e.g. 'sim-*'")
+  print("  -d, --dir <prefix>      only show jobs whose working directory starts with the prefix")
+  print("  -s, --sort <key>        sort by " + ", ".join(queue_system.list_sort_keys) +
+        " (default: priority), '-<key>' reverses the order")
+  print("  -l, --limit <n>         show at most n jobs per queue")
+  print("  -o, --offset <n>        skip the first n jobs of each queue")
   
     
 def uri_query(client, uri):
@@ -38,9 +50,8 @@ def uri_query(client, uri):
     else:
       print(response)
 
-def detailed_job_query(client, job_id):
-  # TODO Look in all queues
-  query_uri = "qsystem://queues/default/jobs/by-id/" + str(job_id)
+def detailed_job_query(client, job_id, queue_name=queue_system.default_queue_name):
+  query_uri = "qsystem://queues/" + queue_name + "/jobs/by-id/" + str(job_id)
   print("Querying",query_uri,"...")
   result = query.retrieve_all_subattributes(client, query_uri)
 
@@ -49,48 +60,61 @@ def detailed_job_query(client, job_id):
     table.append([field, str(result[field])[:max_col_chars]])
   print(format_table(table))
 
-def priority_sort_order(job_data):
-  if job_data["running"] == True:
-    return float("inf")
-  return job_data["effective_priority"]
-
 def get_displayed_field_name(f):
   if f == "running":
     return "R?"
+  if f == "queue":
+    return "queue"
   return queue_system.job_data.displayed_names[f] 
   
-def full_status_report(client):
-  # TODO Look in all queues
-  query_uri = "qsystem://queues/default/jobs/by-id"
+# Shows a job array as a single row, which summarizes its elements. The
+# elements themselves are not listed.
+def summarize_job(j):
+  if "num_pending_elements" in j:
+    j["running"] = (str(j["num_running_elements"]) + " running, " +
+                    str(j["num_pending_elements"]) + " waiting")
+  if j.get("unresolved_dependencies", "") != "":
+    j["running"] = j["unresolved_dependencies"]
+  return j
+
+# Prints the jobs of the given queues, or of all queues, as they are
+# received from the server. The columns have a fixed width, so that
+# rows can be printed before all jobs have been received.
+def full_status_report(client, queue_names=None, filters=dict(), sort="priority",
+                       limit=None, offset=0):
+  if queue_names == None:
+    queue_names = query.retrieve_all_subnodes(client, "qsystem://queues")
   queried_fields=[queue_system.job_data.ID,
                   queue_system.job_data.NAME,
                   queue_system.job_data.RUNNING,
                   queue_system.job_data.START_DATE,
                   queue_system.job_data.DIR]
-
-  jobs = query.retrieve_all_subnodes(client, query_uri)
-  
-
-  if len(jobs) == 0:
+  displayed_fields = ["queue"] + queried_fields
+
+  header = [get_displayed_field_name(f) for f in displayed_fields]
+  col_width = [max(len(name), max_full_status_col_chars) for name in header]
+  col_width[0] = max(len(header[0]), max(len(q) for q in queue_names))
+  col_width[1] = max(len(header[1]), 8)
+
+  filters = dict(filters)
+  filters["array_elements"] = False
+  num_jobs = 0
+  for queue_name in queue_names:
+    for j in client.list_jobs(queue_name, filters, sort, limit, offset,
+                              queried_fields + ["num_pending_elements",
+                                                "num_running_elements",
+                                                "unresolved_dependencies"]):
+      if num_jobs == 0:
+        print(format_row(header, col_width))
+      num_jobs += 1
+
+      j = summarize_job(j)
+      j["queue"] = queue_name
+      print(format_row([str(j[f])[:col_width[i]] for i, f in enumerate(displayed_fields)],
+                       col_width))
+
+  if num_jobs == 0:
     print("No jobs in queue")
-  else:
-    job_status = []
-    for j in jobs:
-      jdata = query.retrieve_all_subattributes(client, query_uri + "/" + j)
-      job_status.append(jdata)
-    
-    job_status = sorted(job_status, key = lambda j : -priority_sort_order(j))
-
-    header = [get_displayed_field_name(f) for f in queried_fields]
-
-    table = [header]
-
-    for j in job_status:
-      row = []
-      for f in queried_fields:
-        row.append(str(j[f])[:max_full_status_col_chars])
-      table.append(row)
-    print(format_table(table))
 
 def is_integer(s):
   try:
@@ -101,24 +125,64 @@ def is_integer(s):
 
 # *************************************************************************
 if __name__ == '__main__':
-  if len(sys.argv) > 2:
+  args = sys.argv[1:]
+  queue_name = queue_system.default_queue_name
+  queue_names = None
+  filters = dict()
+  sort = "priority"
+  limit = None
+  offset = 0
+  try:
+    while len(args) >= 1 and args[0].startswith("-") and args[0] != "--help":
+      if args[0] in ["-r", "--running"]:
+        filters["state"] = "running"
+        args = args[1:]
+        continue
+      if args[0] in ["-w", "--waiting"]:
+        filters["state"] = "waiting"
+        args = args[1:]
+        continue
+      if len(args) < 2:
+        break
+
+      if args[0] in ["-q", "--queue"]:
+        queue_name = args[1]
+        queue_names = [queue_name]
+      elif args[0] in ["-n", "--name"]:
+        filters["name"] = args[1]
+      elif args[0] in ["-d", "--dir"]:
+        filters["dir"] = args[1]
+      elif args[0] in ["-s", "--sort"]:
+        sort = args[1]
+      elif args[0] in ["-l", "--limit"]:
+        limit = int(args[1])
+      elif args[0] in ["-o", "--offset"]:
+        offset = int(args[1])
+      else:
+        break
+      args = args[2:]
+  except ValueError as e:
+    print("Error:", e)
+    sys.exit(-1)
+
+  if len(args) > 1 or (len(args) == 1 and args[0].startswith("-") and args[0] != "--help"):
     usage()
     sys.exit(-1)
 
   client = queue_system.queue_client()
 
   try:
-    if len(sys.argv) == 1:
-      full_status_report(client)
+    if len(args) == 0:
+      full_status_report(client, queue_names, filters, sort, limit, offset)
     else:
-      if sys.argv[1] == "--help":
+      if args[0] == "--help":
         usage()
         sys.exit(0)
-      elif is_integer(sys.argv[1]):
-        detailed_job_query(client, int(sys.argv[1]))
+      elif is_integer(args[0]):
+        detailed_job_query(client, int(args[0]), queue_name)
         sys.exit(0)
       else:
-        uri_query(client, sys.argv[1])
+        uri_query(client, args[0])
         sys.exit(0)
   except Exception as e:
     print("Error:",e)
\ No newline at end of file
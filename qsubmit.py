@@ -45,10 +45,78 @@ if __name__ == '__main__':
   
   command = sys.argv[1:]
   env = dict(os.environ)
+
+  queue_name = queue_system.default_queue_name
+  array_spec = None
+  dependencies = None
+  memory = None
+  walltime = None
+  cpu_limit = None
+  memory_limit = None
+  pids_limit = None
+  spool = False
+  while len(command) >= 1 and command[0] in ["-q", "--queue", "-a", "--array", "-d", "--dependencies",
+                                             "-m", "--memory", "-w", "--walltime", "-s", "--spool",
+                                             "-C", "--cpu-limit", "-M", "--memory-limit",
+                                             "-P", "--pids-limit"]:
+    if command[0] == "-s" or command[0] == "--spool":
+      spool = True
+      command = command[1:]
+      continue
+    if len(command) < 2:
+      break
+
+    if command[0] == "-q" or command[0] == "--queue":
+      queue_name = command[1]
+    elif command[0] == "-a" or command[0] == "--array":
+      array_spec = command[1]
+    elif command[0] == "-m" or command[0] == "--memory":
+      memory = command[1]
+    elif command[0] == "-w" or command[0] == "--walltime":
+      walltime = command[1]
+    elif command[0] == "-C" or command[0] == "--cpu-limit":
+      cpu_limit = command[1]
+    elif command[0] == "-M" or command[0] == "--memory-limit":
+      memory_limit = command[1]
+    elif command[0] == "-P" or command[0] == "--pids-limit":
+      pids_limit = command[1]
+    else:
+      dependencies = command[1]
+    command = command[2:]
   
   if len(command) == 0:
-    print("Usage: qsubmit.py <command>")
+    print("Usage: qsubmit.py [-q <queue>] [-a|--array <indices>] [-d|--dependencies <dependencies>]")
+    print("                  [-m|--memory <MiB>] [-w|--walltime <seconds>] [-s|--spool]")
+    print("                  [-C|--cpu-limit <CPUs>] [-M|--memory-limit <MiB>] [-P|--pids-limit <n>] <command>")
+    print("  Job arrays: <indices> is e.g. 0-9999, 1,3,5 or 0-100:10. In the command,")
+    print("  the job name and the output files, %a is replaced by the array index")
+    print("  and %A by the id of the array.")
+    print("  Dependencies: <dependencies> is e.g. afterok:12:13,afterany:14. The job")
+    print("  only runs after jobs 12 and 13 have succeeded and job 14 has finished.")
+    print("  Resources: The job is only started when the requested memory is free")
+    print("  in the queue, and is killed when it runs longer than its walltime.")
+    print("  The backfill scheduling policy uses the walltime to start jobs early.")
+    print("  Limits: The job may use at most the given number of CPUs (may be")
+    print("  fractional), memory and processes. They are enforced with cgroups if")
+    print("  the queue server can use them, otherwise partly with setrlimit().")
+    print("  Spooling: The output is written to a local spool directory of the queue")
+    print("  server while the job runs, and moved to the working directory afterwards.")
+    print("  It can be watched with qtail.py.")
     sys.exit(-1)
+
+  if dependencies != None:
+    try:
+      queue_system.parse_dependencies(dependencies)
+    except ValueError as e:
+      print(e)
+      sys.exit(-1)
+
+  if array_spec != None:
+    try:
+      queue_system.parse_array_spec(array_spec)
+    except ValueError as e:
+      print(e)
+      sys.exit(-1)
   
       
   jdata = queue_system.job_data()
@@ -60,10 +128,33 @@ if __name__ == '__main__':
   jdata.set_field(queue_system.job_data.CMD, command)
   jdata.set_field(queue_system.job_data.DIR, os.getcwd())
   jdata.set_field(queue_system.job_data.ENV, env)
+  if dependencies != None:
+    jdata.set_field(queue_system.job_data.DEPENDENCIES, dependencies)
+  if spool:
+    jdata.set_field(queue_system.job_data.SPOOL, True)
+  try:
+    if memory != None:
+      jdata.set_field(queue_system.job_data.MEMORY, int(memory))
+    if walltime != None:
+      jdata.set_field(queue_system.job_data.WALLTIME, int(walltime))
+    if cpu_limit != None:
+      jdata.set_field(queue_system.job_data.CPU_LIMIT, float(cpu_limit))
+    if memory_limit != None:
+      jdata.set_field(queue_system.job_data.MEMORY_LIMIT, int(memory_limit))
+    if pids_limit != None:
+      jdata.set_field(queue_system.job_data.PIDS_LIMIT, int(pids_limit))
+  except ValueError as e:
+    print(e)
+    sys.exit(-1)
 
-  response = client.enqueue_job(jdata)
+  if array_spec != None:
+    response = client.enqueue_array(jdata, array_spec, queue_name)
+  else:
+    response = client.enqueue_job(jdata, queue_name)
   if(response[0][0] != True):
     print("Could not enqueue job:",response[0][1])
+  elif array_spec != None:
+    print("Enqueued as job array "+str(response[1]))
   else:
     print("Enqueued as job "+str(response[1]))
       
@@ -0,0 +1,50 @@
+#!/usr/bin/python
+
+import queue_system
+import sys
+
+def usage():
+  print("Usage: qtail.py [-q <queue>] [-e|--stderr] [-f|--follow] [-c|--bytes <offset>] <job id>")
+  print("  Prints the output of a job, starting at the given byte offset. With -f,")
+  print("  the output of a running job is printed as it is written until the job")
+  print("  has finished. -e prints the output on stderr instead of stdout.")
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  queue_name = queue_system.default_queue_name
+  stream = "stdout"
+  follow = False
+  offset = 0
+  while len(args) >= 1 and args[0] in ["-q", "--queue", "-e", "--stderr",
+                                       "-f", "--follow", "-c", "--bytes"]:
+    if args[0] == "-e" or args[0] == "--stderr":
+      stream = "stderr"
+      args = args[1:]
+      continue
+    if args[0] == "-f" or args[0] == "--follow":
+      follow = True
+      args = args[1:]
+      continue
+    if len(args) < 2:
+      break
+
+    if args[0] == "-q" or args[0] == "--queue":
+      queue_name = args[1]
+    else:
+      offset = int(args[1])
+    args = args[2:]
+
+  if len(args) != 1 or args[0] == "--help":
+    usage()
+    sys.exit(0 if len(args) == 1 else -1)
+
+  client = queue_system.queue_client()
+  try:
+    for data in client.tail(int(args[0]), queue_name, stream, offset, follow):
+      sys.stdout.buffer.write(data)
+      sys.stdout.buffer.flush()
+  except RuntimeError as e:
+    print("Error:", e)
+    sys.exit(-1)
+  except KeyboardInterrupt:
+    pass
@@ -2,22 +2,17 @@ from uri import *
 
 
 def retrieve_all_subattributes(client, uri):
-  result = client.uri_query(uri)
+  return retrieve_subtree(client, uri)
+
+# Retrieves the attributes of the node at the URI and of its subnodes
+# down to the given depth in one request. Subnodes are returned as
+# entries "<name>/" in the resulting dict.
+def retrieve_subtree(client, uri, attributes=None, depth=0):
+  result = client.uri_query_tree(uri, attributes, depth)
 
-  query_result = dict()
   if result[0][0] != True:
     raise RuntimeError(result[0][1])
-  else:
-    listing = uri_accessor.node_content_lister.extract_listing(result[1])
-    for field in listing:
-      if not field.endswith("/"):
-        field_query = uri + "/" + field
-        field_query_result = client.uri_query(field_query)
-        
-        if field_query_result[0][0] != True:
-          raise RuntimeError("Error while accessing field "+str(field)+": "+str(field_query_result[0][1]))
-        query_result[field] =  field_query_result[1]
-    return query_result
+  return result[1]
 
 def retrieve_all_subnodes(client, uri):
   result = client.uri_query(uri)
@@ -30,4 +25,4 @@ def retrieve_all_subnodes(client, uri):
     for field in listing:
       if field.endswith("/"):
         subnodes.append(field.replace("/", ""))
-    return subnodes
\ No newline at end of file
+    return subnodes
@@ -1,29 +1,96 @@
 #!/usr/bin/python
 
 
+import collections
+import concurrent.futures
 import datetime
+import fnmatch
+import glob
+import hashlib
+import heapq
+import itertools
+import math
 import os
 import os.path
+import resource
+import socket
+import struct
 import time
 import threading
-import subprocess
+import shutil
 import signal
 import sys
+import weakref
+from multiprocessing import Pipe
 from multiprocessing.connection import Listener
 from multiprocessing.connection import Client
+from multiprocessing.connection import wait
 
 from uri import *
+from journal import *
+from cgroup import *
+from launcher import *
 
 
 socket_name = "/tmp/queue_system_socket"
 default_log_file = "/tmp/queue_system.log"
 queue_worker_log = "/tmp/queue.log"
+default_queue_name = "default"
 
 allow_cancel_running_jobs = True
 default_max_queue_length = 500
+# Max. number of elements of a job array. An array occupies only one
+# entry of the queue, no matter how many elements it has.
+default_max_array_size = 100000
+# Limits the rate of job submissions to prevent "submission-bomb" DoS
+# attacks, e.g. by recursive submission scripts. A burst of up to
+# default_submission_burst jobs is accepted at once, afterwards
+# the queue accepts at most default_max_submission_rate jobs per second.
+default_max_submission_rate = 100.0
+default_submission_burst = default_max_queue_length
+# Number of threads of the queue server that handle client requests
+default_num_server_threads = 8
+# Max. time in seconds a client may take to send a complete request or to
+# receive a response before its connection is dropped
+default_connection_io_timeout = 10.0
+# Connections without any requests for this many seconds are closed
+default_connection_idle_timeout = 600.0
+# Max. number of finished jobs that are kept in the history of each queue,
+# and the max. time for which they are kept
+default_history_length = 10000
+default_history_max_age = datetime.timedelta(days=7)
+# Memory in MiB that the jobs of a queue may request in total, if not
+# specified otherwise. None means the physical memory of the machine.
+default_queue_memory = None
+# Node-local directory into which the output of jobs that request spooling
+# is written while they run. Each queue uses a subdirectory of its own.
+default_spool_directory = "/tmp/queue_system_spool"
+# Max. number of bytes per message when output is streamed to a client, and
+# the interval in seconds in which followed output is checked for new data
+default_tail_chunk_size = 1024 * 1024
+default_tail_poll_interval = 0.2
+# Number of execution slots of a queue if not specified otherwise.
+# None means one slot per CPU.
+default_num_slots = None
+# Sort orders of job listings, see queue_worker.list_jobs(). Prefixed
+# with "-", the order is reversed.
+list_sort_keys = ["id", "priority", "name", "submission_date", "start_date"]
+# Number of jobs per message of a streamed job listing
+default_list_chunk_size = 200
+# Scheduling policy of a queue if not specified otherwise, see
+# scheduling_policies
+default_scheduling_policy = "priority"
+# Queues of the queue system, as queue name -> (number of execution slots,
+# scheduling policy). Each queue has its own dispatcher, e.g. short
+# interactive jobs are not stuck behind long batch jobs if they are
+# submitted to separate queues.
+default_queues = {
+  default_queue_name: (default_num_slots, default_scheduling_policy)
+}
 
 
 class job_data:
+  __slots__ = ("_data",)
 
   def format_command(command):
     result = ""
@@ -44,6 +111,27 @@ class job_data:
   STDOUT_FILE = "stdout_file"
   STDERR_FILE = "stderr_file"
   PRIORITY = "priority"
+  SLOTS = "slots"
+  ARRAY = "array"
+  ARRAY_ID = "array_id"
+  ARRAY_INDEX = "array_index"
+  EXIT_CODE = "exit_code"
+  END_DATE = "end_date"
+  PEAK_MEMORY = "peak_memory"
+  DEPENDENCIES = "dependencies"
+  MEMORY = "memory"
+  WALLTIME = "walltime"
+  USER = "uid"
+  SPOOL = "spool"
+  USER_TIME = "user_time"
+  SYSTEM_TIME = "system_time"
+  READ_BYTES = "read_bytes"
+  WRITE_BYTES = "write_bytes"
+  VOLUNTARY_SWITCHES = "voluntary_context_switches"
+  INVOLUNTARY_SWITCHES = "involuntary_context_switches"
+  CPU_LIMIT = "cpu_limit"
+  MEMORY_LIMIT = "memory_limit"
+  PIDS_LIMIT = "pids_limit"
 
   displayed_names = {
     ID: "job id",
@@ -57,7 +145,28 @@ class job_data:
     NAME: "job name",
     STDOUT_FILE: "stdout file",
     STDERR_FILE: "stderr file",
-    PRIORITY: "priority"
+    PRIORITY: "priority",
+    SLOTS: "execution slots",
+    ARRAY: "array indices",
+    ARRAY_ID: "array job id",
+    ARRAY_INDEX: "array index",
+    EXIT_CODE: "exit code",
+    END_DATE: "date of completion",
+    PEAK_MEMORY: "peak memory (KiB)",
+    DEPENDENCIES: "dependencies",
+    MEMORY: "requested memory (MiB)",
+    WALLTIME: "walltime (s)",
+    USER: "user id",
+    SPOOL: "spool output",
+    USER_TIME: "user CPU time (s)",
+    SYSTEM_TIME: "system CPU time (s)",
+    READ_BYTES: "bytes read from storage",
+    WRITE_BYTES: "bytes written to storage",
+    VOLUNTARY_SWITCHES: "voluntary context switches",
+    INVOLUNTARY_SWITCHES: "involuntary context switches",
+    CPU_LIMIT: "CPU limit (CPUs)",
+    MEMORY_LIMIT: "memory limit (MiB)",
+    PIDS_LIMIT: "process limit"
   }
 
 
@@ -77,7 +186,28 @@ class job_data:
     NAME: "<unnamed-%J>",
     STDOUT_FILE: "stdout_job.%J",
     STDERR_FILE: "stderr_job.%J",
-    PRIORITY: 1
+    PRIORITY: 1,
+    SLOTS: 1,
+    ARRAY: "",
+    ARRAY_ID: -1,
+    ARRAY_INDEX: -1,
+    EXIT_CODE: None,
+    END_DATE: None,
+    PEAK_MEMORY: None,
+    DEPENDENCIES: "",
+    MEMORY: 0,
+    WALLTIME: 0,
+    USER: -1,
+    SPOOL: False,
+    USER_TIME: None,
+    SYSTEM_TIME: None,
+    READ_BYTES: None,
+    WRITE_BYTES: None,
+    VOLUNTARY_SWITCHES: None,
+    INVOLUNTARY_SWITCHES: None,
+    CPU_LIMIT: 0.0,
+    MEMORY_LIMIT: 0,
+    PIDS_LIMIT: 0
   }
   
   # Fields that are allowed to be set by the client
@@ -89,7 +219,16 @@ class job_data:
     NAME,
     STDOUT_FILE,
     STDERR_FILE,
-    PRIORITY
+    PRIORITY,
+    SLOTS,
+    ARRAY,
+    DEPENDENCIES,
+    MEMORY,
+    WALLTIME,
+    SPOOL,
+    CPU_LIMIT,
+    MEMORY_LIMIT,
+    PIDS_LIMIT
   ])
 
   # Fields that are allowed to be changed by the client
@@ -171,11 +310,319 @@ class job_data:
   def get(self):
     return self._data
 
+  # Returns the names of all fields
+  def fields(self):
+    return self._data.keys()
+
+  def has_field(self, name):
+    return name in self._data
+
+
+# Compact representation of the data of a job, used by the queue server for
+# the jobs in its queues. It offers the same interface as job_data, but
+# stores the fields in slots instead of a per-instance dict.
+class job_record(job_data):
+  __slots__ = tuple(job_data.default_values.keys())
+
+  # Creates the record from job data or from a dict with all fields
+  def __init__(self, data):
+    if isinstance(data, job_data):
+      data = data.get()
+
+    for field in self.default_values:
+      if not field in data:
+        raise ValueError("Invalid job data: required field "+str(field)+" not found.")
+      setattr(self, field, data[field])
+
+  def get_displayed_field_value(self, field):
+    if field in job_data.displayed_format:
+      format_func = job_data.displayed_format[field]
+      return format_func(self.get_field(field))
+
+    return self.get_field(field)
+
+  def sanitize_new_submission(self):
+    for field in self.default_values:
+      if not field in self.submission_values:
+        setattr(self, field, self.default_values[field])
+      else:
+        allowed_dtype = type(self.default_values[field])
+        setattr(self, field, allowed_dtype(getattr(self, field)))
+
+  def set_field(self, name, value):
+    if not name in self.default_values:
+      raise ValueError("Invalid job property: "+name)
+    setattr(self, name, value)
+
+  def get_field(self, name):
+    if not name in self.default_values:
+      raise ValueError("Invalid job property: "+name)
+    return getattr(self, name)
+
+  # Returns the fields as dict. Note that, unlike job_data.get(), modifying
+  # the returned dict does not modify the record.
+  def get(self):
+    return {field : getattr(self, field) for field in self.default_values}
+
+  def fields(self):
+    return self.default_values.keys()
+
+  def has_field(self, name):
+    return name in self.default_values
+
+
+# Number of environments that the queue server keeps even if no job
+# references them anymore, so that clients can refer to them by their hash
+# in later submissions.
+default_num_cached_environments = 64
+
+# Returns the content hash that identifies an environment
+def environment_hash(env):
+  h = hashlib.sha256()
+  for key, value in sorted(env.items()):
+    h.update(str(key).encode("utf-8", "surrogateescape"))
+    h.update(b"\0")
+    h.update(str(value).encode("utf-8", "surrogateescape"))
+    h.update(b"\0")
+  return h.hexdigest()
+
+# Returns the difference between two environments as a tuple
+# (changed variables, names of removed variables)
+def environment_difference(base, env):
+  changed = dict()
+  for key, value in env.items():
+    if base.get(key) != value:
+      changed[key] = value
+  removed = [key for key in base if not key in env]
+  return (changed, removed)
+
+# Shell environment that is shared by all jobs with the same environment.
+# Must not be modified.
+class shared_environment(dict):
+  __slots__ = ("content_hash", "__weakref__")
+
+  # Returns the environment as plain dict
+  def materialize(self):
+    return dict(self)
+
+# Shell environment that is stored as difference to a base environment.
+# The full environment is only built when it is needed, i.e. when the
+# process of a job is spawned. Must not be modified.
+class environment_delta:
+  __slots__ = ("content_hash", "base", "changed", "removed", "__weakref__")
+
+  def __init__(self, base, changed, removed):
+    self.base = base
+    self.changed = changed
+    self.removed = removed
+
+  # Returns the environment as plain dict
+  def materialize(self):
+    env = dict(self.base)
+    for key in self.removed:
+      env.pop(key, None)
+    env.update(self.changed)
+    return env
+
+# Stores each distinct shell environment only once. Environments are
+# identified by a hash of their content, and all jobs with identical
+# environments reference the same shared_environment or environment_delta.
+# An environment is dropped from the pool once no job references it anymore
+# and it is not among the most recently used environments.
+class environment_pool:
+  def __init__(self, num_cached=default_num_cached_environments):
+    # content hash -> shared_environment or environment_delta
+    self._environments = weakref.WeakValueDictionary()
+    # content hash -> environment, most recently used last
+    self._recently_used = collections.OrderedDict()
+    self._num_cached = num_cached
+    self._lock = threading.Lock()
+
+  # Must be called with the lock held
+  def _use(self, env):
+    self._recently_used[env.content_hash] = env
+    self._recently_used.move_to_end(env.content_hash)
+    while len(self._recently_used) > self._num_cached:
+      self._recently_used.popitem(last=False)
+    return env
+
+  # Returns the environment with the given content hash, or None if it
+  # is not in the pool.
+  def lookup(self, env_hash):
+    with self._lock:
+      env = self._environments.get(env_hash)
+      if env != None:
+        self._use(env)
+      return env
+
+  # Returns the shared environment with the same content as env
+  def intern(self, env):
+    if isinstance(env, (shared_environment, environment_delta)):
+      return env
+
+    env_hash = environment_hash(env)
+    with self._lock:
+      shared_env = self._environments.get(env_hash)
+      if shared_env == None:
+        shared_env = shared_environment(env)
+        shared_env.content_hash = env_hash
+        self._environments[env_hash] = shared_env
+      return self._use(shared_env)
+
+  # Adds an environment that is given as difference to an environment in
+  # the pool. Returns the new environment, or None if the base environment
+  # is not in the pool.
+  def intern_delta(self, base_hash, changed, removed):
+    base = self.lookup(base_hash)
+    if base == None:
+      return None
+
+    # Don't build chains of deltas, always refer to a full environment
+    if isinstance(base, environment_delta):
+      env = base.materialize()
+      for key in removed:
+        env.pop(key, None)
+      env.update(changed)
+      changed, removed = environment_difference(base.base, env)
+      base = base.base
+    delta = environment_delta(base, dict(changed), list(removed))
+    env_hash = environment_hash(delta.materialize())
+    with self._lock:
+      env = self._environments.get(env_hash)
+      if env == None:
+        env = delta
+        env.content_hash = env_hash
+        self._environments[env_hash] = env
+      return self._use(env)
+
+  def __len__(self):
+    return len(self._environments)
+
+# The environments of all jobs of the queue server
+shared_environments = environment_pool()
+
+
+# Parses the indices of a job array, given as comma separated list of
+# indices "<i>" and ranges "<first>-<last>" or "<first>-<last>:<step>",
+# e.g. "0-9999" or "1,3,10-20:2". Returns a list of ranges
+# [first, last, step] where last is the last index of the range.
+def parse_array_spec(spec):
+  ranges = []
+  for part in str(spec).split(","):
+    part = part.strip()
+    try:
+      step = 1
+      if ":" in part:
+        part, step = part.split(":", 1)
+        step = int(step)
+      if "-" in part:
+        first, last = part.split("-", 1)
+        first, last = int(first), int(last)
+      else:
+        first = last = int(part)
+    except ValueError:
+      raise ValueError("Invalid job array indices: " + str(spec))
+
+    if first < 0 or last < first or step < 1:
+      raise ValueError("Invalid job array indices: " + str(spec))
+    # Don't let the range end between two indices
+    last = first + (last - first) // step * step
+    ranges.append([first, last, step])
+  return ranges
+
+# Formats ranges as returned by parse_array_spec()
+def format_array_spec(ranges):
+  parts = []
+  for first, last, step in ranges:
+    if first == last:
+      parts.append(str(first))
+    elif step == 1:
+      parts.append(str(first) + "-" + str(last))
+    else:
+      parts.append(str(first) + "-" + str(last) + ":" + str(step))
+  return ",".join(parts)
+
+# Returns the number of indices in ranges as returned by parse_array_spec()
+def array_size(ranges):
+  return sum((last - first) // step + 1 for first, last, step in ranges)
+
+
+# Types of dependencies between jobs. A job with a dependency "afterok" on
+# another job only runs once the other job has finished with exit code 0,
+# and is cancelled if the other job fails or is cancelled. A dependency
+# "afterany" is satisfied once the other job has left the queue.
+AFTEROK = "afterok"
+AFTERANY = "afterany"
+
+# Parses the dependencies of a job, given as comma separated list of
+# "<type>:<job id>[:<job id>...]", e.g. "afterok:12:13,afterany:14".
+# Returns a dict job id -> dependency type.
+def parse_dependencies(spec):
+  dependencies = dict()
+  for part in str(spec).split(","):
+    if part.strip() == "":
+      continue
+    items = [item.strip() for item in part.split(":")]
+    if not items[0] in [AFTEROK, AFTERANY] or len(items) < 2:
+      raise ValueError("Invalid job dependencies: " + str(spec))
+    for item in items[1:]:
+      try:
+        job_id = int(item)
+      except ValueError:
+        raise ValueError("Invalid job dependencies: " + str(spec))
+      # afterok is the stronger dependency
+      if dependencies.get(job_id) != AFTEROK:
+        dependencies[job_id] = items[0]
+  return dependencies
+
+# Formats dependencies as returned by parse_dependencies()
+def format_dependencies(dependencies):
+  parts = []
+  for dependency_type in [AFTEROK, AFTERANY]:
+    job_ids = [str(job_id) for job_id, t in dependencies.items() if t == dependency_type]
+    if len(job_ids) > 0:
+      parts.append(":".join([dependency_type] + job_ids))
+  return ",".join(parts)
+
+
+# Returns the fraction of the execution slots of a job that it has kept
+# busy, or None if it is unknown
+def cpu_efficiency(cpu_time, runtime, slots):
+  if cpu_time == None or runtime.total_seconds() <= 0:
+    return None
+  return cpu_time / (runtime.total_seconds() * slots)
+
+def format_bytes(num_bytes):
+  for unit in ["B", "KiB", "MiB", "GiB"]:
+    if num_bytes < 1024:
+      return "{:.1f} {}".format(num_bytes, unit)
+    num_bytes /= 1024
+  return "{:.1f} TiB".format(num_bytes)
+
+
+# States of a job that are reported to subscribers of the queue server
+class job_state:
+  QUEUED = "queued"
+  STARTED = "started"
+  FINISHED = "finished"
+  CANCELLED = "cancelled"
 
 
 class job(uri_node):
   def __init__(self, jdata):
     self._data = jdata
+    # The priority index this job is currently waiting in, if any
+    self._index = None
+    # Serializes starting and killing the process of the job
+    self._process_lock = threading.Lock()
+    self._kill_requested = False
+    # job id -> dependency type of the dependencies that are not
+    # satisfied yet, or None
+    self._unresolved_dependencies = None
+    # Directory the output is written to while the job runs, if it is spooled
+    self._spool_directory = None
+    # The cgroup of the job while it runs, if cgroups are used
+    self._cgroup = None
 
   # URI node code
   
@@ -185,16 +632,19 @@ class job(uri_node):
 
   # Returns a list that contains the available URI attributes of this node
   def uri_node_attributes(self, permissions):
-    data_attributes = list(self._data.get().keys())
+    data_attributes = list(self._data.fields())
     data_attributes.append("wait_time")
     data_attributes.append("runtime")
     data_attributes.append("effective_priority")
+    data_attributes.append("cpu_time")
+    data_attributes.append("cpu_efficiency")
+    data_attributes.append("unresolved_dependencies")
     return data_attributes
     
-  def get_effective_priority(self):
+  def get_effective_priority(self, now=None):
     if self.is_running():
       return float("-inf")
-    return self.get_wait_time().total_seconds() * self._data.get_field(job_data.PRIORITY)
+    return self.get_wait_time(now).total_seconds() * self._data.get_field(job_data.PRIORITY)
 
   def read_uri_attribute(self, name, permissions):
     if name == "wait_time":
@@ -203,8 +653,14 @@ class job(uri_node):
       return self.get_runtime()
     if name == "effective_priority":
       return self.get_effective_priority()
-
-    if not name in self._data.get():
+    if name == "unresolved_dependencies":
+      return format_dependencies(self._unresolved_dependencies or dict())
+    if name == "cpu_time":
+      return self.get_cpu_time()
+    if name == "cpu_efficiency":
+      return self.get_cpu_efficiency()
+
+    if not self._data.has_field(name):
       raise uri_exception_no_such_attribute()
 
     if name == job_data.CMD:
@@ -215,6 +671,8 @@ class job(uri_node):
       return self._format_filename(self.get_stderr_file())
     if name == job_data.NAME:
       return self._format_string(self.get_name())
+    if name == job_data.ENV:
+      return self.get_environment()
 
     return self._data.get_field(name)
 
@@ -226,8 +684,12 @@ class job(uri_node):
       raise uri_exception_read_only
     if name == "effective_priority":
       raise uri_exception_read_only
+    if name == "unresolved_dependencies":
+      raise uri_exception_read_only
+    if name in ["cpu_time", "cpu_efficiency"]:
+      raise uri_exception_read_only
 
-    if not name in self._data.get():
+    if not self._data.has_field(name):
       raise uri_exception_no_such_attribute()
 
     if permissions == uri_permissions.CLIENT:
@@ -237,6 +699,10 @@ class job(uri_node):
         raise uri_exception_permission_denied()
     else:
       self._data.set_field(name, value)
+
+    # A changed priority moves the job to another place in the queue
+    if name == job_data.PRIORITY and self._index != None:
+      self._index.update(self)
   # End URI node code 
     
   def get_id(self):
@@ -250,6 +716,29 @@ class job(uri_node):
   
   def is_running(self):
     return self._data.get_field(job_data.RUNNING)
+
+  # Returns the state of the job while it is in the queue, see job_state
+  def get_state(self):
+    if self.is_running():
+      return job_state.STARTED
+    return job_state.QUEUED
+
+  # Sets the dependencies of the job that are not satisfied yet, as dict
+  # job id -> dependency type
+  def set_unresolved_dependencies(self, dependencies):
+    self._unresolved_dependencies = dependencies
+
+  def has_unresolved_dependencies(self):
+    return self._unresolved_dependencies != None and len(self._unresolved_dependencies) > 0
+
+  # Marks the dependency on a job as satisfied and returns its type
+  def resolve_dependency(self, job_id):
+    return self._unresolved_dependencies.pop(job_id)
+
+  # Returns the exit code of the process of the job, or None if the
+  # process has not finished or could not be started
+  def get_exit_code(self):
+    return self._data.get_field(job_data.EXIT_CODE)
   
   def get_start_date(self):
     return self._data.get_field(job_data.START_DATE)
@@ -260,23 +749,155 @@ class job(uri_node):
   def get_priority(self):
     return self._data.get_field(job_data.PRIORITY)
 
-  def get_wait_time(self):
+  # Returns the id of the user who submitted the job, or -1 if unknown
+  def get_user(self):
+    return self._data.get_field(job_data.USER)
+
+  # Returns the full shell environment of the job
+  def get_environment(self):
+    env = self._data.get_field(job_data.ENV)
+    if isinstance(env, (shared_environment, environment_delta)):
+      env = env.materialize()
+    if self.is_array_element():
+      env = dict(env)
+      env["QSYSTEM_ARRAY_JOB_ID"] = str(self.get_array_id())
+      env["QSYSTEM_ARRAY_TASK_ID"] = str(self.get_array_index())
+    return env
+
+  # Returns the command line that is executed. The elements of job arrays
+  # may refer to their index with %a in the arguments.
+  def get_command_line(self):
+    command = self._data.get_field(job_data.CMD)
+    if self.is_array_element():
+      return [self._format_string(arg) for arg in command]
+    return command
+
+  # The execution slots of a queue correspond to cores
+  def get_slots(self):
+    return self._data.get_field(job_data.SLOTS)
+
+  # Returns the requested memory in MiB, or 0 if the job didn't specify it
+  def get_memory(self):
+    return self._data.get_field(job_data.MEMORY)
+
+  # Returns the max. runtime of the job as timedelta, or None if the job
+  # didn't specify it
+  def get_walltime(self):
+    walltime = self._data.get_field(job_data.WALLTIME)
+    if walltime <= 0:
+      return None
+    return datetime.timedelta(seconds=walltime)
+
+  # Returns the time at which a running job will have finished at the
+  # latest, or None if it is unknown
+  def get_expected_end_date(self):
+    walltime = self.get_walltime()
+    if walltime == None:
+      return None
+    return self.get_start_date() + walltime
+
+  # Returns the limits of the job as tuple (CPUs, memory in MiB, number of
+  # processes), where 0 means no limit
+  def get_limits(self):
+    return (self._data.get_field(job_data.CPU_LIMIT),
+            self._data.get_field(job_data.MEMORY_LIMIT),
+            self._data.get_field(job_data.PIDS_LIMIT))
+
+  # Returns the resource limits that are set with setrlimit() for the limits
+  # that can't be enforced with the controllers of the job's cgroup, as list
+  # of (resource, limit)
+  def _get_fallback_rlimits(self, unavailable_controllers):
+    cpus, memory, pids = self.get_limits()
+    rlimits = []
+    # Unlike memory.max, this also counts memory that has been mapped but
+    # not used, and it applies to each process of the job separately
+    if memory > 0 and "memory" in unavailable_controllers:
+      rlimits.append((resource.RLIMIT_AS, memory * 1024 * 1024))
+    # A job that uses at most the given number of CPUs during its walltime
+    # can't use more CPU time than this
+    if cpus > 0 and "cpu" in unavailable_controllers and self.get_walltime() != None:
+      rlimits.append((resource.RLIMIT_CPU,
+                      math.ceil(cpus * self.get_walltime().total_seconds())))
+    # There is no equivalent for pids.max: RLIMIT_NPROC counts all
+    # processes of the user, including those of other jobs
+
+    # Unprivileged processes can't raise their hard limits
+    result = []
+    for limit, value in rlimits:
+      soft, hard = resource.getrlimit(limit)
+      if hard != resource.RLIM_INFINITY:
+        value = min(value, hard)
+      result.append((limit, value))
+    return result
+
+  # Returns True if the job can run with the given free resources
+  def fits(self, free_slots, free_memory):
+    return self.get_slots() <= free_slots and self.get_memory() <= free_memory
+
+  def get_submission_date(self):
+    return self._data.get_field(job_data.SUBMISSION_DATE)
+
+  def get_wait_time(self, now=None):
     if self.is_running():
       return self._data.get_field(job_data.START_DATE) - self._data.get_field(job_data.SUBMISSION_DATE)
     else:
-      return datetime.datetime.now() - self._data.get_field(job_data.SUBMISSION_DATE)
+      if now == None:
+        now = datetime.datetime.now()
+      return now - self._data.get_field(job_data.SUBMISSION_DATE)
 
   def get_runtime(self):
     if self.is_running():
       return datetime.datetime.now() - self._data.get_field(job_data.START_DATE)
+    elif self._data.get_field(job_data.END_DATE) != None:
+      return self._data.get_field(job_data.END_DATE) - self._data.get_field(job_data.START_DATE)
     else:
       return datetime.timedelta()
 
+  # Returns the CPU time in seconds that the processes of the job have
+  # used so far, or None if it is unknown. While the job runs, it is only
+  # known if the job has a cgroup.
+  def get_cpu_time(self):
+    cgroup = self._cgroup
+    if cgroup != None:
+      try:
+        usage = cgroup.read_usage()
+        return usage["user_time"] + usage["system_time"]
+      except OSError:
+        # The job has just finished
+        pass
+    if self._data.get_field(job_data.USER_TIME) == None:
+      return None
+    return self._data.get_field(job_data.USER_TIME) + self._data.get_field(job_data.SYSTEM_TIME)
+
+  def get_cpu_efficiency(self):
+    return cpu_efficiency(self.get_cpu_time(), self.get_runtime(), self.get_slots())
+
+  # Returns the id of the job array that this job belongs to. Jobs that are
+  # not part of an array are treated as an array of their own.
+  def get_array_id(self):
+    array_id = self._data.get_field(job_data.ARRAY_ID)
+    if array_id == -1:
+      return self.get_id()
+    return array_id
+
+  # Returns the index of the job within its job array, or 0 if it is not
+  # part of an array.
+  def get_array_index(self):
+    return max(self._data.get_field(job_data.ARRAY_INDEX), 0)
+
+  def is_array(self):
+    return False
+
+  def is_array_element(self):
+    return self._data.get_field(job_data.ARRAY_ID) != -1
+
   def _format_string(self, s):
     formatted = s.replace("%J", str(self.get_id()))
     formatted = formatted.replace("%j", str(self.get_id()))
     formatted = formatted.replace("%N", self._data.get_field(job_data.NAME))
     formatted = formatted.replace("%n", self._data.get_field(job_data.NAME))
+    formatted = formatted.replace("%A", str(self.get_array_id()))
+    formatted = formatted.replace("%a", str(self.get_array_index()))
     return formatted
 
   def _format_filename(self, filename):
@@ -292,89 +913,1104 @@ class job(uri_node):
   
   def get_stderr_file(self):
     return self._format_filename(self._data.get_field(job_data.STDERR_FILE))
+
+  def is_spooled(self):
+    return self._data.get_field(job_data.SPOOL)
+
+  # Returns the path of the file in the working directory that receives
+  # the output stream ("stdout" or "stderr") of the job
+  def get_output_file(self, stream):
+    if stream == "stderr":
+      return os.path.join(self.get_working_directory(), self.get_stderr_file())
+    return os.path.join(self.get_working_directory(), self.get_stdout_file())
+
+  # Returns the path of the spool file of an output stream in the given
+  # spool directory. If both streams go to the same file, they share a
+  # spool file.
+  def get_spool_file(self, stream, spool_directory):
+    if self.get_stdout_file() == self.get_stderr_file():
+      stream = "stdout"
+    return os.path.join(spool_directory, str(self.get_id()) + "." + stream)
+
+  # Returns the path of the file that an output stream is written to
+  # while the job runs
+  def get_current_output_file(self, stream):
+    if self._spool_directory != None:
+      return self.get_spool_file(stream, self._spool_directory)
+    return self.get_output_file(stream)
   
   
-  def run(self):
+  # Marks the job as running. This is done by the queue worker when
+  # the job is dispatched, before its process is started.
+  def mark_running(self):
     if self.is_running():
       raise RuntimeError("Tried to mark already running job as running")
     
     self._data.set_field(job_data.RUNNING, True)
     self._data.set_field(job_data.START_DATE, datetime.datetime.now())
+
+  # Runs the job. If the job requests spooling and a spool directory is
+  # given, the output is written to spool files in this directory, which
+  # the caller has to move to their final destination afterwards. If a
+  # cgroup directory is given, the job runs in a cgroup of its own below it.
+  # The process is started by the given process_launcher, the threaded
+  # queue server never forks job processes itself.
+  def run(self, launcher, spool_directory=None, cgroup_directory=None):
+    if not self.is_running():
+      self.mark_running()
     
-    os.chdir(self.get_working_directory())
-    outfile=open(self.get_stdout_file(), "w")
+    # Do not use os.chdir() here, several jobs may be started
+    # concurrently from different threads.
+    working_dir = self.get_working_directory()
+    if self.is_spooled():
+      self._spool_directory = spool_directory
+    outfile = open(self.get_current_output_file("stdout"), "w")
     errfile = outfile
     if self.get_stdout_file() != self.get_stderr_file():
-      errfile = open(self.get_stderr_file(), "w")
+      errfile = open(self.get_current_output_file("stderr"), "w")
     
     try:
-      process = subprocess.Popen(self._data.get_field(job_data.CMD), 
-                                 cwd=self._data.get_field(job_data.DIR), 
-                                 shell=False, 
-                                 env=self._data.get_field(job_data.ENV), 
-                                 stdout=outfile, stderr=errfile, preexec_fn=os.setsid)
-      self._data.set_field(job_data.PROCESS, process.pid)
-      process.wait()
+      unavailable_controllers = set(limit_controllers)
+      if cgroup_directory != None:
+        try:
+          self._cgroup = job_cgroup(cgroup_directory, self.get_id())
+          unavailable_controllers = self._cgroup.set_limits(*self.get_limits())
+        except OSError as e:
+          print("Warning: Could not create cgroup of job", self.get_id(), ":", e)
+      cgroup = self._cgroup
+      cgroup_path = None if cgroup == None else cgroup.get_path()
+      rlimits = self._get_fallback_rlimits(unavailable_controllers)
+
+      with self._process_lock:
+        if self._kill_requested:
+          raise RuntimeError("Job was killed before it was started.")
+
+        pid = launcher.launch(self.get_command_line(), working_dir, self.get_environment(),
+                              outfile, errfile, cgroup_path, rlimits)
+        self._data.set_field(job_data.PROCESS, pid)
+
+      # Jobs are killed once they exceed their walltime
+      walltime_timer = None
+      walltime_exceeded = threading.Event()
+      def kill_after_walltime():
+        walltime_exceeded.set()
+        self.kill()
+      if self.get_walltime() != None:
+        walltime_timer = threading.Timer(self.get_walltime().total_seconds(), kill_after_walltime)
+        walltime_timer.daemon = True
+        walltime_timer.start()
+
+      try:
+        status, resource_usage, process_io = launcher.wait(pid)
+      except OSError:
+        # The launcher has exited, so the job can't be supervised anymore
+        self.kill()
+        raise
+      with self._process_lock:
+        # The process has been reaped, its pid may be reused from now on
+        self._data.set_field(job_data.PROCESS, None)
+      if walltime_timer != None:
+        walltime_timer.cancel()
+      # Processes that the job has left behind must not keep running
+      # outside of the queue's control
+      if cgroup != None and not cgroup.kill_remaining():
+        print("Warning: Processes of job", self.get_id(), "have not exited after being killed")
+      exit_code = os.waitstatus_to_exitcode(status)
+      self._data.set_field(job_data.EXIT_CODE, exit_code)
+      self._record_resource_usage(resource_usage, process_io)
       
       duration = datetime.datetime.now() - self._data.get_field(job_data.START_DATE)
       duration = datetime.timedelta(days=duration.days, seconds=duration.seconds)
       
       outfile.write("*******************************\n")
-      outfile.write("Job terminated with exit code "+str(process.returncode)+" after running for "+str(duration)+"\n")
+      if walltime_exceeded.is_set():
+        outfile.write("Job has been killed because it exceeded its walltime.\n")
+      if cgroup != None and cgroup.is_out_of_memory():
+        outfile.write("Processes of the job have been killed because it exceeded its memory limit.\n")
+      outfile.write("Job terminated with exit code "+str(exit_code)+" after running for "+str(duration)+"\n")
+      peak_memory = self._data.get_field(job_data.PEAK_MEMORY)
+      outfile.write("CPU time: {:.2f} s, peak memory: {}, read: {}, written: {}\n".format(
+        self.get_cpu_time(), "unknown" if peak_memory == None else format_bytes(1024 * peak_memory),
+        format_bytes(self._data.get_field(job_data.READ_BYTES)),
+        format_bytes(self._data.get_field(job_data.WRITE_BYTES))))
     except Exception as e:
       errfile.write("An exception occured during the execution of the job: "+str(e)+"\n")
     finally:
-      self._data.set_field(job_data.PROCESS, None)
+      with self._process_lock:
+        self._data.set_field(job_data.PROCESS, None)
+        if self._cgroup != None:
+          try:
+            self._cgroup.remove()
+          except OSError as e:
+            print("Warning: Could not remove cgroup of job", self.get_id(), ":", e)
+          self._cgroup = None
     
       outfile.close()
       errfile.close()
     
+      self._data.set_field(job_data.END_DATE, datetime.datetime.now())
       self._data.set_field(job_data.RUNNING, False)
 
+  # Stores the resource usage of the finished job, from the rusage of its
+  # process and the I/O statistics of the process, or from its cgroup,
+  # which also covers processes that the job process has not waited for.
+  # The peak memory is only known from the cgroup: ru_maxrss includes the
+  # memory of the process that has forked the job process before exec().
+  def _record_resource_usage(self, resource_usage, process_io):
+    usage = {
+      job_data.USER_TIME: resource_usage.ru_utime,
+      job_data.SYSTEM_TIME: resource_usage.ru_stime,
+      job_data.PEAK_MEMORY: None,
+      # Blocks are counted in units of 512 bytes
+      job_data.READ_BYTES: process_io.get("read_bytes", 512 * resource_usage.ru_inblock),
+      job_data.WRITE_BYTES: process_io.get("write_bytes", 512 * resource_usage.ru_oublock),
+      job_data.VOLUNTARY_SWITCHES: resource_usage.ru_nvcsw,
+      job_data.INVOLUNTARY_SWITCHES: resource_usage.ru_nivcsw
+    }
+    if self._cgroup != None:
+      try:
+        usage.update(self._cgroup.read_usage())
+      except OSError as e:
+        print("Warning: Could not read resource usage of job", self.get_id(), "from its cgroup:", e)
+
+    for field, value in usage.items():
+      self._data.set_field(field, value)
+
   def raw_data(self):
     return self._data
 
+  # Returns the job data as it is written to the journal, with the
+  # environment replaced by its content hash. Only the dependencies that
+  # are not satisfied yet are journaled.
+  def journal_data(self):
+    data = self._data.get()
+    data[job_data.ENV] = data[job_data.ENV].content_hash
+    if self._unresolved_dependencies != None:
+      data[job_data.DEPENDENCIES] = format_dependencies(self._unresolved_dependencies)
+    return data
+
   
+  # Kills the process of the job. If the job has been dispatched but its
+  # process has not been started yet, it will not be started at all.
   def kill(self):
-    process_id = self._data.get_field(job_data.PROCESS)
-    if process_id != None:
-      #self._process.kill()
-      os.killpg(os.getpgid(process_id), signal.SIGTERM)
+    with self._process_lock:
+      self._kill_requested = True
+      process_id = self._data.get_field(job_data.PROCESS)
+      if process_id != None:
+        if self._cgroup != None:
+          # Also kills processes that have left the process group
+          self._cgroup.kill()
+        else:
+          # The process leads its own session, so its process group has
+          # the same id. It may have exited and been reaped by the launcher
+          # already.
+          try:
+            os.killpg(process_id, signal.SIGTERM)
+          except ProcessLookupError:
+            pass
     
 
+# A job array: A set of jobs that only differ by their index in the array.
+# The array waits in the queue as a single job. Its elements are only
+# created when they are dispatched, as jobs of their own with a new job id.
+class job_array(job):
+  def __init__(self, jdata):
+    super().__init__(jdata)
+    # Ranges [next index, last index, step] of the elements that have not
+    # been dispatched yet
+    self._pending = collections.deque(parse_array_spec(jdata.get_field(job_data.ARRAY)))
+    self._num_pending = array_size(self._pending)
+    # Elements that have been dispatched and have not finished yet
+    self._running_elements = dict()
+    self._num_finished = 0
+    self._cancelled = False
+
+  def is_array(self):
+    return True
+
+  # %a stands for all indices of the array
+  def get_array_index(self):
+    return self._data.get_field(job_data.ARRAY)
+
+  def uri_node_attributes(self, permissions):
+    data_attributes = super().uri_node_attributes(permissions)
+    data_attributes.append("num_pending_elements")
+    data_attributes.append("num_running_elements")
+    data_attributes.append("num_finished_elements")
+    return data_attributes
+
+  def read_uri_attribute(self, name, permissions):
+    if name == "num_pending_elements":
+      return self._num_pending
+    if name == "num_running_elements":
+      return len(self._running_elements)
+    if name == "num_finished_elements":
+      return self._num_finished
+    return super().read_uri_attribute(name, permissions)
+
+  def has_pending_elements(self):
+    return self._num_pending > 0
+
+  def get_state(self):
+    if len(self._running_elements) > 0 or self._num_finished > 0:
+      return job_state.STARTED
+    return job_state.QUEUED
+
+  def is_cancelled(self):
+    return self._cancelled
+
+  # Returns True if all elements have been dispatched and have finished
+  def is_finished(self):
+    return self._num_pending == 0 and len(self._running_elements) == 0
+
+  # Creates the next element of the array as job with the given id
+  def create_next_element(self, element_id):
+    index_range = self._pending[0]
+    index = index_range[0]
+    index_range[0] += index_range[2]
+    if index_range[0] > index_range[1]:
+      self._pending.popleft()
+    self._num_pending -= 1
+
+    data = self._data.get()
+    data[job_data.ID] = element_id
+    data[job_data.ARRAY] = ""
+    data[job_data.DEPENDENCIES] = ""
+    data[job_data.ARRAY_ID] = self.get_id()
+    data[job_data.ARRAY_INDEX] = index
+    element = job(job_record(data))
+    self._running_elements[element_id] = element
+    return element
+
+  # The exit code of the array is the exit code of the first element
+  # that failed, or 0 if all elements succeeded.
+  def element_finished(self, element):
+    if self._running_elements.pop(element.get_id(), None) != None:
+      if self._num_finished == 0 or self.get_exit_code() == 0:
+        self._data.set_field(job_data.EXIT_CODE, element.get_exit_code())
+      self._num_finished += 1
+
+  # Drops all elements that have not been dispatched yet and returns the
+  # elements that are still running.
+  def cancel_pending_elements(self):
+    self._cancelled = True
+    self._pending.clear()
+    self._num_pending = 0
+    return list(self._running_elements.values())
+
+  # The journal only knows about the elements that still have to be
+  # dispatched, the array is restored with just these.
+  def journal_data(self):
+    data = super().journal_data()
+    data[job_data.ARRAY] = format_array_spec(self._pending)
+    return data
+
+
+# Index of the waiting jobs by effective priority. The jobs are kept in one
+# heap per user and priority class, so that the order within a heap doesn't
+# change as the jobs age and the jobs of each user can be found quickly.
+class job_priority_index:
+  # Positions in a heap entry
+  _KEY = 0
+  _ID = 1
+  _JOB = 2
+  _VALID = 3
+
+  def __init__(self):
+    # (user, priority) -> heap of [key, job id, job, valid]
+    self._heaps = dict()
+    # job id -> heap entry
+    self._entries = dict()
+    # Number of invalidated entries that are still stored in the heaps
+    self._num_invalid = 0
+
+  def __len__(self):
+    return len(self._entries)
+
+  def __contains__(self, j):
+    return j.get_id() in self._entries
+
+  # Within one priority class, the job that comes first is the oldest job
+  # for positive priorities and the newest job for negative priorities.
+  # For a priority of 0 all jobs are equal and submission order is kept.
+  def _heap_key(self, j, priority):
+    timestamp = j.get_submission_date().timestamp()
+    if priority < 0:
+      return -timestamp
+    return timestamp
+
+  def push(self, j):
+    if j in self:
+      raise ValueError("Job "+str(j.get_id())+" is already in the index")
+
+    priority = j.get_priority()
+    entry = [self._heap_key(j, priority), j.get_id(), j, True]
+    heap_id = (j.get_user(), priority)
+    if not heap_id in self._heaps:
+      self._heaps[heap_id] = []
+    heapq.heappush(self._heaps[heap_id], entry)
+
+    self._entries[j.get_id()] = entry
+    j._index = self
+
+  def remove(self, j):
+    entry = self._entries.pop(j.get_id(), None)
+    if entry != None:
+      entry[self._VALID] = False
+      j._index = None
+      self._num_invalid += 1
+
+      # Make sure that heaps don't grow without bounds if many jobs are
+      # removed that never reach the top of their heap
+      if self._num_invalid > 64 and self._num_invalid > len(self._entries):
+        self._compact()
+
+  def _compact(self):
+    for heap_id in list(self._heaps.keys()):
+      heap = [entry for entry in self._heaps[heap_id] if entry[self._VALID]]
+      if len(heap) == 0:
+        del self._heaps[heap_id]
+      else:
+        heapq.heapify(heap)
+        self._heaps[heap_id] = heap
+    self._num_invalid = 0
+
+  # Must be called when the priority of a job in the index has changed
+  def update(self, j):
+    self.remove(j)
+    self.push(j)
+
+  # Removes invalidated entries from the top of the heap and returns
+  # the first valid entry, or None if the heap is empty.
+  def _heap_top(self, heap_id):
+    heap = self._heaps[heap_id]
+    while len(heap) > 0 and not heap[0][self._VALID]:
+      heapq.heappop(heap)
+      self._num_invalid -= 1
+
+    if len(heap) == 0:
+      del self._heaps[heap_id]
+      return None
+    return heap[0]
+
+  # Returns the ids of the heaps of a user, or of all heaps if user is None
+  def _heap_ids(self, user):
+    return [heap_id for heap_id in self._heaps.keys() if user == None or heap_id[0] == user]
+
+  # Returns the users that have waiting jobs
+  def users(self):
+    return set(heap_id[0] for heap_id in list(self._heaps.keys()) if self._heap_top(heap_id) != None)
+
+  # Returns the waiting job with the highest effective priority without
+  # removing it, or None if no job is waiting. If user is given, only
+  # the jobs of this user are considered.
+  def peek(self, now=None, user=None):
+    if now == None:
+      now = datetime.datetime.now()
+
+    best_entry = None
+    best_priority = None
+    for heap_id in self._heap_ids(user):
+      entry = self._heap_top(heap_id)
+      if entry == None:
+        continue
+
+      effective_priority = entry[self._JOB].get_effective_priority(now)
+      # On equal effective priority, the job that was submitted first wins
+      if (best_entry == None or
+          effective_priority > best_priority or
+          (effective_priority == best_priority and entry[self._ID] < best_entry[self._ID])):
+        best_entry = entry
+        best_priority = effective_priority
+
+    if best_entry == None:
+      return None
+    return best_entry[self._JOB]
+
+  # Removes and returns the waiting job with the highest effective priority,
+  # or None if no job is waiting.
+  def pop(self, now=None):
+    j = self.peek(now)
+    if j != None:
+      self.remove(j)
+    return j
+
+  # Yields the valid entries of a heap in heap order, without modifying it.
+  # Visiting the first k entries takes O(k log k).
+  def _sorted_entries(self, heap):
+    if len(heap) == 0:
+      return
+    # Entries are compared by key and job id, which are unique
+    frontier = [(heap[0][self._KEY], heap[0][self._ID], 0)]
+    while len(frontier) > 0:
+      key, job_id, position = heapq.heappop(frontier)
+      entry = heap[position]
+      if entry[self._VALID]:
+        yield entry
+      for child in [2 * position + 1, 2 * position + 2]:
+        if child < len(heap):
+          heapq.heappush(frontier, (heap[child][self._KEY], heap[child][self._ID], child))
+
+  # Yields the waiting jobs in order of their effective priority, highest
+  # first. If user is given, only the jobs of this user are yielded. The
+  # index must not be modified during the iteration.
+  def iterate(self, now=None, user=None):
+    if now == None:
+      now = datetime.datetime.now()
+
+    # Within one priority class, the heap order is the order of the
+    # effective priorities
+    def by_effective_priority(entry):
+      return (-entry[self._JOB].get_effective_priority(now), entry[self._ID])
+    heaps = [self._heaps[heap_id] for heap_id in self._heap_ids(user)]
+    for entry in heapq.merge(*[self._sorted_entries(heap) for heap in heaps],
+                             key=by_effective_priority):
+      yield entry[self._JOB]
+
+
+# Scheduling policies decide which of the waiting jobs is started next. The
+# queue worker asks its policy for the next job whenever jobs may be started,
+# and starts jobs as long as the policy returns one. It also tells the
+# policy about every job that it starts and every job that has finished.
+# All methods are called with the lock of the queue worker held.
+class scheduling_policy:
+  # Name of the policy, under which it is listed in scheduling_policies
+  name = None
+
+  # Returns the job to start next, or None if no job should be started.
+  # waiting_jobs is the job_priority_index of the waiting jobs,
+  # running_jobs the list of running jobs, free_slots and free_memory
+  # (in MiB) are the free resources of the queue.
+  def next_job(self, waiting_jobs, running_jobs, free_slots, free_memory, now):
+    raise NotImplementedError()
+
+  def job_started(self, j, now):
+    pass
+
+  def job_finished(self, j, now):
+    pass
+
+# Starts the waiting jobs strictly in order of their effective priority.
+# A job that doesn't fit into the free resources blocks all jobs behind it,
+# so that large jobs cannot starve.
+class priority_policy(scheduling_policy):
+  name = "priority"
+
+  def next_job(self, waiting_jobs, running_jobs, free_slots, free_memory, now):
+    j = waiting_jobs.peek(now)
+    if j != None and j.fits(free_slots, free_memory):
+      return j
+    return None
+
+# Number of waiting jobs behind the first one that the backfill policy
+# considers for backfilling
+default_backfill_depth = 100
+
+# Backfill scheduling ("EASY backfilling"): If the waiting job with the
+# highest effective priority doesn't fit into the free resources, it gets a
+# reservation for the earliest time at which enough running jobs will have
+# finished according to their walltimes. Jobs behind it may start right
+# away if they don't delay this reservation, i.e. if they will have finished
+# before it, or if they only use resources that the first job doesn't need.
+# Jobs without walltime can only use such resources.
+class backfill_policy(scheduling_policy):
+  name = "backfill"
+
+  def __init__(self, depth=default_backfill_depth):
+    self._depth = depth
+
+  def next_job(self, waiting_jobs, running_jobs, free_slots, free_memory, now):
+    candidates = waiting_jobs.iterate(now)
+    first = next(candidates, None)
+    if first == None or first.fits(free_slots, free_memory):
+      return first
+
+    reservation_date, extra_slots, extra_memory = self._reserve(first, running_jobs,
+                                                                free_slots, free_memory)
+    for j in itertools.islice(candidates, self._depth):
+      if not j.fits(free_slots, free_memory):
+        continue
+      walltime = j.get_walltime()
+      if reservation_date != None and walltime != None and now + walltime <= reservation_date:
+        return j
+      if j.fits(extra_slots, extra_memory):
+        return j
+    return None
+
+  # Returns the date at which the job can start at the latest, or None if
+  # it is unknown, and the slots and memory that remain free for other
+  # jobs at this date.
+  def _reserve(self, j, running_jobs, free_slots, free_memory):
+    ending_jobs = [r for r in running_jobs if r.get_expected_end_date() != None]
+    ending_jobs.sort(key = lambda r : r.get_expected_end_date())
+    for r in ending_jobs:
+      free_slots += r.get_slots()
+      free_memory += r.get_memory()
+      if j.fits(free_slots, free_memory):
+        return (r.get_expected_end_date(), free_slots - j.get_slots(), free_memory - j.get_memory())
+
+    # The job can only start once jobs without walltime have finished
+    for r in running_jobs:
+      if r.get_expected_end_date() == None:
+        free_slots += r.get_slots()
+        free_memory += r.get_memory()
+    return (None, free_slots - j.get_slots(), free_memory - j.get_memory())
+
+# Half-life of the usage that the fair-share policy accounts to a user
+default_fair_share_half_life = datetime.timedelta(hours=12)
+
+# Recently consumed resources of a user, in slot seconds. The usage decays
+# exponentially over time. It is updated only when the number of slots
+# that the user occupies changes, in between it follows from
+#   usage(t) = usage(t0) * d + slots * (1 - d) / decay_rate
+# with d = exp(-decay_rate * (t - t0)).
+class user_usage:
+  __slots__ = ("_usage", "_slots", "_date")
+
+  def __init__(self, now):
+    self._usage = 0.0
+    self._slots = 0
+    self._date = now
+
+  def get(self, now, decay_rate):
+    elapsed = max((now - self._date).total_seconds(), 0.0)
+    remaining = math.exp(-decay_rate * elapsed)
+    return self._usage * remaining + self._slots * (1 - remaining) / decay_rate
+
+  def add_slots(self, slots, now, decay_rate):
+    self._usage = self.get(now, decay_rate)
+    self._date = now
+    self._slots += slots
+
+  def is_idle(self):
+    return self._slots == 0
+
+# Fair share by user: The next job is the job with the highest effective
+# priority of the user with the lowest recent usage, so that a user who
+# submits many jobs cannot starve the others. If this job doesn't fit
+# into the free resources, it blocks the queue as with priority_policy.
+class fair_share_policy(scheduling_policy):
+  name = "fairshare"
+
+  def __init__(self, half_life=default_fair_share_half_life):
+    self._decay_rate = math.log(2) / half_life.total_seconds()
+    # user id -> user_usage
+    self._usage = dict()
+
+  def get_usage(self, user, now):
+    if not user in self._usage:
+      return 0.0
+    return self._usage[user].get(now, self._decay_rate)
+
+  def next_job(self, waiting_jobs, running_jobs, free_slots, free_memory, now):
+    best_job = None
+    best_key = None
+    for user in waiting_jobs.users():
+      j = waiting_jobs.peek(now, user)
+      # Among users with equal usage, the effective priority decides
+      key = (self.get_usage(user, now), -j.get_effective_priority(now), j.get_id())
+      if best_key == None or key < best_key:
+        best_job = j
+        best_key = key
+
+    if best_job != None and best_job.fits(free_slots, free_memory):
+      return best_job
+    return None
+
+  def job_started(self, j, now):
+    if not j.get_user() in self._usage:
+      self._usage[j.get_user()] = user_usage(now)
+    self._usage[j.get_user()].add_slots(j.get_slots(), now, self._decay_rate)
+
+  def job_finished(self, j, now):
+    usage = self._usage[j.get_user()]
+    usage.add_slots(-j.get_slots(), now, self._decay_rate)
+    # Forget users whose usage has decayed to almost nothing
+    for user in [u for u, usage in self._usage.items()
+                 if usage.is_idle() and usage.get(now, self._decay_rate) < 1.0]:
+      del self._usage[user]
+
+# Scheduling policies by name
+scheduling_policies = {
+  priority_policy.name: priority_policy,
+  backfill_policy.name: backfill_policy,
+  fair_share_policy.name: fair_share_policy
+}
+
+
+# Index of jobs by their (formatted) name. Also serves as the children of the
+# by-name URI directory, which maps each name to the most recently submitted
+# job with that name.
+class job_name_index:
+  def __init__(self):
+    # name -> dict(job id -> job), in order of submission
+    self._jobs = dict()
+
+  def add(self, j):
+    name = j.get_name()
+    if not name in self._jobs:
+      self._jobs[name] = dict()
+    self._jobs[name][j.get_id()] = j
+
+  def remove(self, j):
+    name = j.get_name()
+    jobs = self._jobs.get(name)
+    if jobs != None:
+      jobs.pop(j.get_id(), None)
+      if len(jobs) == 0:
+        del self._jobs[name]
+
+  # Returns a list of all jobs with the given name
+  def find(self, name):
+    return list(self._jobs.get(name, dict()).values())
+
+  # Mapping interface for the URI resolver
+  def __contains__(self, name):
+    return name in self._jobs
+
+  def __getitem__(self, name):
+    jobs = self.find(name)
+    # The jobs may have been removed concurrently
+    if len(jobs) == 0:
+      raise uri_exception_not_found()
+    return jobs[-1]
+
+  def __len__(self):
+    return len(self._jobs)
+
+  def __iter__(self):
+    # Requests are handled concurrently, so iterate over a snapshot
+    return iter(list(self._jobs.keys()))
+
+  def items(self):
+    return [(name, self[name]) for name in self]
+
+
+# Record of a job that has left the queue, i.e. that has finished or that
+# has been cancelled
+class finished_job(uri_node):
+  fields = [job_data.ID, job_data.NAME, job_data.CMD, job_data.DIR,
+            job_data.ARRAY_ID, job_data.ARRAY_INDEX, job_data.SUBMISSION_DATE,
+            job_data.START_DATE, job_data.END_DATE, job_data.EXIT_CODE,
+            job_data.PEAK_MEMORY, job_data.STDOUT_FILE, job_data.STDERR_FILE,
+            job_data.SLOTS, job_data.USER_TIME, job_data.SYSTEM_TIME, job_data.READ_BYTES,
+            job_data.WRITE_BYTES, job_data.VOLUNTARY_SWITCHES, job_data.INVOLUNTARY_SWITCHES]
+  __slots__ = ("_values", "_state")
+
+  def __init__(self, j, state):
+    data = j.raw_data()
+    values = dict((field, data.get_field(field)) for field in self.fields)
+    values[job_data.NAME] = j.get_name()
+    try:
+      values[job_data.STDOUT_FILE] = j.get_stdout_file()
+      values[job_data.STDERR_FILE] = j.get_stderr_file()
+    except ValueError:
+      # The job could not write its output anyway
+      pass
+    if values[job_data.END_DATE] == None:
+      values[job_data.END_DATE] = datetime.datetime.now()
+    self._values = tuple(values[field] for field in self.fields)
+    self._state = state
+
+  def get_field(self, name):
+    return self._values[self.fields.index(name)]
+
+  def get_id(self):
+    return self.get_field(job_data.ID)
+
+  def get_name(self):
+    return self.get_field(job_data.NAME)
+
+  def get_state(self):
+    return self._state
+
+  def get_exit_code(self):
+    return self.get_field(job_data.EXIT_CODE)
+
+  def get_end_date(self):
+    return self.get_field(job_data.END_DATE)
+
+  def get_runtime(self):
+    start_date = self.get_field(job_data.START_DATE)
+    if start_date == None:
+      return datetime.timedelta()
+    return self.get_end_date() - start_date
+
+  # See job.get_output_file()
+  def get_output_file(self, stream):
+    if stream == "stderr":
+      return os.path.join(self.get_field(job_data.DIR), self.get_field(job_data.STDERR_FILE))
+    return os.path.join(self.get_field(job_data.DIR), self.get_field(job_data.STDOUT_FILE))
+
+  def uri_children(self, permissions):
+    return dict()
+
+  def get_cpu_time(self):
+    if self.get_field(job_data.USER_TIME) == None:
+      return None
+    return self.get_field(job_data.USER_TIME) + self.get_field(job_data.SYSTEM_TIME)
+
+  def uri_node_attributes(self, permissions):
+    return self.fields + ["state", "runtime", "cpu_time", "cpu_efficiency"]
+
+  def read_uri_attribute(self, name, permissions):
+    if name == "state":
+      return self._state
+    if name == "runtime":
+      return self.get_runtime()
+    if name == "cpu_time":
+      return self.get_cpu_time()
+    if name == "cpu_efficiency":
+      return cpu_efficiency(self.get_cpu_time(), self.get_runtime(), self.get_field(job_data.SLOTS))
+    if not name in self.fields:
+      raise uri_exception_no_such_attribute()
+    if name == job_data.CMD:
+      return job_data.format_command(self.get_field(name))
+    return self.get_field(name)
+
+  def write_uri_attribute(self, name, value, permissions):
+    raise uri_exception_read_only()
+
+
+# History of the jobs that have left a queue, indexed by id and by name.
+# The oldest jobs are evicted once the history holds more than max_length
+# jobs or once they have left the queue more than max_age ago.
+class job_history(uri_node):
+  def __init__(self, max_length=default_history_length, max_age=default_history_max_age):
+    # job id -> finished_job, in the order in which the jobs have left
+    # the queue
+    self._jobs = collections.OrderedDict()
+    self._jobs_by_uri_id = dict()
+    self._jobs_by_name = job_name_index()
+    self._children = {
+      "by-name": uri_directory(self._jobs_by_name),
+      "by-id": uri_directory(self._jobs_by_uri_id)
+    }
+    self._max_length = max_length
+    self._max_age = max_age
+    self._lock = threading.Lock()
+
+  # Adds a job that has left the queue in the given state, see job_state
+  def add(self, j, state):
+    entry = finished_job(j, state)
+    with self._lock:
+      self._jobs[entry.get_id()] = entry
+      self._jobs_by_uri_id[str(entry.get_id())] = entry
+      self._jobs_by_name.add(entry)
+      self._evict()
+    uri_tree_changed()
+
+  # Must be called with the lock held
+  def _evict(self):
+    oldest_end_date = datetime.datetime.now() - self._max_age
+    evicted = False
+    while len(self._jobs) > 0:
+      entry = next(iter(self._jobs.values()))
+      if len(self._jobs) <= self._max_length and entry.get_end_date() >= oldest_end_date:
+        break
+      del self._jobs[entry.get_id()]
+      del self._jobs_by_uri_id[str(entry.get_id())]
+      self._jobs_by_name.remove(entry)
+      evicted = True
+    return evicted
+
+  # Returns the finished_job with the given id, or None
+  def find(self, job_id):
+    with self._lock:
+      return self._jobs.get(job_id)
+
+  def __len__(self):
+    return len(self._jobs)
+
+  def uri_children(self, permissions):
+    with self._lock:
+      evicted = self._evict()
+    if evicted:
+      uri_tree_changed()
+    return self._children
+
+  def uri_node_attributes(self, permissions):
+    return ["num_jobs", "max_length", "max_age"]
+
+  def read_uri_attribute(self, name, permissions):
+    if name == "num_jobs":
+      return len(self._jobs)
+    if name == "max_length":
+      return self._max_length
+    if name == "max_age":
+      return self._max_age
+    raise uri_exception_no_such_attribute()
+
+  def write_uri_attribute(self, name, value, permissions):
+    if name in self.uri_node_attributes(permissions):
+      raise uri_exception_read_only()
+    raise uri_exception_no_such_attribute()
+
+
+# Moves spooled output files to their final destination in the background,
+# so that slow (network) file systems don't delay the queue.
+class spool_mover:
+  def __init__(self):
+    self._cond = threading.Condition()
+    # source -> destination of the files that have not been moved yet, in
+    # order. Several jobs may write to the same destination.
+    self._pending = collections.OrderedDict()
+    self._closed = False
+    self._thread = threading.Thread(target=self._move_files, daemon=True)
+    self._thread.start()
+
+  def move(self, source, destination):
+    with self._cond:
+      self._pending[source] = destination
+      self._cond.notify_all()
+
+  # Returns the spool file that will be moved to the destination last, or
+  # None if there is none
+  def find(self, destination):
+    with self._cond:
+      for source, pending_destination in reversed(self._pending.items()):
+        if pending_destination == destination:
+          return source
+    return None
+
+  # Moves all remaining files and stops the mover
+  def close(self):
+    with self._cond:
+      self._closed = True
+      self._cond.notify_all()
+    self._thread.join()
+
+  def _move_files(self):
+    while True:
+      with self._cond:
+        while len(self._pending) == 0 and not self._closed:
+          self._cond.wait()
+        if len(self._pending) == 0:
+          return
+        source, destination = next(iter(self._pending.items()))
+
+      try:
+        shutil.move(source, destination)
+      except Exception as e:
+        print("Warning: Could not move spooled output", source, "to", destination + ":", e)
+
+      with self._cond:
+        del self._pending[source]
+
+
+# Children of the URI node of a queue. The next job is only looked up when
+# a URI refers to it, not whenever the URI resolver passes through the queue.
+class queue_children:
+  def __init__(self, worker, children):
+    self._worker = worker
+    self._children = children
+
+  # Mapping interface for the URI resolver
+  def __contains__(self, name):
+    if name == "next-job":
+      return self._worker._find_next_job_for_execution() != None
+    return name in self._children
+
+  def __getitem__(self, name):
+    if name == "next-job":
+      j = self._worker._find_next_job_for_execution()
+      # The job may have been started concurrently
+      if j == None:
+        raise uri_exception_not_found()
+      return j
+    return self._children[name]
+
+  def __len__(self):
+    return len(self._children) + (1 if self._worker._find_next_job_for_execution() != None else 0)
+
+  def __iter__(self):
+    names = list(self._children.keys())
+    if self._worker._find_next_job_for_execution() != None:
+      names.append("next-job")
+    return iter(names)
+
+  def items(self):
+    result = []
+    for name in self:
+      try:
+        result.append((name, self[name]))
+      except uri_exception_not_found:
+        pass
+    return result
+
+
 class queue_worker(uri_node):
+  # The next job changes over time as the waiting jobs age
+  uri_volatile_children = frozenset(["next-job"])
   
-  def __init__(self, queue_log_file):
-    self._jobs = []
+  def __init__(self, queue_log_file, num_slots=default_num_slots, journal=None,
+               memory=default_queue_memory, policy=None, spool_directory=None,
+               cgroup_directory=None, launcher=None):
+    # job id -> job, in order of submission
+    self._jobs = dict()
+    # The same jobs, indexed as they are addressed by URIs
+    self._jobs_by_uri_id = dict()
+    self._jobs_by_name = job_name_index()
+    self._jobs_directory = uri_directory({
+      "by-name": uri_directory(self._jobs_by_name),
+      "by-id": uri_directory(self._jobs_by_uri_id)
+    })
+    # Jobs that are waiting for execution. Jobs with unsatisfied
+    # dependencies are only added once their dependencies are satisfied.
+    self._waiting_jobs = job_priority_index()
+    # job id -> list of jobs in the queue that depend on this job
+    self._dependents = dict()
+    # Jobs that have finished or have been cancelled
+    self._history = job_history()
+    self._uri_children = queue_children(self, {
+      "jobs": self._jobs_directory,
+      "history": self._history
+    })
     #self._current_job = None
     self._num_jobs = 0
     self._lock = threading.Lock()
+    # Signalled whenever something happens that might allow the dispatcher
+    # to start more jobs: A job is submitted, cancelled or has completed,
+    # or the queue is shut down.
+    self._state_changed = threading.Condition(self._lock)
     self._run = True
     self._log = open(queue_log_file, "w", 1)
+
+    if num_slots == None:
+      num_slots = os.cpu_count()
+    if num_slots == None or num_slots < 1:
+      num_slots = 1
+    self._num_slots = num_slots
+    self._free_slots = num_slots
+
+    if memory == None:
+      memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    self._memory = memory
+    self._free_memory = memory
+
+    if policy == None:
+      policy = priority_policy()
+    self._policy = policy
+    # job id -> job of the running jobs
+    self._running_jobs = dict()
+    # Threads that execute the currently running jobs
+    self._job_threads = set()
+    # Functions that are called as listener(job id, state, exit code)
+    # whenever a job changes its state, see job_state. They are called
+    # with the lock held and must not block.
+    self._listeners = []
+
+    # Jobs that request spooling write their output to this directory,
+    # otherwise spooling is disabled
+    self._spool_directory = spool_directory
+    self._spool_mover = None
+    if spool_directory != None:
+      os.makedirs(spool_directory, exist_ok=True)
+      self._spool_mover = spool_mover()
+
+    # Jobs run in cgroups below this directory, see cgroup.py. Without it,
+    # their resource usage is only taken from the job processes themselves.
+    self._cgroup_directory = cgroup_directory
+    # Starts the processes of jobs, see launcher.py. Without it, the worker
+    # starts a launcher of its own with the main loop.
+    self._launcher = launcher
+    self._owns_launcher = launcher == None
+
+    self._journal = journal
+    if journal != None:
+      self._restore_from_journal()
+      journal.start()
+
+  # Restores the jobs that were enqueued when the queue server was stopped.
+  # Jobs that were already running cannot be resumed and are dropped.
+  def _restore_from_journal(self):
+    num_jobs, jobs, started_jobs, environments = self._journal.replay()
+    self._num_jobs = num_jobs
+
+    for job_id in sorted(jobs.keys()):
+      data = jobs[job_id]
+      # Fill in fields that were added after the journal was written
+      for field in job_data.default_values:
+        if not field in data:
+          data[field] = job_data.default_values[field]
+      data[job_data.RUNNING] = False
+      data[job_data.PROCESS] = None
+      env = data[job_data.ENV]
+      if isinstance(env, str):
+        env = environments[env]
+      data[job_data.ENV] = shared_environments.intern(env)
+
+      if job_id in started_jobs:
+        print("Warning: Job", job_id, "was running when the queue was stopped and cannot be restarted.")
+        self._journal.append(job_journal.FINISH, job_id)
+        continue
+
+      record = job_record(data)
+      try:
+        self._validate_job(record)
+      except ValueError as e:
+        print("Warning: Job", job_id, "cannot run in this queue anymore, cancelling it:", e)
+        self._journal.append(job_journal.CANCEL, job_id)
+        continue
+
+      # The journal only holds the dependencies that were not satisfied.
+      # Jobs that they refer to and that are not in the queue anymore were
+      # running and have been dropped.
+      dependencies = parse_dependencies(data[job_data.DEPENDENCIES])
+      unresolved_dependencies = dict()
+      for dependency_id, dependency_type in dependencies.items():
+        if dependency_id in self._jobs:
+          unresolved_dependencies[dependency_id] = dependency_type
+        elif dependency_type == AFTEROK:
+          print("Warning: Job", job_id, "depends on job", dependency_id,
+                "that did not finish, cancelling it.")
+          self._journal.append(job_journal.CANCEL, job_id)
+          break
+      else:
+        j = self._create_job(record)
+        self._add_job(j)
+        self._add_dependencies(j, unresolved_dependencies)
+
+    print("Restored", len(self._jobs), "jobs from the journal.")
+
+  # Appends a record to the journal, if journaling is enabled, and hands
+  # over a snapshot of the queue when it's due. Returns the sequence number
+  # of the record, or None. Must be called with the lock held.
+  def _journal_record(self, record_type, job_id, data=None, environment=None):
+    if self._journal == None:
+      return None
+
+    sequence_number = self._journal.append(record_type, job_id, data, environment)
+    if self._journal.needs_snapshot():
+      jobs = dict()
+      started_jobs = set()
+      environments = dict()
+      for j in self._jobs.values():
+        # Arrays whose elements have all been dispatched are finished as
+        # far as the journal is concerned.
+        if j.is_array() and not j.has_pending_elements():
+          continue
+        env = j.raw_data().get_field(job_data.ENV)
+        environments[env.content_hash] = env
+        jobs[j.get_id()] = j.journal_data()
+        if j.is_running():
+          started_jobs.add(j.get_id())
+      self._journal.snapshot(self._num_jobs, jobs, started_jobs, environments)
+    return sequence_number
+
+  # Blocks until a record has been written to disk. Must be called
+  # without holding the lock.
+  def _wait_journal_durable(self, sequence_number):
+    if sequence_number != None:
+      self._journal.wait_durable(sequence_number)
     
   def uri_children(self, permissions):
-    
-    jobs_by_id = dict()
-    jobs_by_name = dict()
-    for j in self._jobs:
-      jobs_by_id[str(j.get_id())] = j
-      jobs_by_name[j.get_name()] = j
-    by_id = uri_directory(jobs_by_id)
-    by_name = uri_directory(jobs_by_name)
-
-    result = {
-      "jobs": uri_directory({"by-name": by_name, "by-id": by_id})
-    }
-
-    # TODO if number of waiting jobs > 1
-    if len(self._jobs) > 1:
-      result["next-job"] = self._jobs[self._find_next_job_for_execution()]
-
-    return result
+    return self._uri_children
 
   # Returns a list that contains the available URI attributes of this node
   def uri_node_attributes(self, permissions):
-    return ["num_received_jobs", "running", "num_enqueued_jobs"]
+    return ["num_received_jobs", "running", "num_enqueued_jobs", "num_slots", "free_slots",
+            "memory", "free_memory", "policy"]
 
   def read_uri_attribute(self, name, permissions):
     try:
@@ -388,6 +2024,21 @@ class queue_worker(uri_node):
       if name == "running":
         return self._run
 
+      if name == "num_slots":
+        return self._num_slots
+
+      if name == "free_slots":
+        return self._free_slots
+
+      if name == "memory":
+        return self._memory
+
+      if name == "free_memory":
+        return self._free_memory
+
+      if name == "policy":
+        return self._policy.name
+
       raise uri_exception_no_such_attribute()
     finally:
       self._lock.release()
@@ -400,10 +2051,14 @@ class queue_worker(uri_node):
       if name == "num_jobs":
         raise uri_exception_read_only()
 
+      if name in ["num_slots", "free_slots", "memory", "free_memory", "policy"]:
+        raise uri_exception_read_only()
+
       if name == "running":
         if permissions == uri_permissions.SERVER:
           if type(value) is bool:
             self._run = value
+            self._state_changed.notify_all()
           else:
             raise TypeError("Invalid data type for 'running' attribute. Must be bool, but is "+str(type(value)))
         
@@ -411,66 +2066,310 @@ class queue_worker(uri_node):
     finally:
       self._lock.release()
 
-  def new_job(self, jdata):
+  # Enqueues a new job. If env is given, it must be an environment from
+  # shared_environments, which replaces the environment of the job data.
+  # user is the id of the user who submitted the job, -1 if unknown.
+  def new_job(self, jdata, env=None, user=-1):
+    record = self._prepare_job(jdata, env, user)
+
     self._lock.acquire()
-    
     try:
-      # Make sure that the client has not set any fields that he shouldn't ;)
-      jdata.sanitize_new_submission()
-
-      job_id = self._num_jobs
-      jdata.set_field(job_data.ID, job_id)
-      jdata.set_field(job_data.SUBMISSION_DATE, datetime.datetime.now())
-      j = job(jdata)
-    
-      self._jobs.append(j)
-      self._num_jobs += 1
-    except:
-      raise
+      job_id, sequence_number = self._insert_job(record)
+      self._state_changed.notify_all()
     finally:
       self._lock.release()
 
+    # Only acknowledge the submission once it has been persisted. Concurrent
+    # submissions share the same disk flush.
+    self._wait_journal_durable(sequence_number)
     return job_id
 
+  # Enqueues a batch of jobs, given as list of tuples (job data, env) with
+  # env as for new_job(). The jobs are enqueued in order until the queue
+  # holds max_queue_length jobs, the remaining jobs are rejected.
+  # Invalid jobs are rejected without affecting the others. Returns a list
+  # with a tuple (True, job id) or (False, error message) per job.
+  def new_jobs(self, jobs, max_queue_length, user=-1):
+    results = []
+    records = []
+    for jdata, env in jobs:
+      try:
+        records.append(self._prepare_job(jdata, env, user))
+        results.append(None)
+      except Exception as e:
+        results.append((False, str(e)))
+
+    sequence_number = None
+    self._lock.acquire()
+    try:
+      records = iter(records)
+      for i in range(len(results)):
+        if results[i] != None:
+          continue
+        record = next(records)
+        if len(self._jobs) >= max_queue_length:
+          results[i] = (False, "Queue has reached maximum allowed length.")
+          continue
+        try:
+          job_id, sequence_number = self._insert_job(record)
+          results[i] = (True, job_id)
+        except Exception as e:
+          results[i] = (False, str(e))
+      self._state_changed.notify_all()
+    finally:
+      self._lock.release()
+
+    # The journal writes records in order, so all jobs are persisted
+    # once the last one is.
+    self._wait_journal_durable(sequence_number)
+    return results
+
+  # Validates the data of a new job and returns its record
+  def _prepare_job(self, jdata, env, user):
+    record = job_record(jdata)
+    # Make sure that the client has not set any fields that he shouldn't ;)
+    record.sanitize_new_submission()
+    record.set_field(job_data.USER, user)
+    if env == None:
+      env = shared_environments.intern(record.get_field(job_data.ENV))
+    record.set_field(job_data.ENV, env)
+    self._validate_job(record)
+    return record
+
+  # Raises a ValueError if the job can't run in this queue. Also used for
+  # restored jobs, since the queue may have been restarted with fewer
+  # resources.
+  def _validate_job(self, record):
+    slots = record.get_field(job_data.SLOTS)
+    if slots < 1 or slots > self._num_slots:
+      raise ValueError("Job requests "+str(slots)+" execution slots, but the queue provides "+
+                       str(self._num_slots)+" slots.")
+
+    memory = record.get_field(job_data.MEMORY)
+    if memory < 0 or memory > self._memory:
+      raise ValueError("Job requests "+str(memory)+" MiB of memory, but the queue provides "+
+                       str(self._memory)+" MiB.")
+    if record.get_field(job_data.WALLTIME) < 0:
+      raise ValueError("Invalid walltime: "+str(record.get_field(job_data.WALLTIME)))
+    for field in [job_data.CPU_LIMIT, job_data.MEMORY_LIMIT, job_data.PIDS_LIMIT]:
+      if record.get_field(field) < 0:
+        raise ValueError("Invalid "+job_data.displayed_names[field]+": "+str(record.get_field(field)))
+
+    if record.get_field(job_data.ARRAY) != "":
+      num_elements = array_size(parse_array_spec(record.get_field(job_data.ARRAY)))
+      if num_elements > default_max_array_size:
+        raise ValueError("Job array has "+str(num_elements)+" elements, but at most "+
+                         str(default_max_array_size)+" are allowed.")
+
+  # Adds a prepared job to the queue. Returns the job id and the sequence
+  # number of its journal record. Must be called with the lock held.
+  def _insert_job(self, record):
+    dependencies = self._check_dependencies(parse_dependencies(record.get_field(job_data.DEPENDENCIES)))
+
+    job_id = self._num_jobs
+    record.set_field(job_data.ID, job_id)
+    record.set_field(job_data.SUBMISSION_DATE, datetime.datetime.now())
+    j = self._create_job(record)
+
+    self._add_job(j)
+    self._add_dependencies(j, dependencies)
+    self._num_jobs += 1
+    sequence_number = self._journal_submission(j)
+    self._notify_listeners(j, job_state.QUEUED)
+    return (job_id, sequence_number)
+
+  # Appends the current data of a job to the journal. Returns the sequence
+  # number of the record, or None. Must be called with the lock held.
+  def _journal_submission(self, j):
+    # The journal stores each environment only once
+    env = j.raw_data().get_field(job_data.ENV)
+    return self._journal_record(job_journal.SUBMIT, j.get_id(), j.journal_data(),
+                                (env.content_hash, env))
+
+  # Checks the dependencies of a new job, as dict job id -> dependency
+  # type. Returns the dependencies on jobs in the queue, dependencies on
+  # jobs in the history are already satisfied. Raises an exception if
+  # the dependencies can never be satisfied. Must be called with the
+  # lock held.
+  def _check_dependencies(self, dependencies):
+    unresolved_dependencies = dict()
+    for dependency_id, dependency_type in dependencies.items():
+      if dependency_id in self._jobs:
+        unresolved_dependencies[dependency_id] = dependency_type
+        continue
+
+      finished = self._history.find(dependency_id)
+      if finished == None:
+        raise ValueError("Job depends on unknown job "+str(dependency_id)+".")
+      if dependency_type == AFTEROK and not self._has_succeeded(finished, finished.get_state()):
+        raise ValueError("Job depends on job "+str(dependency_id)+", which has failed.")
+    return unresolved_dependencies
+
+  def _has_succeeded(self, j, state):
+    return state == job_state.FINISHED and j.get_exit_code() == 0
+
+  # Makes a job wait for its dependencies on other jobs in the queue, given
+  # as dict job id -> dependency type. Without dependencies, the job
+  # becomes eligible for execution right away. Must be called with the
+  # lock held.
+  def _add_dependencies(self, j, dependencies):
+    if len(dependencies) == 0:
+      self._waiting_jobs.push(j)
+      return
+
+    j.set_unresolved_dependencies(dependencies)
+    for dependency_id in dependencies:
+      if not dependency_id in self._dependents:
+        self._dependents[dependency_id] = []
+      self._dependents[dependency_id].append(j)
+
+  # Resolves the dependencies of the jobs that depend on a job that has
+  # left the queue in the given state. Dependents whose dependencies are
+  # all satisfied become eligible for execution. Returns the dependents
+  # whose dependencies can't be satisfied anymore, which are cancelled.
+  # Must be called with the lock held.
+  def _resolve_dependents(self, j, state):
+    cancelled = []
+    succeeded = self._has_succeeded(j, state)
+    for dependent in self._dependents.pop(j.get_id(), []):
+      # The dependent may have been cancelled in the meantime
+      if self._jobs.get(dependent.get_id()) is not dependent:
+        continue
+
+      dependency_type = dependent.resolve_dependency(j.get_id())
+      if dependency_type == AFTEROK and not succeeded:
+        self._remove_job(dependent)
+        self._journal_record(job_journal.CANCEL, dependent.get_id())
+        cancelled.append(dependent)
+      else:
+        self._journal_submission(dependent)
+        if not dependent.has_unresolved_dependencies():
+          self._waiting_jobs.push(dependent)
+          self._state_changed.notify_all()
+    return cancelled
+
+  def add_listener(self, listener):
+    with self._lock:
+      self._listeners.append(listener)
+
+  def remove_listener(self, listener):
+    with self._lock:
+      self._listeners.remove(listener)
+
+  # Reports a state change of a job to the listeners. Must be called with
+  # the lock held.
+  def _notify_listeners(self, j, state):
+    for listener in self._listeners:
+      try:
+        listener(j.get_id(), state, j.get_exit_code())
+      except Exception as e:
+        print("Warning: Exception occured in job state listener:", e)
+
+  # Records that a job has left the queue in the given state and reports
+  # it to the listeners. Must be called with the lock held.
+  def _job_left_queue(self, j, state):
+    # Cancelling a job may cancel the jobs that depend on it, and so on
+    jobs = [(j, state)]
+    while len(jobs) > 0:
+      j, state = jobs.pop()
+      self._history.add(j, state)
+      self._notify_listeners(j, state)
+      for dependent in self._resolve_dependents(j, state):
+        jobs.append((dependent, job_state.CANCELLED))
+
+  # Returns a dict job id -> (state, exit code) of the jobs with the given
+  # ids that are in the queue or in its history
+  def get_job_states(self, job_ids):
+    states = dict()
+    with self._lock:
+      for job_id in job_ids:
+        j = self._jobs.get(job_id)
+        if j == None:
+          j = self._history.find(job_id)
+        if j != None:
+          states[job_id] = (j.get_state(), j.get_exit_code())
+    return states
+
+  def get_history(self):
+    return self._history
+
+  # Creates a job or, if the record specifies array indices, a job array
+  def _create_job(self, record):
+    if record.get_field(job_data.ARRAY) != "":
+      return job_array(record)
+    return job(record)
+
+  # Adds a job to the job table and its indices. Must be called with
+  # the lock held.
+  def _add_job(self, j):
+    self._jobs[j.get_id()] = j
+    self._jobs_by_uri_id[str(j.get_id())] = j
+    self._jobs_by_name.add(j)
+    uri_tree_changed()
+
+  # Removes a job from the job table and its indices, if it is still
+  # present. Must be called with the lock held.
+  def _remove_job(self, j):
+    if self._jobs.get(j.get_id()) is j:
+      del self._jobs[j.get_id()]
+      del self._jobs_by_uri_id[str(j.get_id())]
+      self._jobs_by_name.remove(j)
+      uri_tree_changed()
+
   def find_job_by_id(self, id):
-    for job in self._jobs:
-      if job.get_id() == id:
-        return job
-    return None
+    return self._jobs.get(id)
 
   def find_jobs_by_name(self, name):
-    result = []
-    for job in self._jobs:
-      if job.get_name() == name:
-        result.append(job)
-    return result
+    return self._jobs_by_name.find(name)
   
   def cancel_job(self, job_id):
-    self._lock.acquire()
-    
-    for i,j in enumerate(self._jobs):
-      if j.get_id() == job_id:
-        if j.is_running():
-          if allow_cancel_running_jobs:
-            j.kill()
-            self._lock.release()
-            return (True, "Job was running and has been killed.")
-          else:
-            self._lock.release()
-            return (False, "Cancelling running jobs is not allowed. Please terminate the job with \"kill\".")
-        else:
-          self._jobs.pop(i)
-          self._lock.release()
-          return (True, "Job has been cancelled.")
-      
-    
-    self._lock.release()
-    
-    return (False, "Specified job was not found.")
+    with self._lock:
+      j = self._jobs.get(job_id)
+      if j == None:
+        return (False, "Specified job was not found.")
+
+      if j.is_array():
+        sequence_number, message = self._cancel_array(j)
+      elif j.is_running():
+        if not allow_cancel_running_jobs:
+          return (False, "Cancelling running jobs is not allowed. Please terminate the job with \"kill\".")
+        j.kill()
+        return (True, "Job was running and has been killed.")
+      else:
+        self._remove_job(j)
+        self._waiting_jobs.remove(j)
+        sequence_number = self._journal_record(job_journal.CANCEL, job_id)
+        self._job_left_queue(j, job_state.CANCELLED)
+        self._state_changed.notify_all()
+        message = "Job has been cancelled."
+
+    self._wait_journal_durable(sequence_number)
+    return (True, message)
   
+  # Cancels the elements of a job array that have not been dispatched yet
+  # and kills the running ones, if allowed. Must be called with the lock
+  # held. Returns (sequence number of the journal record, message).
+  def _cancel_array(self, array):
+    self._waiting_jobs.remove(array)
+    running_elements = array.cancel_pending_elements()
+    sequence_number = self._journal_record(job_journal.CANCEL, array.get_id())
+    if len(running_elements) == 0:
+      self._remove_job(array)
+      self._job_left_queue(array, job_state.CANCELLED)
+      message = "Job array has been cancelled."
+    elif allow_cancel_running_jobs:
+      for element in running_elements:
+        element.kill()
+      message = "Job array has been cancelled, its running jobs have been killed."
+    else:
+      message = "Waiting jobs of the job array have been cancelled, its running jobs are not affected."
+    self._state_changed.notify_all()
+    return (sequence_number, message)
+
   def shutdown(self):
     self._lock.acquire()
     self._run = False
+    self._state_changed.notify_all()
     self._lock.release()
     
   def get_num_jobs(self):
@@ -481,135 +2380,1014 @@ class queue_worker(uri_node):
     
   def get_queued_jobs(self):
     self._lock.acquire()
-    result = [j.raw_data().get() for j in self._jobs]
+    result = [j.raw_data().get() for j in self._jobs.values()]
     self._lock.release()
     
     return result
+
+  # Returns the path of the file that currently holds an output stream
+  # ("stdout" or "stderr") of a job in the queue or in its history, or
+  # None if the job has not started yet. Raises a ValueError if the job
+  # is unknown.
+  def find_output_file(self, job_id, stream):
+    with self._lock:
+      j = self._jobs.get(job_id)
+      if j == None:
+        j = self._history.find(job_id)
+        if j == None:
+          raise ValueError("No such job: " + str(job_id))
+        if j.get_field(job_data.START_DATE) == None:
+          return None
+      elif j.is_array() or not j.is_running():
+        return None
+      else:
+        return j.get_current_output_file(stream)
+
+    path = j.get_output_file(stream)
+    if self._spool_mover != None:
+      return self._spool_mover.find(path) or path
+    return path
+
+  # Returns the jobs that match the filters, in the given sort order (see
+  # list_sort_keys), skipping the first offset jobs and returning at most
+  # limit jobs. filters is a dict that may contain
+  #   "state": "running" or "waiting" (which includes held jobs),
+  #   "name": glob pattern of the job name,
+  #   "dir": prefix of the working directory,
+  #   "user": id of the submitting user,
+  #   "array_elements": whether to include the elements of job arrays.
+  # The jobs are taken from the index that matches the filters and the
+  # sort order, so only as many jobs are visited as needed.
+  def list_jobs(self, filters=None, sort="id", limit=None, offset=0):
+    if filters == None:
+      filters = dict()
+    unknown_filters = set(filters.keys()) - set(["state", "name", "dir", "user", "array_elements"])
+    if len(unknown_filters) > 0:
+      raise ValueError("Unknown filters: " + ", ".join(sorted(unknown_filters)))
+    if filters.get("state") not in [None, "running", "waiting"]:
+      raise ValueError("Invalid job state filter: " + str(filters["state"]))
+    descending = sort.startswith("-")
+    if not sort.lstrip("-") in list_sort_keys:
+      raise ValueError("Invalid sort key: " + sort)
+    if (not isinstance(offset, int) or offset < 0 or
+        (limit != None and (not isinstance(limit, int) or limit < 0))):
+      raise ValueError("Invalid limit or offset")
+
+    with self._lock:
+      now = datetime.datetime.now()
+      jobs = filter(lambda j : self._matches_filters(j, filters),
+                    self._candidate_jobs(filters, sort, now))
+      end = None if limit == None else offset + limit
+
+      if sort in ["id", "-id", "priority"]:
+        return list(itertools.islice(jobs, offset, end))
+
+      key = self._sort_key(sort.lstrip("-"), now)
+      if end == None:
+        jobs = sorted(jobs, key=key, reverse=descending)
+      elif descending:
+        jobs = heapq.nlargest(end, jobs, key=key)
+      else:
+        jobs = heapq.nsmallest(end, jobs, key=key)
+      return jobs[offset:end]
+
+  # Returns an iterable of the jobs that may match the filters. For the sort
+  # orders "id", "-id" and "priority", the jobs are returned in this order.
+  # Must be called with the lock held.
+  def _candidate_jobs(self, filters, sort, now):
+    state = filters.get("state")
+    name = filters.get("name")
+
+    if state == "running":
+      return sorted(self._running_jobs.values(), key=self._sort_key(sort.lstrip("-"), now),
+                    reverse=sort.startswith("-"))
+    if name != None and not glob.has_magic(name):
+      jobs = self._jobs_by_name.find(name)
+    elif sort == "priority":
+      return self._jobs_by_priority(state, now)
+    else:
+      jobs = self._jobs.values()
+
+    if sort == "-id":
+      return reversed(list(jobs))
+    if sort == "priority":
+      return sorted(jobs, key=self._sort_key(sort, now))
+    return jobs
+
+  # Yields the jobs in the order in which they are shown by qstatus: first
+  # the running jobs, then the waiting jobs by their effective priority and
+  # then the jobs that can't start yet because of their dependencies.
+  # Must be called with the lock held.
+  def _jobs_by_priority(self, state, now):
+    if state != "waiting":
+      yield from sorted(self._running_jobs.values(), key=lambda j : j.get_start_date())
+    yield from self._waiting_jobs.iterate(now)
+    # Held jobs are only searched for if the listing reaches them
+    for j in self._jobs.values():
+      if not j.is_running() and not j in self._waiting_jobs:
+        yield j
+
+  def _sort_key(self, sort, now):
+    if sort == "id":
+      return lambda j : j.get_id()
+    if sort == "priority":
+      def priority_key(j):
+        if j.is_running():
+          return (0, j.get_start_date(), j.get_id())
+        if j in self._waiting_jobs:
+          return (1, -j.get_effective_priority(now), j.get_id())
+        return (2, 0, j.get_id())
+      return priority_key
+    if sort == "name":
+      return lambda j : (j.get_name(), j.get_id())
+    if sort == "submission_date":
+      return lambda j : (j.get_submission_date(), j.get_id())
+    # Jobs that have not started yet come last
+    return lambda j : (j.get_start_date() == None, j.get_start_date() or now, j.get_id())
+
+  def _matches_filters(self, j, filters):
+    state = filters.get("state")
+    if state == "running" and not j.is_running():
+      return False
+    if state == "waiting" and j.is_running():
+      return False
+    if "name" in filters and not fnmatch.fnmatchcase(j.get_name(), filters["name"]):
+      return False
+    if "dir" in filters and not j.get_working_directory().startswith(filters["dir"]):
+      return False
+    if "user" in filters and j.get_user() != filters["user"]:
+      return False
+    if not filters.get("array_elements", True) and j.is_array_element():
+      return False
+    return True
+
+  # Returns a dict attribute name -> value per job with the given URI
+  # attributes of the jobs, or all attributes but the environment if
+  # fields is None. Attributes that a job doesn't have are left out.
+  def project_jobs(self, jobs, fields=None):
+    rows = []
+    with self._lock:
+      for j in jobs:
+        row = dict()
+        job_fields = fields
+        if job_fields == None:
+          job_fields = [f for f in j.uri_node_attributes(uri_permissions.CLIENT) if f != job_data.ENV]
+        for field in job_fields:
+          try:
+            row[field] = j.read_uri_attribute(field, uri_permissions.CLIENT)
+          except uri_exception_no_such_attribute:
+            pass
+        rows.append(row)
+    return rows
   
   def is_running(self):
     return self._run
 
 
+  # Returns the waiting job with the highest effective priority, or None
+  # if no job is waiting. Must be called without holding the lock, since
+  # peek() drops invalidated entries from the heaps.
   def _find_next_job_for_execution(self):
-    return self._jobs.index(max(self._jobs, key = lambda j : j.get_effective_priority()))
+    with self._lock:
+      return self._waiting_jobs.peek()
 
     
+  # Dispatches the waiting jobs that the scheduling policy selects, as long
+  # as it selects any. Must be called with the lock held.
+  def _dispatch_jobs(self):
+    now = datetime.datetime.now()
+    while self._free_slots > 0:
+      j = self._policy.next_job(self._waiting_jobs, list(self._running_jobs.values()),
+                                self._free_slots, self._free_memory, now)
+      if j == None:
+        return
+
+      if j.is_array():
+        j = self._dispatch_array_element(j)
+      else:
+        self._waiting_jobs.remove(j)
+      self._free_slots -= j.get_slots()
+      self._free_memory -= j.get_memory()
+      j.mark_running()
+      self._running_jobs[j.get_id()] = j
+      self._policy.job_started(j, now)
+      self._journal_record(job_journal.START, j.get_id(), j.get_start_date())
+      self._notify_listeners(j, job_state.STARTED)
+
+      self._log.write(str(datetime.datetime.now()) +
+                      ": Executing job " + str(j.get_id()) +
+                      ", Name: " + str(j.get_name()) +
+                      ", Command: " + str(j.get_cmd()) +
+                      ", Slots: " + str(j.get_slots()) +
+                      ", Output: "+os.path.join(j.get_working_directory(),j.get_stdout_file())+"\n")
+
+      t = threading.Thread(target=self._execute_job, args=(j,))
+      self._job_threads.add(t)
+      t.start()
+
+  # Creates the next element of a waiting job array, which keeps waiting
+  # as long as it has elements left. Must be called with the lock held.
+  def _dispatch_array_element(self, array):
+    if array.get_state() == job_state.QUEUED:
+      self._notify_listeners(array, job_state.STARTED)
+    element = array.create_next_element(self._num_jobs)
+    self._num_jobs += 1
+    self._add_job(element)
+    # The array is journaled with the elements that are left, the element
+    # as a job of its own.
+    if array.has_pending_elements():
+      self._journal_submission(array)
+    else:
+      self._waiting_jobs.remove(array)
+      self._journal_record(job_journal.FINISH, array.get_id())
+    self._journal_submission(element)
+    return element
+
+  def _execute_job(self, j):
+    try:
+      j.run(self._launcher, self._spool_directory, self._cgroup_directory)
+    except Exception as e:
+      print("An exception occured during the execution of job",j.get_id(),":",e)
+    finally:
+      # Do not put that inside the try, because
+      # the job must always be removed from the queue after it was attempted to execute it
+      self._lock.acquire()
+      # The job has finished once its output is complete, not once it
+      # has been moved
+      if j.is_spooled() and self._spool_mover != None:
+        for stream in ["stdout", "stderr"]:
+          spool_file = j.get_spool_file(stream, self._spool_directory)
+          if os.path.exists(spool_file):
+            self._spool_mover.move(spool_file, j.get_output_file(stream))
+      # If the job was cancelled, it is possible that it is not in queue anymore,
+      # which _remove_job() takes care of
+      self._remove_job(j)
+      self._journal_record(job_journal.FINISH, j.get_id())
+      self._job_left_queue(j, job_state.FINISHED)
+      if j.is_array_element():
+        self._element_finished(j)
+      self._free_slots += j.get_slots()
+      self._free_memory += j.get_memory()
+      self._running_jobs.pop(j.get_id(), None)
+      self._policy.job_finished(j, datetime.datetime.now())
+      self._job_threads.discard(threading.current_thread())
+      self._state_changed.notify_all()
+      self._lock.release()
+    
+  # Removes the job array of a finished element once all of its elements
+  # have finished. Must be called with the lock held.
+  def _element_finished(self, element):
+    array = self._jobs.get(element.get_array_id())
+    if array != None and array.is_array():
+      array.element_finished(element)
+      if array.is_finished():
+        self._remove_job(array)
+        if array.is_cancelled():
+          self._job_left_queue(array, job_state.CANCELLED)
+        else:
+          self._job_left_queue(array, job_state.FINISHED)
+
   def main_loop(self):
+    if self._launcher == None:
+      self._launcher = process_launcher()
     print("Entering main batch processing loop...")
-    while self._run:
-      if len(self._jobs) > 0:
-        next_job_index = self._find_next_job_for_execution()
-        j = None
+    self._lock.acquire()
+    try:
+      while self._run:
         try:
-          j = self._jobs[next_job_index]
-          self._log.write(str(datetime.datetime.now()) +
-                          ": Executing job " + str(j.get_id()) +
-                          ", Name: " + str(j.get_name()) +
-                          ", Command: " + str(j.get_cmd()) +
-                          ", Output: "+os.path.join(j.get_working_directory(),j.get_stdout_file())+"\n")
-          j.run()
+          self._dispatch_jobs()
         except Exception as e:
-          print("An exception occured during the execution of job",self._jobs[0].get_id(),":",e)
-        finally:
-          # Do not put that inside the try, because
-          # the job must always be removed from the queue after it was attempted to execute it
-
-
-          self._lock.acquire()
-          # If the job was cancelled, it is possible that it is not in queue anymore, so make sure it
-          # exists
-          if j in self._jobs:
-            self._jobs.pop(self._jobs.index(j))
-          self._lock.release()
-      
-      # This not only prevents high cpu usage, it also prevents DoS attacks
-      # against the queue system (recursive submission scripts!)
-      time.sleep(0.4)
+          print("An exception occured while dispatching jobs:",e)
+
+        # Sleep until a job can possibly be started. Note that the rate of
+        # job submissions (recursive submission scripts!) is limited
+        # by the queue server.
+        self._state_changed.wait()
+    finally:
+      self._lock.release()
+
+    print("Waiting for running jobs to complete...")
+    self._lock.acquire()
+    running_threads = list(self._job_threads)
+    self._lock.release()
+    for t in running_threads:
+      t.join()
+
+    if self._spool_mover != None:
+      self._spool_mover.close()
+    if self._journal != None:
+      self._journal.close()
+    if self._owns_launcher:
+      self._launcher.close()
     print("Shutting down...")
         
       
+# Token bucket rate limiter: Up to 'burst' events are allowed at once,
+# tokens for new events are refilled with 'rate' tokens per second.
+class rate_limiter:
+  def __init__(self, rate, burst):
+    self._rate = rate
+    self._burst = burst
+    self._tokens = float(burst)
+    self._last_update = time.monotonic()
+    self._lock = threading.Lock()
+
+  # Returns True and consumes a token if the event is allowed.
+  def try_acquire(self):
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self._burst, self._tokens + (now - self._last_update) * self._rate)
+      self._last_update = now
+
+      if self._tokens < 1.0:
+        return False
+      self._tokens -= 1.0
+      return True
+
+  # Consumes up to max_count tokens and returns the number of events
+  # that are allowed.
+  def acquire_up_to(self, max_count):
+    with self._lock:
+      now = time.monotonic()
+      self._tokens = min(self._burst, self._tokens + (now - self._last_update) * self._rate)
+      self._last_update = now
+
+      count = min(max_count, int(self._tokens))
+      self._tokens -= count
+      return count
+
+
+# Wire protocol
+#
+# Clients keep one connection open for as long as they like and can send any
+# number of requests over it. A request is sent as
+#   ["request", <request id>, <message>]
+# and answered with
+#   ["response", <request id>, <reply>]
+# where <message> is a list whose first element names the operation, e.g.
+# ['cancel', 12], and <reply> is a list whose first element is a tuple
+# (success, explanation), optionally followed by the result.
+# For compatibility, a bare <message> without envelope is answered with a
+# bare <reply>.
+#
+# A request ['subscribe', <queue or None>, <list of job ids or None>] turns
+# the connection into a subscription: After the reply, the server sends
+#   ["event", <request id>, <event>]
+# whenever a matching job changes its state, where <event> is a dict with
+# the keys "queue", "id", "state" (see job_state) and "exit_code". The
+# connection cannot be used for other requests anymore, the subscription
+# ends when the client closes it.
+#
+# A request ['list_jobs', <queue>, <filters>, <sort key>, <limit>, <offset>,
+# <fields>] (see queue_worker.list_jobs()) is answered with any number of
+#   ["rows", <request id>, <list of dicts field -> value>]
+# with the matching jobs in order, followed by the reply, which holds the
+# number of listed jobs.
+#
+# A request ['tail', <queue>, <job id>, <stream>, <offset>, <follow>] streams
+# the output stream ("stdout" or "stderr") of a job from the given byte
+# offset. After the reply, the server sends the output as raw messages of
+# bytes, which are received with recv_bytes() instead of recv(), and an
+# empty message at the end of the output. If follow is True, the output of
+# a running job is sent as it is written until the job has finished.
+request_tag = "request"
+response_tag = "response"
+event_tag = "event"
+rows_tag = "rows"
+# Appended to the reply if a request refers to an environment by its
+# content hash that the server doesn't know. The client should then send
+# the environment with 'put_environment' and repeat the request.
+unknown_environment_tag = "unknown-environment"
+
+# A subscription of a connection to the events of a queue_server. Events
+# are only sent after the reply to the 'subscribe' request, until then they
+# are kept back.
+class event_subscription:
+  def __init__(self, conn, request_id, queue_name, job_ids):
+    self.conn = conn
+    self._request_id = request_id
+    self._queue_name = queue_name
+    self._job_ids = None if job_ids == None else set(job_ids)
+    self._send_lock = threading.Lock()
+    self._replied = False
+    self._pending_events = []
+    # Ids of the subscribed jobs that have not finished yet, None if all
+    # jobs are subscribed or the reply has not been sent yet
+    self._unfinished_jobs = None
+
+  def matches(self, event):
+    if self._queue_name != None and self._queue_name != event["queue"]:
+      return False
+    return self._job_ids == None or event["id"] in self._job_ids
+
+  # Sends the reply to the 'subscribe' request with the states of the
+  # subscribed jobs as dict job id -> (state, exit code), followed by the
+  # events that have been kept back
+  def send_reply(self, states):
+    with self._send_lock:
+      if self._job_ids != None:
+        self._unfinished_jobs = {job_id for job_id, (state, exit_code) in states.items()
+                                 if state in [job_state.QUEUED, job_state.STARTED]}
+      self.conn.send([response_tag, self._request_id, [(True, "Subscribed."), states]])
+      for event in self._pending_events:
+        self._send_event(event)
+      self._pending_events = []
+      self._replied = True
+
+  def send_event(self, event):
+    with self._send_lock:
+      if not self._replied:
+        self._pending_events.append(event)
+      else:
+        self._send_event(event)
+
+  # Must be called with the send lock held
+  def _send_event(self, event):
+    self.conn.send([event_tag, self._request_id, event])
+    if self._unfinished_jobs != None and event["state"] in [job_state.FINISHED, job_state.CANCELLED]:
+      self._unfinished_jobs.discard(event["id"])
+
+  # Returns True if all subscribed jobs have finished or are unknown, so
+  # that there will be no more events
+  def is_finished(self):
+    with self._send_lock:
+      return self._unfinished_jobs != None and len(self._unfinished_jobs) == 0
+
 class queue_server:
   
-  def __init__(self, queue_worker, max_queue_length, uri_root):
-    self._listener = Listener(socket_name, 'AF_UNIX')
-    self._queue_worker = queue_worker
+  def __init__(self, queues, max_queue_length, uri_root,
+               max_submission_rate=default_max_submission_rate,
+               submission_burst=default_submission_burst,
+               address=None,
+               num_threads=default_num_server_threads,
+               io_timeout=default_connection_io_timeout,
+               idle_timeout=default_connection_idle_timeout):
+    if address == None:
+      address = socket_name
+    # Clients with connection pools open several connections at once
+    self._listener = Listener(address, 'AF_UNIX', backlog=128)
+    # queue name -> queue_worker
+    self._queues = queues
   
     self._max_queue_length = max_queue_length
     self._uri_root = uri_root
+    self._submission_limiter = rate_limiter(max_submission_rate, submission_burst)
+
+    # Requests are handled concurrently by a bounded pool of threads.
+    # While a request of a connection is being handled, the connection
+    # is not watched by the listening thread, so each connection is only
+    # ever served by one thread at a time.
+    self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_threads)
+    self._io_timeout = io_timeout
+    self._idle_timeout = idle_timeout
+
+    # Idle client connections -> time of their last activity. Connections
+    # that are new or have been served are handed back by other threads
+    # through _returned_connections, which then wake up the listening thread.
+    self._connections = dict()
+    self._returned_connections = []
+    self._connections_lock = threading.Lock()
+    self._wakeup_receiver, self._wakeup_sender = Pipe(duplex=False)
+
+    # Events are sent to the subscribers by a separate thread, so that the
+    # queues are never blocked by slow subscribers. It also watches the
+    # connections of the subscribers, and is woken up through
+    # _events_wakeup_sender when there are new events or subscriptions.
+    self._subscriptions = []
+    self._events = collections.deque()
+    self._events_lock = threading.Lock()
+    self._events_wakeup_receiver, self._events_wakeup_sender = Pipe(duplex=False)
+    self._events_wakeup_pending = False
+    for queue_name, queue in queues.items():
+      queue.add_listener(self._make_event_listener(queue_name))
     
-  def _handle_enqueue(self, msg, conn):
+  def _find_queue(self, queue_name):
+    if not queue_name in self._queues:
+      raise ValueError("No such queue: " + str(queue_name))
+    return self._queues[queue_name]
+
+  # If env_hash is given, the job uses the environment with this content
+  # hash instead of the environment in the job data.
+  # user is the id of the user who sent the request.
+  def _handle_enqueue(self, msg, queue_name, env_hash, user):
+    try:
+      queue = self._find_queue(queue_name)
+    except ValueError as e:
+      return [(False, str(e))]
+
+    env = None
+    if env_hash != None:
+      env = shared_environments.lookup(env_hash)
+      if env == None:
+        return [(False, "The environment is not known to the queue server."), unknown_environment_tag]
+
+    # Refuse new jobs if the queue has shutdown
+    if not queue.is_running():
+      return [(False, "Queue has shutdown.")]
 
     # Refuse new jobs if the specified max. queue length is reached.
     # This can prevent "submission-bomb" DoS attacks.
-    if(self._queue_worker.get_num_jobs() >= self._max_queue_length):
-      conn.send([(False, "Request to enqueue has been denied. Queue has reached maximum allowed length.")])
-      return
-          
-    # Refuse new jobs if the queue has shutdown
-    if not self._queue_worker.is_running():
-      conn.send([(False, "Queue has shutdown.")])
-      return
+    if(queue.get_num_jobs() >= self._max_queue_length):
+      return [(False, "Request to enqueue has been denied. Queue has reached maximum allowed length.")]
+
+    # Refuse new jobs if they are submitted faster than allowed. Only
+    # submissions that have passed the checks above count.
+    # This can prevent "submission-bomb" DoS attacks.
+    if not self._submission_limiter.try_acquire():
+      return [(False, "Request to enqueue has been denied. Too many jobs have been submitted, please try again later.")]
     
     try:
       jdata = job_data(msg)
 
-      job_id = self._queue_worker.new_job(jdata)
-      conn.send([(True, "Job is enqueued."), job_id])
+      job_id = queue.new_job(jdata, env, user)
+      return [(True, "Job is enqueued."), job_id]
     except Exception as e:
-      conn.send([(False, "Could not enqueue job: "+str(e))])
+      return [(False, "Could not enqueue job: "+str(e))]
+
+  # Enqueues a batch of jobs, given as list of tuples (job data, env hash),
+  # see queue_client.enqueue_jobs(). If an env hash is None, the job uses
+  # the environment in its job data.
+  def _handle_enqueue_jobs(self, jobs, queue_name, user):
+    try:
+      queue = self._find_queue(queue_name)
+    except ValueError as e:
+      return [(False, str(e))]
+
+    envs = []
+    unknown_environments = set()
+    for data, env_hash in jobs:
+      env = None
+      if env_hash != None:
+        env = shared_environments.lookup(env_hash)
+        if env == None:
+          unknown_environments.add(env_hash)
+      envs.append(env)
+    # Nothing is enqueued until the client has sent all missing environments
+    if len(unknown_environments) > 0:
+      return [(False, "Some environments are not known to the queue server."),
+              unknown_environment_tag, list(unknown_environments)]
+
+    if not queue.is_running():
+      return [(False, "Queue has shutdown.")]
+
+    results = [None] * len(jobs)
+    valid = []
+    for i in range(len(jobs)):
+      try:
+        valid.append((i, (job_data(dict(jobs[i][0])), envs[i])))
+      except Exception as e:
+        results[i] = (False, str(e))
+
+    # Refuse the jobs that don't fit into the queue, and of the others those
+    # that are submitted faster than allowed. Refused jobs don't count
+    # against the submission rate.
+    free_length = max(self._max_queue_length - queue.get_num_jobs(), 0)
+    num_allowed = self._submission_limiter.acquire_up_to(min(len(valid), free_length))
+    accepted = []
+    for k, (i, j) in enumerate(valid):
+      if k >= free_length:
+        results[i] = (False, "Queue has reached maximum allowed length.")
+      elif k >= num_allowed:
+        results[i] = (False, "Too many jobs have been submitted, please try again later.")
+      else:
+        accepted.append((i, j))
+
+    accepted_results = queue.new_jobs([j for i, j in accepted], self._max_queue_length, user)
+    for (i, j), result in zip(accepted, accepted_results):
+      results[i] = result
+
+    num_enqueued = sum(1 for result in results if result[0] == True)
+    return [(True, str(num_enqueued) + " of " + str(len(jobs)) + " jobs are enqueued."), results]
+
+  def _make_event_listener(self, queue_name):
+    def listener(job_id, state, exit_code):
+      with self._events_lock:
+        if len(self._subscriptions) > 0:
+          self._events.append({"queue": queue_name, "id": job_id,
+                               "state": state, "exit_code": exit_code})
+          self._wake_up_event_thread()
+    return listener
+
+  # Must be called with the events lock held
+  def _wake_up_event_thread(self):
+    if not self._events_wakeup_pending:
+      self._events_wakeup_pending = True
+      self._events_wakeup_sender.send(None)
+
+  # Registers a subscription for the events of the jobs with the given ids
+  # of a queue, or of all jobs if job_ids is None. The reply contains the
+  # current states of these jobs as dict job id -> (state, exit code),
+  # including the jobs in the history of the queue. A subscription for
+  # given jobs is ended by the server once all of them have finished or
+  # are unknown to the queue.
+  def _subscribe(self, conn, request_id, queue_name, job_ids):
+    states = dict()
+    if queue_name != None:
+      try:
+        queue = self._find_queue(queue_name)
+      except ValueError as e:
+        conn.send([response_tag, request_id, [(False, str(e))]])
+        return False
+
+    # Events are kept back until the reply has been sent
+    subscription = event_subscription(conn, request_id, queue_name, job_ids)
+    with self._events_lock:
+      self._subscriptions.append(subscription)
+      # So that the event thread watches the connection
+      self._wake_up_event_thread()
+    # Only now the states are read, so that no state changes are missed
+    if queue_name != None and job_ids != None:
+      states = queue.get_job_states(job_ids)
+
+    try:
+      subscription.send_reply(states)
+      if subscription.is_finished():
+        self._end_subscription(subscription)
+    except (EOFError, OSError):
+      self._end_subscription(subscription)
+    return True
+
+  def _end_subscription(self, subscription):
+    with self._events_lock:
+      if subscription in self._subscriptions:
+        self._subscriptions.remove(subscription)
+    subscription.conn.close()
+
+  # Sends the events to the subscribers and ends the subscriptions whose
+  # connection has been closed by the client. Subscribers don't send
+  # anything, so their connections only become readable when closed.
+  def _send_events(self):
+    while True:
+      with self._events_lock:
+        subscriptions = {s.conn: s for s in self._subscriptions if not s.conn.closed}
+      try:
+        ready = wait(list(subscriptions.keys()) + [self._events_wakeup_receiver])
+      except (OSError, ValueError):
+        # A connection has been closed by another thread meanwhile
+        continue
+
+      for conn in ready:
+        if conn is self._events_wakeup_receiver:
+          conn.recv()
+          with self._events_lock:
+            self._events_wakeup_pending = False
+            events = list(self._events)
+            self._events.clear()
+          self._dispatch_events(events)
+        else:
+          self._end_subscription(subscriptions[conn])
+
+  def _dispatch_events(self, events):
+    for event in events:
+      with self._events_lock:
+        subscriptions = list(self._subscriptions)
+
+      for subscription in subscriptions:
+        if not subscription.matches(event):
+          continue
+        try:
+          subscription.send_event(event)
+          if subscription.is_finished():
+            self._end_subscription(subscription)
+        except Exception:
+          # The client has closed the connection, or it doesn't keep
+          # up with the events
+          self._end_subscription(subscription)
+
+  # Sends the jobs of a queue that match the filters in chunks, followed by
+  # the reply, see queue_worker.list_jobs(). The jobs are selected at once,
+  # their fields are read chunk by chunk, so that the queue is not blocked
+  # for long.
+  def _list_jobs(self, conn, request_id, queue_name, filters, sort, limit, offset, fields):
+    try:
+      queue = self._find_queue(queue_name)
+      jobs = queue.list_jobs(filters, sort, limit, offset)
+    except ValueError as e:
+      conn.send([response_tag, request_id, [(False, str(e))]])
+      return
+
+    for i in range(0, len(jobs), default_list_chunk_size):
+      conn.send([rows_tag, request_id, queue.project_jobs(jobs[i:i + default_list_chunk_size], fields)])
+    conn.send([response_tag, request_id, [(True, str(len(jobs)) + " jobs listed."), len(jobs)]])
+
+  # Handles a 'tail' request. Output that is available right away is sent
+  # by the calling thread. Following the output of a job may take long, so
+  # the connection is then handed over to a thread of its own.
+  # Returns like _serve_request().
+  def _tail(self, conn, request_id, queue_name, job_id, stream, offset, follow):
+    if not follow:
+      return self._stream_output(conn, request_id, queue_name, job_id, stream, offset, False)
+
+    def follow_output():
+      try:
+        served = self._stream_output(conn, request_id, queue_name, job_id, stream, offset, True)
+      except Exception as e:
+        print("Warning: Exception occured while following the output of job", job_id, ":", e)
+        served = False
+      if served:
+        self._return_connection(conn)
+      else:
+        conn.close()
+    threading.Thread(target=follow_output, daemon=True).start()
+    return None
+
+  # Sends the reply to a 'tail' request followed by the output. Returns
+  # False if the connection is broken.
+  def _stream_output(self, conn, request_id, queue_name, job_id, stream, offset, follow):
+    try:
+      try:
+        queue = self._find_queue(queue_name)
+        path, f = self._open_output_file(queue, job_id, stream, follow)
+      except Exception as e:
+        conn.send([response_tag, request_id, [(False, str(e))]])
+        return True
+      conn.send([response_tag, request_id, [(True, "Streaming output."), path]])
+    except (EOFError, OSError):
+      return False
+    return self._send_output(conn, queue, job_id, f, offset, follow)
+
+  # Opens the file that holds an output stream of a job and returns a tuple
+  # (path, file). If follow is True, waits for the job to start.
+  def _open_output_file(self, queue, job_id, stream, follow):
+    if not stream in ["stdout", "stderr"]:
+      raise ValueError("Invalid output stream: " + str(stream))
+    while True:
+      path = queue.find_output_file(job_id, stream)
+      if path != None:
+        try:
+          return (path, open(path, "rb"))
+        except FileNotFoundError:
+          # The file may have been moved out of the spool in the meantime,
+          # or the job is just about to create it
+          pass
+      state = queue.get_job_states([job_id]).get(job_id, (None, None))[0]
+      if not follow or not state in [job_state.QUEUED, job_state.STARTED]:
+        raise ValueError("No output of job " + str(job_id) + " is available.")
+      time.sleep(default_tail_poll_interval)
+
+  # Sends the output in the file from the offset as raw messages, with
+  # sendfile() directly from the file to the connection, followed by an
+  # empty message. If follow is True, keeps sending new output until the
+  # job has left the queue. Closes the file. Returns False if the
+  # connection is broken.
+  def _send_output(self, conn, queue, job_id, f, offset, follow):
+    # The socket object only borrows the file descriptor of the connection
+    sock = socket.socket(fileno=conn.fileno())
+    try:
+      while True:
+        # Read the state first, so that no output is missed that is
+        # written before the job leaves the queue
+        state = queue.get_job_states([job_id]).get(job_id, (None, None))[0]
+        done = not follow or not state in [job_state.QUEUED, job_state.STARTED]
+        size = os.fstat(f.fileno()).st_size
+        while offset < size:
+          length = min(size - offset, default_tail_chunk_size)
+          sock.sendall(struct.pack("!i", length))
+          end = offset + length
+          while offset < end:
+            sent = os.sendfile(sock.fileno(), f.fileno(), offset, end - offset)
+            if sent == 0:
+              raise EOFError("Output file has been truncated")
+            offset += sent
+          size = os.fstat(f.fileno()).st_size
+        if done:
+          sock.sendall(struct.pack("!i", 0))
+          return True
+        time.sleep(default_tail_poll_interval)
+    except Exception as e:
+      print("Warning: Could not send output of job", job_id, ":", e)
+      return False
+    finally:
+      sock.detach()
+      f.close()
+
+  def _handle_uri_query(self, uri, read = lambda access, permissions : access.read(permissions)):
+    try:
+      permissions = uri_permissions.CLIENT
+      access = uri_accessor(uri, self._uri_root, permissions)
+      result = read(access, permissions)
+      return [(True, "URI has been read."), result]
+    except uri_exception_read_only:
+      return [(False, "URI is read-only.")]
+    except uri_exception_permission_denied:
+      return [(False, "Access to URI has been denied.")]
+    except uri_exception_not_found:
+      return [(False, "Object at specified URI does not exist.")]
+    except uri_exception_no_such_attribute:
+      return [(False, "Attribute specified by URI does not exist.")]
+    except Exception as e:
+      print("Warning: Exception occured during URI query:", e)
+      return [(False, str(e))]
+
+  # Reads the subtrees below one URI or a list of URIs, see
+  # uri_accessor.read_tree(). For a list of URIs, the result is the list
+  # of the individual replies.
+  def _handle_uri_query_tree(self, uris, attributes, depth):
+    if attributes != None:
+      attributes = set(attributes)
+    read = lambda access, permissions : access.read_tree(permissions, attributes, depth)
+
+    if isinstance(uris, str):
+      return self._handle_uri_query(uris, read)
+    return [(True, "URIs have been read."), [self._handle_uri_query(uri, read) for uri in uris]]
+
+  # Stores an environment that is given either as ("full", environment) or
+  # as ("delta", base content hash, changed variables, removed variables)
+  # and replies with its content hash.
+  def _handle_put_environment(self, payload):
+    if payload[0] == "full":
+      env = shared_environments.intern(dict(payload[1]))
+    elif payload[0] == "delta":
+      env = shared_environments.intern_delta(payload[1], payload[2], payload[3])
+      if env == None:
+        return [(False, "The base environment is not known to the queue server."), unknown_environment_tag]
+    else:
+      return [(False, "Invalid environment")]
+    return [(True, "Environment has been stored."), env.content_hash]
+
+  def _handle_cancel(self, job_id, queue_name):
+    try:
+      queue = self._find_queue(queue_name)
+    except ValueError as e:
+      return [(False, str(e))]
+    return [queue.cancel_job(job_id)]
+
+  # Handles a single message of the user with the given id and returns
+  # the reply
+  def _handle_message(self, msg, user):
+    # Don't log job data and environments, they would just clutter the log.
+    if msg[0] in ['enqueue', 'enqueue_array', 'enqueue_jobs', 'put_environment']:
+      print("Received message:",msg[0])
+    else:
+      print("Received message:",msg[:3])
     
+    # Messages of older clients don't specify the queue
+    if(msg[0] == 'enqueue'):
+      queue_name = msg[2] if len(msg) > 2 else default_queue_name
+      env_hash = msg[3] if len(msg) > 3 else None
+      return self._handle_enqueue(msg[1], queue_name, env_hash, user)
+
+    # ['enqueue_array', job data, queue, env hash, array indices]
+    elif(msg[0] == 'enqueue_array'):
+      data = dict(msg[1])
+      data[job_data.ARRAY] = msg[4]
+      return self._handle_enqueue(data, msg[2], msg[3], user)
+
+    # ['enqueue_jobs', list of (job data, env hash), queue]
+    elif(msg[0] == 'enqueue_jobs'):
+      return self._handle_enqueue_jobs(msg[1], msg[2], user)
+
+    elif(msg[0] == 'put_environment'):
+      return self._handle_put_environment(msg[1])
+        
+    elif(msg[0] == 'cancel'):
+      queue_name = msg[2] if len(msg) > 2 else default_queue_name
+      return self._handle_cancel(msg[1], queue_name)
       
-    
+    elif(msg[0] == 'shutdown'):
+      for queue in self._queues.values():
+        queue.shutdown()
+      return [(True, "Queue will shutdown as soon as all running jobs have completed.")]
+
+    elif(msg[0] == 'uri_query'):
+      return self._handle_uri_query(msg[1])
+
+    elif(msg[0] == 'uri_query_tree'):
+      return self._handle_uri_query_tree(msg[1], msg[2], msg[3])
+      
+    else:
+      print("Warning: Message is unknown, cannot be handled:",msg)
+      return [(False, "Invalid message")]
+
+  # Receives one request from the connection and answers it.
+  # Returns False if the connection has been closed by the client, and
+  # None if the connection has become a subscription.
+  def _serve_request(self, conn):
+    try:
+      msg = conn.recv()
+    except (EOFError, OSError):
+      return False
+
+    try:
+      if len(msg) == 3 and msg[0] == request_tag and msg[2][0] == 'subscribe':
+        print("Received message:",msg[2][:2])
+        if self._subscribe(conn, msg[1], msg[2][1], msg[2][2]):
+          return None
+      elif len(msg) == 3 and msg[0] == request_tag and msg[2][0] == 'tail':
+        print("Received message:",msg[2][:4])
+        return self._tail(conn, msg[1], *msg[2][1:7])
+      elif len(msg) == 3 and msg[0] == request_tag and msg[2][0] == 'list_jobs':
+        print("Received message:",msg[2][:4])
+        self._list_jobs(conn, msg[1], *msg[2][1:7])
+      elif len(msg) == 3 and msg[0] == request_tag:
+        request_id = msg[1]
+        conn.send([response_tag, request_id, self._handle_message(msg[2], self._peer_user(conn))])
+      else:
+        conn.send(self._handle_message(msg, self._peer_user(conn)))
+    except (EOFError, OSError):
+      return False
+    except Exception as e:
+      print("Warning: Exception occured during handling of message:", e)
+      return self._send_error(conn, msg, e)
+    return True
+
+  # Answers a request whose handling has failed, so that the client does
+  # not wait for a response forever. Returns like _serve_request().
+  def _send_error(self, conn, msg, error):
+    try:
+      if isinstance(msg, list) and len(msg) == 3 and msg[0] == request_tag:
+        # The output of a job may have been sent partially, after which
+        # the client can't tell a response from the output
+        if isinstance(msg[2], list) and len(msg[2]) > 0 and msg[2][0] == 'tail':
+          return False
+        conn.send([response_tag, msg[1], [(False, str(error))]])
+      else:
+        conn.send([(False, str(error))])
+    except (EOFError, OSError):
+      return False
+    return True
+
+  # Makes sure that reading a request or sending a response cannot block a
+  # thread of the server forever, e.g. if a client is suspended in the
+  # middle of sending a request.
+  def _set_io_timeout(self, conn):
+    seconds = int(self._io_timeout)
+    microseconds = int((self._io_timeout - seconds) * 1e6)
+    timeout = struct.pack("ll", seconds, microseconds)
+
+    # The socket object only borrows the file descriptor of the connection
+    sock = socket.socket(fileno=conn.fileno())
+    try:
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO, timeout)
+      sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, timeout)
+    finally:
+      sock.detach()
+
+  # Returns the id of the user of the process at the other end of the
+  # connection, as reported by the kernel
+  def _peer_user(self, conn):
+    sock = socket.socket(fileno=conn.fileno())
+    try:
+      credentials = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i"))
+    finally:
+      sock.detach()
+    pid, uid, gid = struct.unpack("3i", credentials)
+    return uid
+
+  def _return_connection(self, conn):
+    with self._connections_lock:
+      # If other connections are already waiting to be returned, the
+      # listening thread has been woken up already.
+      if len(self._returned_connections) == 0:
+        self._wakeup_sender.send(None)
+      self._returned_connections.append(conn)
+
+  def _accept_connections(self):
+    while True:
+      try:
+        conn = self._listener.accept()
+        self._set_io_timeout(conn)
+        self._return_connection(conn)
+      except Exception as e:
+        print("Warning: Exception occured while accepting connection:", e)
+
+  def _serve_connection(self, conn):
+    served = self._serve_request(conn)
+    if served == True:
+      self._return_connection(conn)
+    elif served == False:
+      conn.close()
+
+  def _close_idle_connections(self, now):
+    for conn, last_activity in list(self._connections.items()):
+      if now - last_activity > self._idle_timeout:
+        del self._connections[conn]
+        conn.close()
 
   def listen(self):
     print("********* Listening for instructions ***********")
+    accept_thread = threading.Thread(target=self._accept_connections, daemon=True)
+    accept_thread.start()
+    event_thread = threading.Thread(target=self._send_events, daemon=True)
+    event_thread.start()
+
     while True:
       try:
-        conn = self._listener.accept()
-        msg = conn.recv()
-        # Only log the the first three fields since the fourth is the environment,
-        # which would just clutter the log.
-        print("Received message:",msg[:3])
-        
-        if(msg[0] == 'enqueue'):
-          self._handle_enqueue(msg[1],conn)
-            
-        elif(msg[0] == 'cancel'):
-          job_id = msg[1]
-          result = self._queue_worker.cancel_job(job_id)
-          if not result:
-            conn.send([result])
+        ready = wait(list(self._connections.keys()) + [self._wakeup_receiver],
+                     timeout=self._idle_timeout)
+        now = time.monotonic()
+        for conn in ready:
+          if conn is self._wakeup_receiver:
+            conn.recv()
+            with self._connections_lock:
+              for returned in self._returned_connections:
+                self._connections[returned] = now
+              self._returned_connections = []
           else:
-            conn.send([result])
-          
-        elif(msg[0] == 'shutdown'):
-          conn.send([(True, "Queue will shutdown as soon as all running jobs have completed.")])
-          self._queue_worker.shutdown()
-
-        elif(msg[0] == 'uri_query'):
-          uri = msg[1]
-          try:
-            permissions = uri_permissions.CLIENT
-            access = uri_accessor(uri, self._uri_root, permissions)
-            result = access.read(permissions)
-            conn.send([(True, "URI has been read."), result])
-          except uri_exception_read_only:
-            conn.send([(False, "URI is read-only.")])
-          except uri_exception_permission_denied:
-            conn.send([(False, "Access to URI has been denied.")])
-          except uri_exception_not_found:
-            conn.send([(False, "Object at specified URI does not exist.")])
-          except uri_exception_no_such_attribute:
-            conn.send([(False, "Attribute specified by URI does not exist.")])
-          except Exception as e:
-            conn.send([(False, str(e))])
-            raise
-          
-        else:
-          print("Warning: Message is unknown, cannot be handled:",msg)
-          conn.send([(False, "Invalid message")])
-        
-        conn.close()
+            del self._connections[conn]
+            self._executor.submit(self._serve_connection, conn)
+
+        self._close_idle_connections(now)
       except Exception as e:
         print("Warning: Exception occured during handling of message:", e)
         #raise
@@ -617,55 +3395,373 @@ class queue_server:
     self._listener.close()
     
 
-class queue_client:
+# Returns True if the server has refused a request because it doesn't know
+# an environment that the request refers to by its content hash
+def is_unknown_environment(response):
+  return len(response) > 1 and response[1] == unknown_environment_tag
+
+# The requests of a client that take several round trips, shared by
+# queue_client and async_client.async_queue_client. Each one is a generator
+# that yields the messages to send and receives the replies, and returns
+# the final reply, so that the clients only differ in how they send a
+# request, see queue_client._run_requests().
+class client_requests:
   def __init__(self):
-    pass
-  
-  def enqueue_job(self, jdata):
-    connection = Client(socket_name)
+    # (content hash, environment) of the last environment that has been
+    # sent to the server. Further environments are sent as difference to it.
+    self._environment_base = None
+
+  # See queue_client.put_environment()
+  def put_environment(self, env):
+    response = None
+    if self._environment_base != None:
+      base_hash, base = self._environment_base
+      changed, removed = environment_difference(base, env)
+      if len(changed) + len(removed) < len(env):
+        response = yield ['put_environment', ("delta", base_hash, changed, removed)]
+
+    if response == None or is_unknown_environment(response):
+      response = yield ['put_environment', ("full", env)]
+
+    if response[0][0] == True:
+      self._environment_base = (response[1], dict(env))
+    return response
+
+  # See queue_client.enqueue_job() and enqueue_array()
+  def enqueue(self, jdata, queue_name, array_spec=None):
+    data = dict(jdata.get())
+    env = data[job_data.ENV]
+    data[job_data.ENV] = dict()
+    if array_spec == None:
+      msg = ['enqueue', data, queue_name, environment_hash(env)]
+    else:
+      msg = ['enqueue_array', data, queue_name, environment_hash(env), array_spec]
+
+    response = yield msg
+    if is_unknown_environment(response):
+      put_response = yield from self.put_environment(env)
+      if put_response[0][0] != True:
+        return put_response
+      response = yield msg
+
+    # The server may have dropped the environment in the meantime
+    if is_unknown_environment(response):
+      data[job_data.ENV] = env
+      if array_spec != None:
+        data[job_data.ARRAY] = array_spec
+      response = yield ['enqueue', data, queue_name]
+    return response
+
+  # See queue_client.enqueue_jobs()
+  def enqueue_jobs(self, jdata_list, queue_name):
+    jobs = []
+    environments = dict()
+    # Jobs are usually created with the same environment, only hash it once
+    hashes_by_object = dict()
+    for jdata in jdata_list:
+      data = dict(jdata.get())
+      env = data[job_data.ENV]
+      data[job_data.ENV] = dict()
+      env_hash = hashes_by_object.get(id(env))
+      if env_hash == None:
+        env_hash = environment_hash(env)
+        hashes_by_object[id(env)] = env_hash
+        environments[env_hash] = env
+      jobs.append((data, env_hash))
+    msg = ['enqueue_jobs', jobs, queue_name]
+
+    response = yield msg
+    if is_unknown_environment(response):
+      for env_hash in response[2]:
+        put_response = yield from self.put_environment(environments[env_hash])
+        if put_response[0][0] != True:
+          return put_response
+      response = yield msg
+
+    # The server may have dropped environments in the meantime
+    if is_unknown_environment(response):
+      for data, env_hash in jobs:
+        data[job_data.ENV] = environments[env_hash]
+      response = yield ['enqueue_jobs', [(data, None) for data, env_hash in jobs], queue_name]
+    return response
+
+
+# Client of the queue server. All requests of a client are sent over one
+# connection, which is opened with the first request and kept until
+# close() is called.
+class queue_client:
+  def __init__(self, address=None):
+    if address == None:
+      address = socket_name
+    self._address = address
+    self._connection = None
+    self._next_request_id = 0
+    self._requests = client_requests()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def close(self):
+    if self._connection != None:
+      self._connection.close()
+      self._connection = None
+
+  def _send_request(self, msg):
+    if self._connection == None:
+      self._connection = Client(self._address)
+
+    request_id = self._next_request_id
+    self._next_request_id += 1
+    self._connection.send([request_tag, request_id, msg])
+    return request_id
+
+  def _receive_response(self, request_id):
+    while True:
+      response = self._connection.recv()
+      if response[0] == response_tag and response[1] == request_id:
+        return response[2]
 
-    msg = ['enqueue', jdata.get()]
-    connection.send(msg)
-    
-    return connection.recv()
-    
-  def cancel_job(self,job_id):
-    connection = Client(socket_name)
-    
-    msg = ['cancel', job_id]
-    connection.send(msg)
+  def _request(self, msg):
+    try:
+      request_id = self._send_request(msg)
+    except (EOFError, OSError):
+      # The server may have closed an idle connection, try once more
+      # with a new one.
+      self.close()
+      request_id = self._send_request(msg)
+
+    try:
+      return self._receive_response(request_id)
+    except:
+      self.close()
+      raise
+  
+  # Sends the requests that a generator of client_requests yields and
+  # returns the result of the generator
+  def _run_requests(self, requests):
+    response = None
+    try:
+      while True:
+        response = self._request(requests.send(response))
+    except StopIteration as e:
+      return e.value
+
+  # Sends an environment to the server, as difference to the last
+  # environment sent, if the server still knows it and the difference
+  # is smaller. Returns the reply of the server.
+  def put_environment(self, env):
+    return self._run_requests(self._requests.put_environment(env))
+
+  # Enqueues a job. The environment of the job is only sent to the server
+  # if the server doesn't know it already.
+  def enqueue_job(self, jdata, queue_name=default_queue_name):
+    return self._run_requests(self._requests.enqueue(jdata, queue_name))
+
+  # Enqueues a job array, i.e. one job per index in array_spec (see
+  # parse_array_spec()) with a single request. The jobs can refer to their
+  # index with %a, and to the id of the array with %A.
+  def enqueue_array(self, jdata, array_spec, queue_name=default_queue_name):
+    return self._run_requests(self._requests.enqueue(jdata, queue_name, array_spec))
+
+  # Enqueues a list of jobs with a single request. The reply is
+  #   [(True, explanation), results]
+  # with one entry (True, job id) or (False, error message) per job, in the
+  # order of the list. The jobs are accepted in order: Once the queue has
+  # reached its maximum length or the submission rate limit is exceeded,
+  # all remaining jobs are rejected. Invalid jobs are rejected without
+  # affecting the others.
+  def enqueue_jobs(self, jdata_list, queue_name=default_queue_name):
+    return self._run_requests(self._requests.enqueue_jobs(jdata_list, queue_name))
     
-    return connection.recv()
+  def cancel_job(self,job_id, queue_name=default_queue_name):
+    return self._request(['cancel', job_id, queue_name])
     
   def get_queue_status(self):
-    connection = Client(socket_name)
-    
-    msg = ['status']
-    connection.send(msg)
-    return connection.recv()
+    return self._request(['status'])
 
   def uri_query(self, uri):
-    connection = Client(socket_name)
+    return self._request(["uri_query", uri])
+
+  # Subscribes to the state changes of the jobs with the given ids in a
+  # queue, or of all jobs if job_ids is None, or of all queues if
+  # queue_name is None. Returns a job_subscription.
+  def subscribe(self, queue_name=None, job_ids=None):
+    return job_subscription(self._address, queue_name, job_ids)
+
+  # Blocks until the jobs with the given ids have finished or have been
+  # cancelled, or until the timeout in seconds has passed. Returns a dict
+  # job id -> (state, exit code) of the jobs that have left the queue.
+  # Jobs that are neither in the queue nor in its history have the
+  # state None.
+  def wait(self, job_ids, queue_name=default_queue_name, timeout=None):
+    deadline = None
+    if timeout != None:
+      deadline = time.monotonic() + timeout
+
+    results = dict()
+    with self.subscribe(queue_name, job_ids) as subscription:
+      for job_id in job_ids:
+        state, exit_code = subscription.states.get(job_id, (None, None))
+        if not state in [job_state.QUEUED, job_state.STARTED]:
+          results[job_id] = (state, exit_code)
+
+      while len(results) < len(set(job_ids)):
+        remaining = None
+        if deadline != None:
+          remaining = max(deadline - time.monotonic(), 0)
+        event = subscription.next_event(remaining)
+        if event == None:
+          break
+        if event["state"] in [job_state.FINISHED, job_state.CANCELLED]:
+          results[event["id"]] = (event["state"], event["exit_code"])
+    return results
+
+  # Yields the jobs of a queue that match the filters as dicts field ->
+  # value, as they are received from the server. See queue_worker.list_jobs()
+  # for filters, sort, limit and offset. fields are the URI attributes of
+  # the jobs to return, None for all but the environment. Raises a
+  # RuntimeError if the server refuses the request.
+  def list_jobs(self, queue_name=default_queue_name, filters=None, sort="id",
+                limit=None, offset=0, fields=None):
+    msg = ['list_jobs', queue_name, filters, sort, limit, offset, fields]
+    try:
+      request_id = self._send_request(msg)
+    except (EOFError, OSError):
+      self.close()
+      request_id = self._send_request(msg)
 
-    msg = ["uri_query", uri]
-    connection.send(msg)
-    return connection.recv()
+    try:
+      while True:
+        response = self._connection.recv()
+        if response[1] != request_id:
+          continue
+        if response[0] == rows_tag:
+          yield from response[2]
+        elif response[0] == response_tag:
+          if response[2][0][0] != True:
+            raise RuntimeError(response[2][0][1])
+          return
+    except (EOFError, OSError):
+      self.close()
+      raise
+
+  # Yields the output stream ("stdout" or "stderr") of a job from the given
+  # byte offset in chunks of bytes. If follow is True, the output of a
+  # running job is yielded as it is written until the job has finished.
+  # Raises a RuntimeError if no output is available.
+  def tail(self, job_id, queue_name=default_queue_name, stream="stdout", offset=0, follow=False):
+    response = self._request(['tail', queue_name, job_id, stream, offset, follow])
+    if response[0][0] != True:
+      raise RuntimeError(response[0][1])
+
+    complete = False
+    try:
+      while True:
+        data = self._connection.recv_bytes()
+        if len(data) == 0:
+          complete = True
+          return
+        yield data
+    finally:
+      # The rest of the output would have to be received first
+      if not complete:
+        self.close()
+
+  # Queries the attributes of the node at the URI, and of its children down
+  # to the given depth, in one request. uri may also be a list of URIs.
+  # If attributes is given, only attributes with these names are returned.
+  def uri_query_tree(self, uri, attributes=None, depth=0):
+    return self._request(["uri_query_tree", uri, attributes, depth])
   
   def shutdown_queue(self):
-    connection = Client(socket_name)
-    
-    msg = ['shutdown']
-    connection.send(msg)
-    return connection.recv()
+    return self._request(['shutdown'])
       
+# Subscription to the state changes of jobs, see queue_client.subscribe().
+# It has its own connection to the queue server. The events are dicts with
+# the keys "queue", "id", "state" (see job_state) and "exit_code".
+class job_subscription:
+  def __init__(self, address, queue_name=None, job_ids=None):
+    self._connection = Client(address)
+    try:
+      self._connection.send([request_tag, 0, ['subscribe', queue_name, job_ids]])
+      # Skip anything that is not the reply
+      msg = self._connection.recv()
+      while msg[0] != response_tag:
+        msg = self._connection.recv()
+      response = msg[2]
+    except:
+      self.close()
+      raise
+
+    if response[0][0] != True:
+      self.close()
+      raise RuntimeError(response[0][1])
+    # job id -> (state, exit code) of the subscribed jobs that were in the
+    # queue or its history when the subscription was made
+    self.states = response[1]
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def __iter__(self):
+    while True:
+      try:
+        yield self.next_event()
+      except EOFError:
+        return
+
+  # Returns the next event, or None if there is none within the timeout
+  # in seconds. Without timeout, it blocks until there is an event. Raises
+  # EOFError once the server has ended the subscription, which it does
+  # when all subscribed jobs have finished.
+  def next_event(self, timeout=None):
+    while True:
+      if timeout != None and not self._connection.poll(timeout):
+        return None
+      msg = self._connection.recv()
+      if msg[0] == event_tag:
+        return msg[2]
+
+  def close(self):
+    if self._connection != None:
+      self._connection.close()
+      self._connection = None
+
+# Returns the log file of the queue with the given name
+def queue_log_file(queue_name):
+  if queue_name == default_queue_name:
+    return queue_worker_log
+  root, extension = os.path.splitext(queue_worker_log)
+  return root + "." + queue_name + extension
+
 class queue_system(uri_node):
-  def __init__(self, log_file=default_log_file):
+  def __init__(self, log_file=default_log_file, queues=default_queues):
     self._log_filename = log_file
     self._set_log_file(log_file)
 
     self._queues = dict()
-    self._queues["default"] = queue_worker(queue_worker_log)
-    self._server = queue_server(self._queues["default"], default_max_queue_length, self)
+    job_cgroups = setup_job_cgroups()
+    # After the server has moved to a cgroup of its own, which the launcher
+    # inherits
+    self._launcher = process_launcher()
+    for queue_name in queues:
+      num_slots, policy = queues[queue_name]
+      self._queues[queue_name] = queue_worker(queue_log_file(queue_name),
+                                              num_slots,
+                                              job_journal(default_journal_directory, queue_name),
+                                              policy=scheduling_policies[policy](),
+                                              spool_directory=os.path.join(default_spool_directory,
+                                                                           queue_name),
+                                              cgroup_directory=create_queue_cgroup(job_cgroups, queue_name),
+                                              launcher=self._launcher)
+    self._queue_directory = uri_directory(self._queues)
+    self._server = queue_server(self._queues, default_max_queue_length, self)
     self._listener_thread = None
 
   def _set_log_file(self, filename):
@@ -675,8 +3771,7 @@ class queue_system(uri_node):
     sys.stderr = self._log
      
   def uri_children(self, permissions):
-    queues = uri_directory(self._queues)
-    return {"queues" : queues}
+    return {"queues" : self._queue_directory}
 
   # Returns a list that contains the available URI attributes of this node
   def uri_node_attributes(self, permissions):
@@ -697,15 +3792,58 @@ class queue_system(uri_node):
     self._listener_thread = threading.Thread(target=self._server.listen, daemon=True)
     self._listener_thread.start()
 
-    # TODO This of course does not work for more than one queue
+    # Every queue dispatches its jobs independently
+    queue_threads = []
     for queue_name in self._queues:
-      self._queues[queue_name].main_loop()
+      t = threading.Thread(target=self._queues[queue_name].main_loop)
+      queue_threads.append(t)
+      t.start()
+
+    for t in queue_threads:
+      t.join()
 
   def get_queues(self):
     return self._queues
 
+def usage():
+  print("Usage: queue_system.py [<queue name>[:<number of slots>[:<policy>]] ...]")
+  print("  Starts the queue system with the given queues. Without arguments,")
+  print("  a single queue '" + default_queue_name + "' with one slot per CPU is started.")
+  print("  Scheduling policies: " + ", ".join(scheduling_policies.keys()) +
+        " (default: " + default_scheduling_policy + ")")
+
+# Parses queue definitions of the form
+# <queue name>[:<number of slots>[:<scheduling policy>]]
+def parse_queue_definitions(args):
+  queues = dict()
+  for arg in args:
+    parts = arg.split(":")
+    if len(parts) > 3 or parts[0] == "" or "/" in parts[0]:
+      raise ValueError("Invalid queue definition: " + arg)
+
+    num_slots = default_num_slots
+    if len(parts) >= 2 and parts[1] != "":
+      num_slots = int(parts[1])
+    policy = default_scheduling_policy
+    if len(parts) == 3:
+      policy = parts[2]
+      if not policy in scheduling_policies:
+        raise ValueError("Unknown scheduling policy: " + policy)
+    queues[parts[0]] = (num_slots, policy)
+  return queues
+
 if __name__ == '__main__':
-  q = queue_system()
+  queues = default_queues
+  if len(sys.argv) > 1:
+    if sys.argv[1] == "--help":
+      usage()
+      sys.exit(0)
+    try:
+      queues = parse_queue_definitions(sys.argv[1:])
+    except ValueError as e:
+      print("Error:", e)
+      usage()
+      sys.exit(-1)
+
+  q = queue_system(queues=queues)
   q.run()
-      
-    
@@ -0,0 +1,49 @@
+#!/usr/bin/python
+
+import queue_system
+import sys
+
+def usage():
+  print("Usage: qwait.py [-q <queue>] [-t <timeout in seconds>] <job id> ...")
+  print("  Waits until the jobs have finished. The exit status is 0 if all jobs")
+  print("  have finished with exit code 0.")
+
+if __name__ == '__main__':
+  args = sys.argv[1:]
+  queue_name = queue_system.default_queue_name
+  timeout = None
+  while len(args) >= 2 and args[0] in ["-q", "--queue", "-t", "--timeout"]:
+    if args[0] == "-q" or args[0] == "--queue":
+      queue_name = args[1]
+    else:
+      timeout = float(args[1])
+    args = args[2:]
+
+  if len(args) == 0 or args[0] == "--help":
+    usage()
+    sys.exit(0 if len(args) > 0 else -1)
+
+  job_ids = [int(arg) for arg in args]
+
+  client = queue_system.queue_client()
+  results = client.wait(job_ids, queue_name, timeout)
+
+  success = True
+  for job_id in job_ids:
+    if not job_id in results:
+      print("Job", job_id, "has not finished yet.")
+      success = False
+      continue
+
+    state, exit_code = results[job_id]
+    if state == queue_system.job_state.FINISHED:
+      print("Job", job_id, "has finished with exit code", exit_code)
+      if exit_code != 0:
+        success = False
+    elif state == queue_system.job_state.CANCELLED:
+      print("Job", job_id, "has been cancelled.")
+      success = False
+    else:
+      print("Job", job_id, "is unknown to the queue.")
+      success = False
+  sys.exit(0 if success else 1)
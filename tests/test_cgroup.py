@@ -0,0 +1,127 @@
+# Tests of job_cgroup against fake cgroup files in a temporary directory,
+# so that they run without cgroup v2 delegation.
+
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cgroup
+
+def write_file(directory, name, content):
+  with open(os.path.join(directory, name), "w") as f:
+    f.write(content)
+
+def read_file(directory, name):
+  with open(os.path.join(directory, name), "r") as f:
+    return f.read()
+
+class job_cgroup_test(unittest.TestCase):
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.cgroup = cgroup.job_cgroup(self._directory.name, 7)
+    self.path = self.cgroup.get_path()
+
+  def tearDown(self):
+    self._directory.cleanup()
+
+  def test_path(self):
+    self.assertEqual(self.path, os.path.join(self._directory.name, "job-7"))
+    self.assertTrue(os.path.isdir(self.path))
+
+  def test_set_limits(self):
+    write_file(self.path, "cgroup.controllers", "cpu io memory pids\n")
+    self.assertEqual(self.cgroup.set_limits(0.5, 100, 10), set())
+    self.assertEqual(read_file(self.path, "cpu.max"), "50000 100000")
+    self.assertEqual(read_file(self.path, "memory.max"), str(100 * 1024 * 1024))
+    self.assertEqual(read_file(self.path, "pids.max"), "10")
+
+  def test_set_limits_min_cpu_quota(self):
+    write_file(self.path, "cgroup.controllers", "cpu\n")
+    self.cgroup.set_limits(0.001, 0, 0)
+    self.assertEqual(read_file(self.path, "cpu.max"), "1000 100000")
+
+  def test_set_limits_without_limits(self):
+    write_file(self.path, "cgroup.controllers", "")
+    self.assertEqual(self.cgroup.set_limits(0.0, 0, 0), set())
+    self.assertEqual(sorted(os.listdir(self.path)), ["cgroup.controllers"])
+
+  def test_set_limits_unavailable_controllers(self):
+    write_file(self.path, "cgroup.controllers", "pids\n")
+    self.assertEqual(self.cgroup.set_limits(2.0, 100, 10), {"cpu", "memory"})
+    self.assertFalse(os.path.exists(os.path.join(self.path, "cpu.max")))
+    self.assertFalse(os.path.exists(os.path.join(self.path, "memory.max")))
+    self.assertEqual(read_file(self.path, "pids.max"), "10")
+
+  def test_read_usage(self):
+    write_file(self.path, "cpu.stat",
+               "usage_usec 1750000\nuser_usec 1500000\nsystem_usec 250000\n"
+               "nr_periods 0\nnr_throttled 0\nthrottled_usec 0\n")
+    write_file(self.path, "memory.peak", "1048576\n")
+    write_file(self.path, "io.stat",
+               "8:0 rbytes=1000 wbytes=2000 rios=1 wios=2 dbytes=0 dios=0\n"
+               "8:16 rbytes=24 wbytes=0 rios=1 wios=0 dbytes=0 dios=0\n")
+    self.assertEqual(self.cgroup.read_usage(), {
+      "user_time": 1.5, "system_time": 0.25, "peak_memory": 1024,
+      "read_bytes": 1024, "write_bytes": 2000})
+
+  def test_read_usage_without_memory_and_io(self):
+    write_file(self.path, "cpu.stat", "usage_usec 3000\nuser_usec 2000\nsystem_usec 1000\n")
+    self.assertEqual(self.cgroup.read_usage(), {"user_time": 0.002, "system_time": 0.001})
+
+  def test_is_out_of_memory(self):
+    self.assertFalse(self.cgroup.is_out_of_memory())
+    write_file(self.path, "memory.events", "low 0\nhigh 0\nmax 3\noom 1\noom_kill 0\n")
+    self.assertFalse(self.cgroup.is_out_of_memory())
+    write_file(self.path, "memory.events", "low 0\nhigh 0\nmax 5\noom 2\noom_kill 1\n")
+    self.assertTrue(self.cgroup.is_out_of_memory())
+
+  def test_is_populated(self):
+    write_file(self.path, "cgroup.events", "populated 1\nfrozen 0\n")
+    self.assertTrue(self.cgroup.is_populated())
+    write_file(self.path, "cgroup.events", "populated 0\nfrozen 0\n")
+    self.assertFalse(self.cgroup.is_populated())
+    self.assertTrue(self.cgroup.kill_remaining(timeout=0))
+
+  def test_kill_remaining_timeout(self):
+    write_file(self.path, "cgroup.events", "populated 1\nfrozen 0\n")
+    self.assertFalse(self.cgroup.kill_remaining(timeout=0.05))
+    self.assertEqual(read_file(self.path, "cgroup.kill"), "1")
+
+  def test_kill(self):
+    self.cgroup.kill()
+    self.assertEqual(read_file(self.path, "cgroup.kill"), "1")
+
+  def test_kill_without_cgroup_kill(self):
+    # Like on Linux < 5.14, where cgroup.kill doesn't exist and can't be
+    # created
+    os.symlink(os.path.join(self._directory.name, "missing", "cgroup.kill"),
+               os.path.join(self.path, "cgroup.kill"))
+    process = subprocess.Popen(["sleep", "60"])
+    exited = subprocess.Popen(["true"])
+    exited.wait()
+    try:
+      # Processes that have exited meanwhile are skipped
+      write_file(self.path, "cgroup.procs", "{}\n{}\n".format(exited.pid, process.pid))
+      self.cgroup.kill()
+      self.assertEqual(process.wait(timeout=10), -signal.SIGKILL)
+    finally:
+      if process.poll() == None:
+        process.kill()
+        process.wait()
+
+  def test_remove(self):
+    self.cgroup.remove()
+    self.assertFalse(os.path.exists(self.path))
+
+  def test_left_over_cgroup(self):
+    # Left over from a queue server that has not exited cleanly
+    self.cgroup = cgroup.job_cgroup(self._directory.name, 7)
+    self.assertTrue(os.path.isdir(self.path))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,142 @@
+# Tests of the resource limits of jobs without cgroups, where they are set
+# with setrlimit(), and of killing jobs by their process group. They run
+# without cgroup v2 delegation.
+
+import os
+import resource
+import signal
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import launcher
+from queue_system import job, job_data, job_record, limit_controllers
+
+# Returns a job with the given submitted fields that runs in directory
+def make_job(directory, command, **fields):
+  data = dict(job_data.default_values)
+  data[job_data.CMD] = command
+  data[job_data.DIR] = directory
+  data[job_data.ENV] = dict(os.environ)
+  for field, value in fields.items():
+    data[getattr(job_data, field)] = value
+  record = job_record(data)
+  record.sanitize_new_submission()
+  record.set_field(job_data.ID, 1)
+  return job(record)
+
+# Expected value of a fallback rlimit, which can't exceed the hard limit
+def capped(limit, value):
+  soft, hard = resource.getrlimit(limit)
+  return value if hard == resource.RLIM_INFINITY else min(value, hard)
+
+# Allocates 256 MiB
+allocating_command = [sys.executable, "-c", "bytearray(256 * 1024 * 1024)"]
+
+class fallback_rlimits_test(unittest.TestCase):
+  def test_no_limits(self):
+    j = make_job("/", ["true"], WALLTIME=10)
+    self.assertEqual(j._get_fallback_rlimits(set(limit_controllers)), [])
+
+  def test_unavailable_controllers(self):
+    j = make_job("/", ["true"], CPU_LIMIT=0.5, MEMORY_LIMIT=100, PIDS_LIMIT=10, WALLTIME=10)
+    self.assertEqual(j._get_fallback_rlimits(set(limit_controllers)),
+                     [(resource.RLIMIT_AS, capped(resource.RLIMIT_AS, 100 * 1024 * 1024)),
+                      (resource.RLIMIT_CPU, capped(resource.RLIMIT_CPU, 5))])
+
+  def test_available_controllers(self):
+    j = make_job("/", ["true"], CPU_LIMIT=0.5, MEMORY_LIMIT=100, PIDS_LIMIT=10, WALLTIME=10)
+    self.assertEqual(j._get_fallback_rlimits(set()), [])
+    self.assertEqual(j._get_fallback_rlimits({"cpu"}),
+                     [(resource.RLIMIT_CPU, capped(resource.RLIMIT_CPU, 5))])
+
+  def test_cpu_limit_without_walltime(self):
+    j = make_job("/", ["true"], CPU_LIMIT=1.5)
+    self.assertEqual(j._get_fallback_rlimits(set(limit_controllers)), [])
+
+  def test_cpu_time_is_rounded_up(self):
+    j = make_job("/", ["true"], CPU_LIMIT=0.25, WALLTIME=3)
+    self.assertEqual(j._get_fallback_rlimits({"cpu"}),
+                     [(resource.RLIMIT_CPU, capped(resource.RLIMIT_CPU, 1))])
+
+class job_run_test(unittest.TestCase):
+  @classmethod
+  def setUpClass(cls):
+    cls.launcher = launcher.process_launcher()
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.launcher.close()
+
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.directory = self._directory.name
+
+  def tearDown(self):
+    self._directory.cleanup()
+
+  def read_output(self, j, stream="stdout"):
+    with open(j.get_output_file(stream), "r") as f:
+      return f.read()
+
+  def run_job(self, j):
+    j.run(self.launcher)
+    return j.raw_data().get_field(job_data.EXIT_CODE)
+
+  def test_memory_limit(self):
+    j = make_job(self.directory, allocating_command)
+    self.assertEqual(self.run_job(j), 0)
+
+    j = make_job(self.directory, allocating_command, MEMORY_LIMIT=128)
+    self.assertNotEqual(self.run_job(j), 0)
+    self.assertIn("MemoryError", self.read_output(j, "stderr"))
+    # The limit only applies to the job, the launcher can still start
+    # jobs that need more memory
+    j = make_job(self.directory, allocating_command)
+    self.assertEqual(self.run_job(j), 0)
+
+  def test_cpu_limit(self):
+    busy_command = [sys.executable, "-c", "while True: pass"]
+    j = make_job(self.directory, busy_command, CPU_LIMIT=0.2, WALLTIME=5)
+    start = time.monotonic()
+    # Killed after 1 s of CPU time, well before the walltime. Since the
+    # soft and hard limits are equal, the kernel sends SIGKILL.
+    self.assertEqual(self.run_job(j), -signal.SIGKILL)
+    self.assertLess(time.monotonic() - start, 4.5)
+    self.assertNotIn("exceeded its walltime", self.read_output(j))
+
+  def test_kill(self):
+    # The job's process group also contains the processes it has started
+    j = make_job(self.directory, ["sh", "-c", "sleep 60 & wait"])
+    thread = threading.Thread(target=j.run, args=(self.launcher,))
+    thread.start()
+    deadline = time.monotonic() + 10
+    while j.raw_data().get_field(job_data.PROCESS) == None:
+      self.assertLess(time.monotonic(), deadline)
+      time.sleep(0.01)
+    start = time.monotonic()
+    j.kill()
+    thread.join(timeout=10)
+    self.assertFalse(thread.is_alive())
+    self.assertLess(time.monotonic() - start, 10)
+    self.assertEqual(j.raw_data().get_field(job_data.EXIT_CODE), -signal.SIGTERM)
+
+  def test_kill_after_exit(self):
+    j = make_job(self.directory, ["true"])
+    j.run(self.launcher)
+    # The process has been reaped, so there's nothing left to kill
+    j.kill()
+    self.assertEqual(j.raw_data().get_field(job_data.EXIT_CODE), 0)
+
+  def test_kill_before_start(self):
+    j = make_job(self.directory, ["true"])
+    j.kill()
+    j.run(self.launcher)
+    self.assertIn("killed before it was started", self.read_output(j, "stderr"))
+
+if __name__ == '__main__':
+  unittest.main()
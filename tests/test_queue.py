@@ -0,0 +1,159 @@
+# Tests of queue_worker that run without a queue server
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from journal import job_journal
+from queue_system import environment_delta, environment_hash, environment_pool, job_data, queue_worker, spool_mover
+from uri import uri_accessor, uri_directory, uri_permissions
+
+# Returns the data of a job that runs command in directory
+def make_job_data(directory, command, **fields):
+  jdata = job_data()
+  jdata.set_field(job_data.CMD, command)
+  jdata.set_field(job_data.DIR, directory)
+  jdata.set_field(job_data.ENV, dict(os.environ))
+  for field, value in fields.items():
+    jdata.set_field(getattr(job_data, field), value)
+  return jdata
+
+class queue_uri_test(unittest.TestCase):
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.directory = self._directory.name
+    # The main loop doesn't run, so jobs keep waiting
+    self.queue = queue_worker(os.path.join(self.directory, "queue.log"), num_slots=1)
+    self.root = uri_directory({"queues": uri_directory({"test": self.queue})})
+
+  def tearDown(self):
+    self.queue.shutdown()
+    self._directory.cleanup()
+
+  def list_uri(self, uri):
+    permissions = uri_permissions.CLIENT
+    listing = uri_accessor(uri, self.root, permissions).read(permissions)
+    return uri_accessor.node_content_lister.extract_listing(listing)
+
+  def test_list_queue(self):
+    listing = self.list_uri("qsystem://queues/test")
+    self.assertIn("jobs/", listing)
+    self.assertIn("history/", listing)
+    self.assertNotIn("next-job/", listing)
+
+    self.queue.new_job(make_job_data(self.directory, ["true"]))
+    listing = self.list_uri("qsystem://queues/test")
+    self.assertIn("jobs/", listing)
+    self.assertIn("next-job/", listing)
+    self.assertIn("id", self.list_uri("qsystem://queues/test/next-job"))
+
+  def test_queue_tree(self):
+    self.queue.new_job(make_job_data(self.directory, ["true"]))
+    permissions = uri_permissions.CLIENT
+    access = uri_accessor("qsystem://queues/test", self.root, permissions)
+    tree = access.read_tree(permissions, depth=1)
+    self.assertEqual({key for key in tree if key.endswith("/")}, {"jobs/", "history/", "next-job/"})
+    self.assertEqual(tree["next-job/"]["id"], 0)
+
+class restore_test(unittest.TestCase):
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.directory = self._directory.name
+
+  def tearDown(self):
+    self._directory.cleanup()
+
+  # Returns a queue whose jobs are restored from the journal. Its main loop
+  # doesn't run, so jobs keep waiting.
+  def make_queue(self, num_slots):
+    return queue_worker(os.path.join(self.directory, "queue.log"), num_slots,
+                        job_journal(os.path.join(self.directory, "journal"), "test"))
+
+  def stop_queue(self, queue):
+    queue.shutdown()
+    queue._journal.close()
+
+  def test_restore(self):
+    queue = self.make_queue(4)
+    queue.new_job(make_job_data(self.directory, ["true"], SLOTS=2))
+    queue.new_job(make_job_data(self.directory, ["true"], DEPENDENCIES="afterok:0"))
+    self.stop_queue(queue)
+
+    queue = self.make_queue(4)
+    self.assertEqual(sorted(queue._jobs.keys()), [0, 1])
+    self.assertEqual(queue._find_next_job_for_execution().get_id(), 0)
+    self.stop_queue(queue)
+
+  def test_restore_with_fewer_slots(self):
+    queue = self.make_queue(8)
+    queue.new_job(make_job_data(self.directory, ["true"], SLOTS=8))
+    queue.new_job(make_job_data(self.directory, ["true"], SLOTS=2))
+    queue.new_job(make_job_data(self.directory, ["true"], DEPENDENCIES="afterok:0"))
+    self.stop_queue(queue)
+
+    # The job that doesn't fit anymore is cancelled, and so is the job that
+    # depends on it
+    queue = self.make_queue(4)
+    self.assertEqual(sorted(queue._jobs.keys()), [1])
+    self.assertEqual(queue._find_next_job_for_execution().get_id(), 1)
+    self.stop_queue(queue)
+
+    # Also after the next restart, when there are enough slots again
+    queue = self.make_queue(8)
+    self.assertEqual(sorted(queue._jobs.keys()), [1])
+    self.stop_queue(queue)
+
+class environment_pool_test(unittest.TestCase):
+  def test_deltas(self):
+    pool = environment_pool()
+    base = pool.intern({"A": "1", "B": "2"})
+    first = pool.intern_delta(base.content_hash, {"C": "3"}, ["B"])
+    self.assertEqual(first.materialize(), {"A": "1", "C": "3"})
+    self.assertEqual(first.content_hash, environment_hash({"A": "1", "C": "3"}))
+
+    # A delta to a delta refers to the full environment
+    second = pool.intern_delta(first.content_hash, {"D": "4"}, ["A"])
+    self.assertIsInstance(second, environment_delta)
+    self.assertIs(second.base, base)
+    self.assertEqual(second.materialize(), {"C": "3", "D": "4"})
+    self.assertIs(pool.lookup(second.content_hash), second)
+
+    self.assertEqual(pool.intern_delta("unknown", {}, []), None)
+
+class spool_mover_test(unittest.TestCase):
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.directory = self._directory.name
+
+  def tearDown(self):
+    self._directory.cleanup()
+
+  def make_file(self, name, content):
+    path = os.path.join(self.directory, name)
+    with open(path, "w") as f:
+      f.write(content)
+    return path
+
+  def test_same_destination(self):
+    first = self.make_file("spool.1", "first")
+    second = self.make_file("spool.2", "second")
+    destination = os.path.join(self.directory, "out.txt")
+    mover = spool_mover()
+    # Nothing is moved while the lock is held
+    with mover._cond:
+      mover.move(first, destination)
+      mover.move(second, destination)
+      self.assertEqual(mover.find(destination), second)
+    mover.close()
+
+    self.assertFalse(os.path.exists(first))
+    self.assertFalse(os.path.exists(second))
+    with open(destination, "r") as f:
+      self.assertEqual(f.read(), "second")
+    self.assertEqual(mover.find(destination), None)
+
+if __name__ == '__main__':
+  unittest.main()
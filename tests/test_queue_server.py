@@ -0,0 +1,189 @@
+# Tests of queue_server with a queue_client
+
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from async_client import async_queue_client
+from queue_system import job_data, job_state, queue_client, queue_server, queue_worker
+from uri import uri_directory
+
+# Returns the data of a job that runs command in directory
+def make_job_data(directory, command, **fields):
+  jdata = job_data()
+  jdata.set_field(job_data.CMD, command)
+  jdata.set_field(job_data.DIR, directory)
+  jdata.set_field(job_data.ENV, dict(os.environ))
+  for field, value in fields.items():
+    jdata.set_field(getattr(job_data, field), value)
+  return jdata
+
+# Runs a queue server with the queue "test" for each test. If dispatch is
+# False, the jobs of the queue are never started.
+class queue_server_test_case(unittest.TestCase):
+  dispatch = True
+  max_queue_length = 100
+  max_submission_rate = 100.0
+  submission_burst = 100
+
+  def setUp(self):
+    self._directory = tempfile.TemporaryDirectory()
+    self.directory = self._directory.name
+    self.queue = queue_worker(os.path.join(self.directory, "queue.log"), num_slots=1)
+    queues = {"test": self.queue}
+    # In the abstract namespace, since the server never closes its socket
+    self.address = "\0queue-system-test-" + os.path.basename(self.directory)
+    self.server = queue_server(queues, self.max_queue_length,
+                               uri_directory({"queues": uri_directory(queues)}),
+                               max_submission_rate=self.max_submission_rate,
+                               submission_burst=self.submission_burst,
+                               address=self.address)
+    threading.Thread(target=self.server.listen, daemon=True).start()
+    self.queue_thread = None
+    if self.dispatch:
+      self.queue_thread = threading.Thread(target=self.queue.main_loop)
+      self.queue_thread.start()
+    self.client = queue_client(self.address)
+
+  def tearDown(self):
+    self.client.close()
+    self.queue.shutdown()
+    if self.queue_thread != None:
+      self.queue_thread.join()
+    self._directory.cleanup()
+
+  def enqueue(self, command, **fields):
+    return self.client.enqueue_job(make_job_data(self.directory, command, **fields), "test")
+
+class job_test(queue_server_test_case):
+  def test_wait(self):
+    # The queue starts a process launcher of its own
+    first = self.enqueue(["true"])[1]
+    second = self.enqueue(["sh", "-c", "exit 3"], MEMORY_LIMIT=512)[1]
+    self.assertEqual(self.client.wait([first, second], "test", timeout=30),
+                     {first: (job_state.FINISHED, 0), second: (job_state.FINISHED, 3)})
+
+class subscription_test(queue_server_test_case):
+  # Waits until the server has no subscriptions left and returns the
+  # number of open file descriptors of the process
+  def wait_for_no_subscriptions(self):
+    deadline = time.monotonic() + 10
+    while len(self.server._subscriptions) > 0 and time.monotonic() < deadline:
+      time.sleep(0.01)
+    self.assertEqual(len(self.server._subscriptions), 0)
+    return len(os.listdir("/proc/self/fd"))
+
+  def test_subscriptions_end(self):
+    job_id = self.enqueue(["true"])[1]
+    self.client.wait([job_id], "test", timeout=30)
+    num_fds = self.wait_for_no_subscriptions()
+
+    for i in range(10):
+      job_id = self.enqueue(["true"])[1]
+      self.assertEqual(self.client.wait([job_id], "test", timeout=30),
+                       {job_id: (job_state.FINISHED, 0)})
+    # Jobs that have finished already, and unknown jobs
+    for i in range(10):
+      self.client.wait([job_id, 12345], "test", timeout=30)
+    self.assertEqual(self.wait_for_no_subscriptions(), num_fds)
+
+  def test_subscriber_closes_connection(self):
+    job_id = self.enqueue(["true"])[1]
+    self.client.wait([job_id], "test", timeout=30)
+    num_fds = self.wait_for_no_subscriptions()
+
+    for i in range(10):
+      with self.client.subscribe("test"):
+        pass
+      with self.client.subscribe("test", [job_id + 1]):
+        pass
+    self.assertEqual(self.wait_for_no_subscriptions(), num_fds)
+
+  def test_events(self):
+    with self.client.subscribe("test") as subscription:
+      job_id = self.enqueue(["true"])[1]
+      states = []
+      while len(states) == 0 or states[-1] != job_state.FINISHED:
+        event = subscription.next_event(10)
+        self.assertNotEqual(event, None)
+        self.assertEqual(event["id"], job_id)
+        states.append(event["state"])
+    self.assertEqual(states, [job_state.QUEUED, job_state.STARTED, job_state.FINISHED])
+
+    # A subscription for given jobs ends when they have finished
+    job_id = self.enqueue(["sleep", "0.5"])[1]
+    with self.client.subscribe("test", [job_id]) as subscription:
+      self.assertIn(subscription.states[job_id][0], [job_state.QUEUED, job_state.STARTED])
+      states = [event["state"] for event in subscription]
+    self.assertEqual(states[-1], job_state.FINISHED)
+
+class client_test(queue_server_test_case):
+  dispatch = False
+
+  def check_environments(self):
+    self.assertEqual(self.queue.find_job_by_id(0).get_environment(), dict(os.environ))
+    self.assertEqual(self.queue.find_job_by_id(1).get_environment()["QSYSTEM_TEST"], "1")
+    self.assertEqual(self.queue.find_job_by_id(2).get_environment()["QSYSTEM_TEST"], "2")
+    self.assertEqual(self.queue.find_job_by_id(3).get_environment()["QSYSTEM_TEST"], "2")
+
+  def make_jobs(self):
+    changed_env = dict(os.environ)
+    changed_env["QSYSTEM_TEST"] = "1"
+    array_env = dict(os.environ)
+    array_env["QSYSTEM_TEST"] = "2"
+    return (make_job_data(self.directory, ["true"]),
+            make_job_data(self.directory, ["true"], ENV=changed_env),
+            make_job_data(self.directory, ["true"], ENV=array_env))
+
+  def test_enqueue(self):
+    plain, changed, array = self.make_jobs()
+    self.assertEqual(self.client.enqueue_job(plain, "test")[1], 0)
+    # Sent as difference to the first environment
+    self.assertEqual(self.client.enqueue_job(changed, "test")[1], 1)
+    self.assertEqual(self.client.enqueue_array(array, "0-1", "test")[1], 2)
+    self.assertEqual(self.client.enqueue_jobs([array], "test")[1], [(True, 3)])
+    self.check_environments()
+
+  def test_async_enqueue(self):
+    plain, changed, array = self.make_jobs()
+    async def enqueue():
+      async with async_queue_client(self.address) as client:
+        self.assertEqual((await client.enqueue_job(plain, "test"))[1], 0)
+        self.assertEqual((await client.enqueue_job(changed, "test"))[1], 1)
+        response = await client.enqueue_jobs([array, array], "test")
+        self.assertEqual(response[1], [(True, 2), (True, 3)])
+    asyncio.run(enqueue())
+    self.check_environments()
+
+class submission_limit_test(queue_server_test_case):
+  dispatch = False
+  max_queue_length = 2
+  max_submission_rate = 0.001
+  submission_burst = 3
+
+  def test_rejected_jobs_dont_count(self):
+    for i in range(2):
+      self.assertTrue(self.enqueue(["true"])[0][0])
+    for i in range(5):
+      response = self.enqueue(["true"])
+      self.assertFalse(response[0][0])
+      self.assertIn("maximum allowed length", response[0][1])
+    response = self.client.enqueue_jobs([make_job_data(self.directory, ["true"])] * 3, "test")
+    self.assertEqual([result[0] for result in response[1]], [False] * 3)
+
+    self.assertTrue(self.client.cancel_job(0, "test")[0][0])
+    # The last token is still there
+    self.assertTrue(self.enqueue(["true"])[0][0])
+    self.assertTrue(self.client.cancel_job(1, "test")[0][0])
+    response = self.enqueue(["true"])
+    self.assertFalse(response[0][0])
+    self.assertIn("Too many jobs", response[0][1])
+
+if __name__ == '__main__':
+  unittest.main()
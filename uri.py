@@ -4,6 +4,9 @@
 # to access the pid of job #98:
 # queues://default/jobs/98/pid
 
+import collections
+import threading
+
 
 class uri_permissions:
   CLIENT = 0,
@@ -25,6 +28,17 @@ class uri_exception_not_found(uri_exception):
   pass
 
 class uri_node:
+  # Generation of the structure of the URI tree. It is incremented by
+  # uri_tree_changed() whenever children are added to or removed from any
+  # node of the tree, which invalidates all cached URI resolutions.
+  generation = 0
+  _generation_lock = threading.Lock()
+
+  # Names of children that may refer to different nodes over time, without
+  # a change of the tree structure. URIs that pass through them are
+  # never cached.
+  uri_volatile_children = frozenset()
+
   def __init__(self):
     pass
 
@@ -42,6 +56,12 @@ class uri_node:
   def write_uri_attribute(self, name, value, permissions):
     raise NotImplementedError("URI write not implemented")
 
+# Must be called whenever children are added to or removed from a node
+# of the URI tree.
+def uri_tree_changed():
+  with uri_node._generation_lock:
+    uri_node.generation += 1
+
 class uri_directory(uri_node):
   def __init__(self, children):
     self._children = children
@@ -64,6 +84,13 @@ class uri_accessor:
   job_uri    = "jobs://"
   system_uri = "qsystem://"
 
+  # Max. number of resolved URIs that are cached. Resolved URIs remain valid
+  # as long as the generation of the URI tree doesn't change.
+  cache_capacity = 1024
+  # (uri, permissions) -> (generation, resolution)
+  _cache = collections.OrderedDict()
+  _cache_lock = threading.Lock()
+
   class attribute_setter:
     def __init__(self, uri_node, attribute_name):
       self._node = uri_node
@@ -79,12 +106,29 @@ class uri_accessor:
 
     def content(self, permissions):
       result = ("uri-query-listing", [])
-      for child in self._node.uri_children(permissions):
+      # Take a snapshot, the children may change concurrently
+      for child in list(self._node.uri_children(permissions)):
         result[1].append(child + "/")
       for attribute in self._node.uri_node_attributes(permissions):
         result[1].append(attribute)
       return result
 
+    # Returns the values of the attributes of the node as a dict. If depth > 0,
+    # the children of the node are included recursively as entries
+    # "<child name>/" down to the given depth. If attributes is given, only
+    # attributes with these names are read.
+    def tree(self, permissions, attributes=None, depth=0):
+      result = dict()
+      for attribute in self._node.uri_node_attributes(permissions):
+        if attributes == None or attribute in attributes:
+          result[attribute] = self._node.read_uri_attribute(attribute, permissions)
+
+      if depth > 0:
+        for name, child in list(self._node.uri_children(permissions).items()):
+          child_lister = uri_accessor.node_content_lister(child)
+          result[name + "/"] = child_lister.tree(permissions, attributes, depth - 1)
+      return result
+
     def is_listing(query_result):
       try:
         if query_result[0] == "uri-query-listing":
@@ -104,14 +148,61 @@ class uri_accessor:
     self._getter = self._ungettable
     self._setter = self._unsettable
     self._attribute_setter = None
+    self._node_lister = None
+    self._cacheable = True
 
     self._uri_root = uri_root
-    self._parse(uri, permissions)
+
+    cache_key = (uri, permissions)
+    if not self._load_cached(cache_key):
+      generation = uri_node.generation
+      self._parse(uri, permissions)
+      if self._cacheable:
+        self._store_cached(cache_key, generation)
+
+  def _load_cached(self, cache_key):
+    with self._cache_lock:
+      entry = self._cache.get(cache_key)
+      if entry == None:
+        return False
+
+      generation, resolution = entry
+      if generation != uri_node.generation:
+        del self._cache[cache_key]
+        return False
+
+      self._cache.move_to_end(cache_key)
+    (self._getter, self._setter,
+     self._attribute_setter, self._node_lister) = resolution
+    return True
+
+  # Caches the resolution of the URI. The generation must be read before
+  # parsing the URI, so that a concurrent change of the tree
+  # invalidates the result.
+  def _store_cached(self, cache_key, generation):
+    if self.cache_capacity <= 0:
+      return
+
+    resolution = (self._getter, self._setter,
+                  self._attribute_setter, self._node_lister)
+    with self._cache_lock:
+      self._cache[cache_key] = (generation, resolution)
+      self._cache.move_to_end(cache_key)
+      while len(self._cache) > self.cache_capacity:
+        self._cache.popitem(last=False)
 
 
   def read(self, permissions):
     return self._getter(permissions)
 
+  # Reads the whole subtree below the URI in one go, see
+  # node_content_lister.tree(). If the URI refers to an attribute,
+  # its value is returned.
+  def read_tree(self, permissions, attributes=None, depth=0):
+    if self._node_lister == None:
+      return self.read(permissions)
+    return self._node_lister.tree(permissions, attributes, depth)
+
   def write(self, value, permissions):
     current_value = self.read(permissions)
     current_type = type(current_value)
@@ -175,6 +266,8 @@ class uri_accessor:
         return
       
       if investigate_children and part_present_in_children:
+        if part in current_node.uri_volatile_children:
+          self._cacheable = False
         current_node = children[part]
 
     # When an attribute is reached, the function is aborted. Hence, since
@@ -182,6 +275,7 @@ class uri_accessor:
     content_lister = self.node_content_lister(current_node)
     self._getter = lambda perm : content_lister.content(perm)
     self._setter = self._unsettable
+    self._node_lister = content_lister
         
       
         
@@ -200,6 +294,7 @@ class uri_accessor:
   def _parse(self, uri, permissions):
     self._getter = self._ungettable
     self._setter = self._unsettable
+    self._node_lister = None
 
     if uri.startswith(self.queue_uri):
       uri = uri.replace(self.queue_uri, "", 1)